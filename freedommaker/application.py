@@ -24,9 +24,28 @@ import argparse
 import datetime
 import logging
 import logging.config
+import lzma
 import os
+import signal
+import sqlite3
+import sys
+import time
 
-from .builder import ImageBuilder
+from . import chunks
+from . import daemon
+from . import history
+from . import loop
+from . import packages
+from . import plan
+from . import progress
+from . import store
+from .builder import ImageBuilder, parse_size
+from .buildlog import TAIL_LINES
+from .mirror import (LocalMirror, get_target_packages,
+                     get_target_source_packages)
+from .pipeline import Pipeline, STAGE_LIMITS, parse_stage_limit
+from .preflight import Preflight
+from .variant import ImageVariant
 import freedommaker
 
 IMAGE_SIZE = '3800M'
@@ -36,8 +55,49 @@ DISTRIBUTION = 'unstable'
 DOWNLOAD_SOURCE = False
 INCLUDE_SOURCE = False
 BUILD_DIR = 'build'
+CACHE_DIR = None
+LOCAL_MIRROR = None
 LOG_LEVEL = 'debug'
 HOSTNAME = 'freedombox'
+EMULATION_CPUS = 1
+SAMPLE_INTERVAL = 2
+PROGRESS = 'auto'
+PLAN_FORMATS = ['text', 'json']
+
+# Name, what is given instead of targets and how many, and description of
+# each command
+COMMANDS = [
+    ('build', 'TARGET', '+',
+     'Build images of the targets, the default command'),
+    ('mirror-sync', 'TARGET', '+',
+     'Download the packages needed for the targets into the local mirror'),
+    ('serve', None, None,
+     'Run a build daemon that builds requests one after the other'),
+    ('submit', 'TARGET', '+',
+     'Build the targets with the build daemon. Options other than those of '
+     'what is built and where, such as --vmdebootstrap and resource limits, '
+     'are the daemon\'s own'),
+    ('history', 'TARGET', '*',
+     'Compare the latest builds of the targets, or all, with earlier '
+     'builds and exit with failure if a stage got slower'),
+    ('pin', 'BUILD_STAMP', '+',
+     'Protect files of builds in the artifact store from removal'),
+    ('unpin', 'BUILD_STAMP', '+',
+     'Allow files of builds in the artifact store to be removed again'),
+    ('extract', 'IMAGE', '+',
+     'Reassemble images from the chunk store into the build directory'),
+    ('chunk-stats', None, None,
+     'Show how much space the chunk store saves'),
+]
+
+# Commands that manage the artifact store
+STORE_COMMANDS = ['pin', 'unpin']
+
+# Commands that use the chunk store
+CHUNK_COMMANDS = ['extract', 'chunk-stats']
+
+RAM_DISKS = ['tmpfs', 'zram']
+RAM_DISK = 'tmpfs'
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -47,108 +107,544 @@ class Application(object):
     def __init__(self):
         """Initialize object."""
         self.arguments = None
+        self.listener = None
+        self.progress = None
 
     def run(self):
         """Parse the command line args and execute the command."""
         self.parse_arguments()
 
+        if self.arguments.progress == 'always' or \
+           (self.arguments.progress == 'auto' and sys.stderr.isatty()):
+            self.progress = progress.ProgressDisplay(sys.stderr)
+
         self.setup_logging()
+        if self.arguments.command == 'submit' and not self.arguments.plan:
+            sys.exit(daemon.submit(self.get_socket(), self.arguments))
+
+        if self.arguments.command == 'history':
+            build_history = history.BuildHistory(self.arguments.build_dir)
+            if not os.path.exists(build_history.file_name):
+                logger.info('No build history in %s',
+                            self.arguments.build_dir)
+                return
+
+            sys.exit(int(build_history.report(self.arguments.targets)))
+
+        if self.arguments.command in STORE_COMMANDS:
+            self.pin_builds()
+            return
+
+        if self.arguments.command == 'extract':
+            self.extract_images()
+            return
+
+        if self.arguments.command == 'chunk-stats':
+            self.print_chunk_statistics()
+            return
+
         logger.info('Freedom Maker version - %s', freedommaker.__version__)
 
-        try:
-            logger.info('Creating directory - %s', self.arguments.build_dir)
-            os.makedirs(self.arguments.build_dir)
-        except os.error:
-            pass
+        # Let cleanup of loop devices and mounts run when terminated
+        signal.signal(signal.SIGTERM, loop.deferring(
+            lambda *_: sys.exit(128 + signal.SIGTERM)))
+        signal.signal(signal.SIGINT,
+                      loop.deferring(signal.default_int_handler))
+        if not self.arguments.plan:
+            loop.collect_garbage()
+
+        if self.arguments.command == 'serve':
+            os.makedirs(self.arguments.build_dir, exist_ok=True)
+            daemon.BuildDaemon(self.get_socket(), self.execute_request,
+                               self.arguments).serve()
+            return
+
+        self.execute()
+
+    def get_socket(self):
+        """Return the path of the build daemon's socket."""
+        return os.path.abspath(self.arguments.socket or os.path.join(
+            self.arguments.build_dir, daemon.SOCKET_NAME))
+
+    @staticmethod
+    def execute_request(arguments, listener):
+        """Execute a build received by the build daemon."""
+        application = Application()
+        application.arguments = arguments
+        application.listener = listener
+        application.execute()
+
+    def execute(self):
+        """Execute the command or build the targets."""
+        if not self.arguments.plan:
+            try:
+                logger.info('Creating directory - %s',
+                            self.arguments.build_dir)
+                os.makedirs(self.arguments.build_dir)
+            except os.error:
+                pass
+
+        if not self.arguments.cache_dir:
+            self.arguments.cache_dir = os.path.join(
+                self.arguments.build_dir, 'cache')
+
+        if not self.arguments.local_mirror:
+            self.arguments.local_mirror = os.path.join(
+                self.arguments.cache_dir, 'mirror')
 
+        local_mirror = LocalMirror(self.arguments.local_mirror,
+                                   self.arguments.distribution)
+
+        if self.arguments.command == 'mirror-sync' and \
+           not self.arguments.plan:
+            self.sync_mirror(local_mirror)
+            return
+
+        if not self.arguments.build_mirror:
+            self.arguments.build_mirror = BUILD_MIRROR
+            architectures, components = self.get_mirror_packages()
+            if local_mirror.covers(architectures, components,
+                                   self.get_mirror_sources()):
+                logger.info('Using local mirror - %s', local_mirror.url)
+                self.arguments.build_mirror = local_mirror.url
+            elif local_mirror.is_synced():
+                logger.info('Local mirror was not synchronized for these '
+                            'targets, not using it - %s', local_mirror.url)
+
+        targets = []
         for target in self.arguments.targets:
-            logger.info('Building target - %s', target)
+            if ImageBuilder.get_builder_class(target):
+                targets.append(target)
+            else:
+                logger.warn('Unknown target - %s', target)
+
+        if self.arguments.plan:
+            plan.write_plan(plan.get_plan(targets, self.arguments),
+                            sys.stdout, self.arguments.plan_format)
+            return
+
+        if not self.arguments.skip_preflight:
+            Preflight(self.arguments).run(self.arguments.targets)
+
+        if len(targets) > 1:
+            self.setup_logging(show_thread=True)
+
+        self.log_estimates(targets)
+
+        pipeline = Pipeline(self.arguments.stage_limit, self.listener)
+        try:
+            pipeline.run(targets, self.create_builder)
+        finally:
+            self.evict_artifacts()
+            self.prune_chunks()
 
+    def pin_builds(self):
+        """Pin or unpin build stamps in the artifact store."""
+        artifact_store = store.ArtifactStore(self.arguments.artifact_store)
+        for build_stamp in self.arguments.targets:
+            if self.arguments.command == 'pin':
+                artifact_store.pin(build_stamp)
+                logger.info('Pinned build - %s', build_stamp)
+            else:
+                artifact_store.unpin(build_stamp)
+                logger.info('Unpinned build - %s', build_stamp)
+
+    def extract_images(self):
+        """Reassemble images from the chunk store into build directory."""
+        chunk_store = chunks.ChunkStore(self.arguments.chunk_store)
+        os.makedirs(self.arguments.build_dir, exist_ok=True)
+        for name in self.arguments.targets:
+            index = chunk_store.find_index(name)
+            file_name = index['name']
+            if index['compressed']:
+                file_name = file_name[:-len('.xz')]
+
+            file_name = os.path.join(self.arguments.build_dir, file_name)
+            logger.info('Extracting image - %s', file_name)
+            chunk_store.extract(index, file_name)
+
+    def print_chunk_statistics(self):
+        """Print the space saved by the chunk store."""
+        statistics = chunks.ChunkStore(
+            self.arguments.chunk_store).get_statistics()
+        print('Images: {}, {} MiB'.format(
+            statistics['images'], statistics['image_bytes'] // 1024**2))
+        print('Unique chunks: {}, {} MiB, stored in {} MiB'.format(
+            statistics['chunks'], statistics['chunk_bytes'] // 1024**2,
+            statistics['stored_bytes'] // 1024**2))
+        print('Images take 1/{:.1f} of their size'.format(
+            statistics['ratio']))
+
+    def evict_artifacts(self):
+        """Remove least recently used artifacts beyond the store quota."""
+        if self.arguments.store_quota is None:
+            return
+
+        artifact_store = store.ArtifactStore(self.arguments.artifact_store)
+        try:
+            evicted = artifact_store.evict(self.arguments.store_quota)
+        except (OSError, sqlite3.Error) as exception:
+            logger.warning('Unable to evict artifacts from store - %s',
+                           exception)
+            return
+
+        logger.info('Artifact store uses %d MiB after evicting %d files',
+                    artifact_store.get_size() // 1024**2, len(evicted))
+
+    def prune_chunks(self):
+        """Remove images of old builds from the chunk store."""
+        if self.arguments.chunk_retention is None:
+            return
+
+        chunk_store = chunks.ChunkStore(self.arguments.chunk_store)
+        try:
+            indexes, removed = chunk_store.prune(
+                self.arguments.chunk_retention)
+        except (OSError, ValueError, lzma.LZMAError) as exception:
+            logger.warning('Unable to prune chunk store - %s', exception)
+            return
+
+        logger.info('Removed %d images and %d chunks from chunk store',
+                    indexes, removed)
+
+    def log_estimates(self, targets):
+        """Log how long targets are expected to take from earlier builds."""
+        build_history = history.BuildHistory(self.arguments.build_dir)
+        total = 0
+        for target in targets:
+            cls = ImageBuilder.get_builder_class(target)
+            try:
+                estimate = build_history.estimate(
+                    history.get_key(cls, self.arguments))
+            except sqlite3.Error as exception:
+                logger.warning('Unable to read build history - %s',
+                               exception)
+                return
+
+            if estimate:
+                total += estimate[None]
+                logger.info('Target %s usually takes %s', target,
+                            history.format_duration(estimate[None]))
+            else:
+                logger.info('Target %s has not been built before', target)
+
+        if total:
+            logger.info('Targets built before done in at most %s, by %s',
+                        history.format_duration(total),
+                        datetime.datetime.fromtimestamp(
+                            time.time() + total).strftime('%H:%M'))
+
+    def create_builder(self, target):
+        """Return the builder of a target."""
+        cls = ImageBuilder.get_builder_class(target)
+        builder = cls(self.arguments)
+        builder.progress = self.progress
+        return builder
+
+    def get_mirror_packages(self):
+        """Return packages and components the mirror needs for targets.
+
+        Packages are a map of architecture names to the names of packages
+        needed for them.
+
+        """
+        architectures = {}
+        components = packages.FREE_COMPONENTS
+        for target in self.arguments.targets:
             cls = ImageBuilder.get_builder_class(target)
             if not cls:
-                logger.warn('Unknown target - %s', target)
                 continue
 
-            builder = cls(self.arguments)
-            self.setup_logging(builder.log_file)
-            try:
-                builder.build()
-                logger.info('Target complete - %s', target)
-            except:
-                logger.error('Target failed - %s', target)
-                raise
-            finally:
-                builder.cleanup()
-
-    def parse_arguments(self):
-        """Parse command line arguments."""
+            architectures.setdefault(cls.architecture, []).extend(
+                get_target_packages(cls, self.arguments))
+            if not cls.free:
+                components = packages.NONFREE_COMPONENTS
+
+        return architectures, components
+
+    def get_mirror_sources(self):
+        """Return source packages fetched from build mirror for targets."""
+        names = []
+        for target in self.arguments.targets:
+            cls = ImageBuilder.get_builder_class(target)
+            if cls:
+                names.extend(get_target_source_packages(cls, self.arguments))
+
+        return names
+
+    def sync_mirror(self, local_mirror):
+        """Download all packages needed to build the targets locally."""
+        upstream = self.arguments.build_mirror or BUILD_MIRROR
+        for target in self.arguments.targets:
+            if not ImageBuilder.get_builder_class(target):
+                logger.warn('Unknown target - %s', target)
+
+        architectures, components = self.get_mirror_packages()
+        logger.info('Synchronizing local mirror %s from %s',
+                    local_mirror.directory, upstream)
+        cache_directory = os.path.join(self.arguments.cache_dir, 'indexes')
+        os.makedirs(cache_directory, exist_ok=True)
+        local_mirror.sync(upstream, architectures, components,
+                          cache_directory, key=self.arguments.mirror_key)
+
+    def parse_arguments(self, argv=None):
+        """Parse command line arguments, those of the process by default."""
         build_stamp = datetime.datetime.today().strftime('%Y-%m-%d')
 
-        parser = argparse.ArgumentParser(
-            description='FreedomMaker - Script to build FreedomBox images',
-            formatter_class=argparse.ArgumentDefaultsHelpFormatter
-        )
-        parser.add_argument(
+        options = argparse.ArgumentParser(add_help=False)
+        options.add_argument(
             '--vmdebootstrap', default='vmdebootstrap',
             help='Path to vmdebootstrap executable')
-        parser.add_argument(
+        options.add_argument(
             '--build-stamp', default=build_stamp,
             help='Build stamp to use on image file names')
-        parser.add_argument(
+        options.add_argument(
             '--image-size', default=IMAGE_SIZE,
             help='Size of the image to build')
-        parser.add_argument(
-            '--build-mirror', default=BUILD_MIRROR,
-            help='Debian mirror to use for building')
-        parser.add_argument(
+        options.add_argument(
+            '--build-mirror',
+            help='Debian mirror to use for building, defaults to the local '
+            'mirror if it has been synchronized, otherwise ' + BUILD_MIRROR)
+        options.add_argument(
             '--mirror', default=MIRROR,
             help='Debian mirror to use in built image')
-        parser.add_argument(
+        options.add_argument(
             '--distribution', default=DISTRIBUTION,
             help='Debian release to use in built image')
-        parser.add_argument(
+        options.add_argument(
             '--download-source', action='store_true', default=DOWNLOAD_SOURCE,
             help='Whether to download source packages')
-        parser.add_argument(
+        options.add_argument(
             '--include-source', action='store_true', default=INCLUDE_SOURCE,
             help='Whether to include source in build image')
-        parser.add_argument(
+        options.add_argument(
             '--package', action='append',
             help='Install additional packages in the image')
-        parser.add_argument(
+        options.add_argument(
             '--custom-package', action='append',
             help='Install package from DEB file into the image')
-        parser.add_argument(
+        options.add_argument(
+            '--variant', action='append', type=ImageVariant.parse,
+            help='Also build a variant of the image from the same base '
+            'build, given as NAME:CHANGE,... where CHANGE is one of '
+            'hostname=HOSTNAME, package=PACKAGE, custom-package=DEB_FILE or '
+            'mirror=MIRROR')
+        options.add_argument(
             '--build-dir', default=BUILD_DIR,
             help='Diretory to build images and create log file')
-        parser.add_argument(
+        options.add_argument(
+            '--cache-dir', default=CACHE_DIR,
+            help='Directory to cache downloaded files across builds, '
+            'defaults to \'cache\' inside build directory')
+        options.add_argument(
+            '--local-mirror', default=LOCAL_MIRROR,
+            help='Directory of the local mirror written by mirror-sync, '
+            'defaults to \'mirror\' inside cache directory')
+        options.add_argument(
+            '--mirror-key',
+            help='GPG key to sign the local mirror with instead of the '
+            'default key')
+        options.add_argument(
             '--log-level', default=LOG_LEVEL, help='Log level',
             choices=('critical', 'error', 'warn', 'info', 'debug'))
-        parser.add_argument(
+        options.add_argument(
             '--hostname', default=HOSTNAME,
             help='Hostname to set inside the built images')
-        parser.add_argument(
+        options.add_argument(
             '--sign', action='store_true',
             help='Sign the images with default GPG key after building')
-        parser.add_argument(
+        options.add_argument(
             '--force', action='store_true',
             help='Force rebuild of images even when required image exists')
-        parser.add_argument(
+        options.add_argument(
+            '--refresh-from', metavar='IMAGE',
+            help='Instead of a full build, upgrade packages in a previously '
+            'built image of the same target, if the image was built with the '
+            'same customization inputs')
+        options.add_argument(
+            '--resume', action='store_true',
+            help='Resume a failed build from its last checkpoint instead of '
+            'building from scratch')
+        options.add_argument(
+            '--emulation-cpus', type=int, default=EMULATION_CPUS,
+            help='Number of CPUs dedicated to each build of a foreign '
+            'architecture, concurrent builds get different CPUs. More than '
+            'one may hang with affected versions of qemu-user-static (Debian '
+            'bug #769983)')
+        options.add_argument(
+            '--memory-limit', type=parse_size,
+            help='Maximum memory, in bytes or with K, M or G suffix, that '
+            'each build may use including its tmpfs with --build-in-ram')
+        options.add_argument(
+            '--cgroup-parent', metavar='PATH',
+            help='Control group delegated to Freedom Maker, under which each '
+            'build runs in a group of its own to limit and account its '
+            'resources, defaults to freedom-maker under the root of cgroup '
+            'v2 hierarchy. Builds are not limited if it does not exist')
+        options.add_argument(
+            '--cpu-weight', type=int,
+            help='Relative share of CPU for each build among other processes '
+            'on the host, from 1 to 10000 with 100 being the default')
+        options.add_argument(
+            '--io-weight', type=int,
+            help='Relative share of disk I/O for each build among other '
+            'processes on the host, from 1 to 10000 with 100 being the '
+            'default')
+        options.add_argument(
+            '--skip-preflight', action='store_true',
+            help='Do not check packages, programs and disk space needed by '
+            'all targets before building')
+        options.add_argument(
             '--build-in-ram', action='store_true',
-            help='Build the image in RAM so that it is faster, requires '
-            'free RAM about the size of disk image')
-        parser.add_argument(
-            'targets', nargs='+', help='Image targets to build')
+            help='Build the image in RAM so that it is faster')
+        options.add_argument(
+            '--ram-disk', choices=RAM_DISKS, default=RAM_DISK,
+            help='Kind of RAM disk to build in with --build-in-ram. tmpfs '
+            'requires free RAM about the size of disk image. With zram, the '
+            'image is compressed in RAM and needs only a fraction of that')
+        options.add_argument(
+            '--sample-interval', type=float, default=SAMPLE_INTERVAL,
+            help='Seconds between samples of CPU, memory, I/O and network '
+            'used by each step of a build, written to a .resources.csv file '
+            'next to the image. 0 disables sampling')
+        options.add_argument(
+            '--metrics-dir',
+            help='Directory of node exporter\'s textfile collector to write '
+            'metrics of each target to, after it is built')
+        options.add_argument(
+            '--failure-lines', type=int, default=TAIL_LINES,
+            help='Number of last lines of the failed phase of a build to '
+            'show. Logs of all phases are in a .logs directory next to the '
+            'image')
+        options.add_argument(
+            '--progress', choices=['auto', 'always', 'never'],
+            default=PROGRESS,
+            help='Show a line with the phase, percent done, throughput and '
+            'ETA of each target being built below log messages. auto, the '
+            'default, shows it when writing to a terminal')
+        options.add_argument(
+            '--artifact-store', metavar='DIRECTORY',
+            help='Directory to store built files in by their content. Files '
+            'in the build directory become hard links to stored files, or '
+            'reflinks on another file system, so identical files of '
+            'different builds take space once')
+        options.add_argument(
+            '--store-quota', type=parse_size, metavar='SIZE',
+            help='Maximum size of the artifact store, in bytes or with K, M, '
+            'G or T suffix. After building, least recently used files are '
+            'removed from the store and the build directory, except those '
+            'of pinned builds')
+        options.add_argument(
+            '--pin', action='store_true',
+            help='Pin the files built in the artifact store, such as for a '
+            'release, so that they are never removed to fit the quota')
+        options.add_argument(
+            '--chunk-store', metavar='DIRECTORY',
+            help='Directory to also store images built in, split into '
+            'chunks that are only stored once across all images. Images can '
+            'be reassembled with the extract command, also once removed '
+            'from the build directory')
+        options.add_argument(
+            '--drop-chunked-images', action='store_true',
+            help='Remove images from the build directory once they are in '
+            'the chunk store, leaving their index to extract them with')
+        options.add_argument(
+            '--chunk-retention', type=int, metavar='BUILDS',
+            help='After building, remove images of all but this many latest '
+            'build stamps of each target from the chunk store, along with '
+            'the chunks only they used')
+        options.add_argument(
+            '--delta-block-size', type=parse_size, metavar='SIZE',
+            help='Compress images in independent blocks of this size, such '
+            'as 4M, and write an index of the blocks next to each archive. '
+            'Clients with an image of an earlier build download only the '
+            'blocks that changed')
+        options.add_argument(
+            '--plan', action='store_true',
+            help='Instead of building, show the stages each target would '
+            'run with their commands, why they run or are skipped and when '
+            'they would be done judging from earlier builds. Nothing is run, '
+            'so neither root, loop devices nor the network are needed')
+        options.add_argument(
+            '--plan-format', choices=PLAN_FORMATS, default='text',
+            help='Format of the plan shown with --plan')
+        options.add_argument(
+            '--socket',
+            help='UNIX socket of the build daemon, defaults to {} in build '
+            'directory'.format(daemon.SOCKET_NAME))
+        options.add_argument(
+            '--stage-limit', action='append', type=parse_stage_limit,
+            metavar='STAGE=COUNT',
+            help='Number of targets that may run a build stage at the same '
+            'time, may be given multiple times. Stages and defaults: ' +
+            ', '.join('{}={}'.format(stage, count)
+                      for stage, count in STAGE_LIMITS.items()))
+
+        parser = argparse.ArgumentParser(
+            description='FreedomMaker - Script to build FreedomBox images',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            parents=[options])
+        commands = parser.add_subparsers(
+            dest='command', metavar='COMMAND',
+            help='Command to run, build when only targets are given')
+        for name, metavar, nargs, help_text in COMMANDS:
+            command = commands.add_parser(name, help=help_text,
+                                          description=help_text)
+            if nargs:
+                command.add_argument('targets', metavar=metavar, nargs=nargs)
+            else:
+                command.set_defaults(targets=[])
+
+        # Options may also be given after the command and its targets
+        self.arguments, words = options.parse_known_args(
+            sys.argv[1:] if argv is None else argv)
+
+        if not words or (words[0] not in commands.choices and
+                         not words[0].startswith('-')):
+            words.insert(0, 'build')
 
-        self.arguments = parser.parse_args()
+        parser.parse_args(words, namespace=self.arguments)
+
+        if not self.arguments.artifact_store:
+            if self.arguments.command in STORE_COMMANDS:
+                parser.error('--artifact-store is required for ' +
+                             self.arguments.command)
+
+            if self.arguments.store_quota is not None or self.arguments.pin:
+                parser.error('--store-quota and --pin require '
+                             '--artifact-store')
+
+        if not self.arguments.chunk_store:
+            if self.arguments.command in CHUNK_COMMANDS:
+                parser.error('--chunk-store is required for ' +
+                             self.arguments.command)
+
+            if self.arguments.chunk_retention is not None or \
+               self.arguments.drop_chunked_images:
+                parser.error('--chunk-retention and --drop-chunked-images '
+                             'require --chunk-store')
+
+        if self.arguments.chunk_retention is not None and \
+           self.arguments.chunk_retention < 1:
+            parser.error('--chunk-retention must be at least 1')
+
+    def setup_logging(self, show_thread=False):
+        """Setup logging.
+
+        When several targets are built at the same time, show the target
+        of each message.
+
+        """
+        log_format = '%(asctime)s - %(levelname)s - %(message)s'
+        if show_thread:
+            log_format = '%(asctime)s - %(threadName)s - %(levelname)s - ' \
+                '%(message)s'
 
-    def setup_logging(self, log_file=None):
-        """Setup logging."""
         config = {
             'version': 1,
             'formatters': {
                 'date': {
-                    'format': '%(asctime)s - %(levelname)s - %(message)s'
+                    'format': log_format
                 }
             },
             'handlers': {
@@ -163,4 +659,7 @@ class Application(object):
             },
             'disable_existing_loggers': False
         }
+        if self.progress:
+            config['handlers']['console']['stream'] = self.progress
+
         logging.config.dictConfig(config)
@@ -0,0 +1,507 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmarks of freedom-maker's own overhead and the data path of builds.
+
+Builds run with a stub builder backend that writes synthetic sparse images
+instead of running vmdebootstrap, so that benchmarks need neither root nor
+network access:
+
+    python3 -m freedommaker.benchmark --image-size 512M --density 0.3 \\
+        --output results.json
+
+Programs that are not installed, such as VBoxManage or qemu-img for VM
+conversions, have their benchmarks reported as skipped.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import freedommaker
+
+from . import store
+from .application import Application
+from .builder import ImageBuilder, parse_size
+from .pipeline import Pipeline
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+IMAGE_SIZE = '128M'
+DENSITY = 0.25
+REPEAT = 3
+TARGETS = ['amd64', 'i386']
+
+# Images are written in chunks, each either left as a hole or filled
+CHUNK_SIZE = 1024**2
+
+# Share of each filled chunk that is random and so incompressible. The rest
+# repeats a small block, like the redundancy in file system contents.
+RANDOM_FRACTION = 0.25
+
+# Number of earlier builds in the build directory for the lookup of a
+# reusable build
+PREVIOUS_BUILDS = 100
+
+# Stages and targets run through the scheduler with no work in them
+SCHEDULER_STAGES = ['make_image', 'compress', 'sign']
+SCHEDULER_TARGETS = 8
+
+# Name and command writing to stdout of each compression codec
+CODECS = [
+    ('xz', ['xz', '--no-warn', '--best', '--stdout']),
+    ('xz-threads', ['xz', '--no-warn', '--best', '--threads=0',
+                    '--stdout']),
+    ('pxz', ['pxz', '-9', '--stdout']),
+    ('zstd', ['zstd', '-19', '--threads=0', '--quiet', '--stdout']),
+    ('gzip', ['gzip', '--best', '--stdout']),
+]
+
+# Name, program and command prefix of each VM image conversion
+CONVERSIONS = [
+    ('vdi', 'VBoxManage', ['VBoxManage', 'convertdd']),
+    ('qcow2', 'qemu-img', ['qemu-img', 'convert', '-O', 'qcow2']),
+]
+
+
+def write_sparse_image(file_name, size, density, seed=0):
+    """Write an image with a share of its chunks filled with data.
+
+    Return the number of bytes written, the rest of the image being holes.
+
+    """
+    generator = random.Random(seed)
+    random_size = int(CHUNK_SIZE * RANDOM_FRACTION)
+    block = generator.getrandbits(4096 * 8).to_bytes(4096, 'little')
+    filler = (block * (CHUNK_SIZE // len(block)))[:CHUNK_SIZE - random_size]
+    written = 0
+    with open(file_name, 'wb') as file_handle:
+        for offset in range(0, size, CHUNK_SIZE):
+            if generator.random() >= density:
+                continue
+
+            data = generator.getrandbits(random_size * 8).to_bytes(
+                random_size, 'little') + filler
+            data = data[:size - offset]
+            file_handle.seek(offset)
+            file_handle.write(data)
+            written += len(data)
+
+        file_handle.truncate(size)
+
+    return written
+
+
+def get_allocated_size(file_name):
+    """Return the bytes of disk allocated to a file."""
+    return os.stat(file_name).st_blocks * 512
+
+
+class StubBuilderBackend(object):
+    """Builder backend writing a synthetic sparse image."""
+
+    def __init__(self, builder, density):
+        """Initialize the object."""
+        self.builder = builder
+        self.density = density
+
+    def make_image(self):
+        """Create a disk image."""
+        if self.builder.should_skip_step(self.builder.image_file):
+            logger.info('Image exists, skipping build - %s',
+                        self.builder.image_file)
+            return
+
+        temp_image_file = self.builder.get_temp_image_file()
+        write_sparse_image(temp_image_file,
+                           parse_size(self.builder.arguments.image_size),
+                           self.density)
+        shutil.move(temp_image_file, self.builder.image_file)
+
+    @staticmethod
+    def make_image_variant(variant, image_file):
+        """Leave a variant's image as a copy of the built image."""
+        pass
+
+
+class StubStageBuilder(object):
+    """Builder whose stages do nothing, to time the scheduler alone."""
+
+    def prepare(self):
+        """Get ready for running the build stages."""
+        pass
+
+    def get_stages(self):
+        """Return the names and functions of stages to build the target."""
+        return [(stage, lambda: None) for stage in SCHEDULER_STAGES]
+
+    @staticmethod
+    def run_stage(stage, function):
+        """Run a stage of the build."""
+        function()
+
+    def fail(self):
+        """Record that the build failed."""
+        pass
+
+    def cancel(self):
+        """Stop the commands of the build, there are none."""
+        pass
+
+    def complete(self):
+        """Record that all stages of the build have run."""
+        pass
+
+    def cleanup(self):
+        """Finalize tasks."""
+        pass
+
+
+class Benchmark(object):
+    """Run benchmarks in a work directory and collect their results."""
+
+    def __init__(self, arguments, work_dir):
+        """Initialize the object."""
+        self.arguments = arguments
+        self.work_dir = work_dir
+        self.image_size = parse_size(arguments.image_size)
+        self.image_file = os.path.join(work_dir, 'image.img')
+        self.results = []
+
+    def is_selected(self, name):
+        """Return whether a benchmark was asked for."""
+        return not self.arguments.only or any(
+            name.startswith(prefix) for prefix in self.arguments.only)
+
+    def measure(self, name, function, size=None, setup=None):
+        """Time a function repeatedly and record the result.
+
+        setup, if given, is called untimed before each run. size is the
+        number of bytes processed by a run, for throughput. The value
+        returned by the last run, a dictionary, is added to the result.
+
+        """
+        if not self.is_selected(name):
+            return
+
+        runs = []
+        extra = {}
+        for _ in range(self.arguments.repeat):
+            if setup:
+                setup()
+
+            started = time.perf_counter()
+            extra = function() or {}
+            runs.append(time.perf_counter() - started)
+
+        result = {
+            'name': name,
+            'runs': runs,
+            'seconds': statistics.median(runs),
+        }
+        if size:
+            result['bytes'] = size
+            result['throughput_bytes_per_second'] = \
+                size / result['seconds'] if result['seconds'] else None
+
+        result.update(extra)
+        logger.info('%s: %.3f s', name, result['seconds'])
+        self.results.append(result)
+
+    def skip(self, name, reason):
+        """Record that a benchmark could not run."""
+        if self.is_selected(name):
+            logger.info('%s: skipped, %s', name, reason)
+            self.results.append({'name': name, 'skipped': reason})
+
+    def run(self):
+        """Run all benchmarks and return their results."""
+        logger.info('Writing image of %s with density %s',
+                    self.arguments.image_size, self.arguments.density)
+        self.measure('image_write', self.write_image, size=self.image_size)
+        if not os.path.exists(self.image_file):
+            self.write_image()
+
+        self.bench_scheduler()
+        self.bench_builds()
+        self.bench_previous_build_lookup()
+        self.bench_codecs()
+        self.bench_checksum()
+        self.bench_copies()
+        self.bench_conversions()
+        return self.get_report()
+
+    def get_report(self):
+        """Return results with a description of the host and parameters."""
+        return {
+            'freedom_maker_version': freedommaker.__version__,
+            'python': platform.python_version(),
+            'kernel': platform.release(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'image_size': self.image_size,
+            'density': self.arguments.density,
+            'repeat': self.arguments.repeat,
+            'results': self.results,
+        }
+
+    def write_image(self):
+        """Write the synthetic image the data path is benchmarked with."""
+        return {
+            'data_bytes': write_sparse_image(
+                self.image_file, self.image_size, self.arguments.density)
+        }
+
+    def bench_scheduler(self):
+        """Time running stages that do nothing through the pipeline."""
+        targets = ['target{}'.format(number)
+                   for number in range(SCHEDULER_TARGETS)]
+        stages = len(targets) * len(SCHEDULER_STAGES)
+
+        def run():
+            started = time.perf_counter()
+            Pipeline().run(targets, lambda target: StubStageBuilder())
+            return {
+                'stages': stages,
+                'seconds_per_stage': (time.perf_counter() - started) / stages
+            }
+
+        self.measure('scheduler', run)
+
+    def get_build_arguments(self, build_dir):
+        """Return command line arguments of a build of the targets."""
+        application = Application()
+        application.parse_arguments([
+            '--build-dir', build_dir, '--image-size',
+            self.arguments.image_size, '--build-stamp', 'benchmark'
+        ] + self.arguments.target)
+        return application.arguments
+
+    def create_builder(self, arguments, target):
+        """Return the builder of a target using the stub backend."""
+        builder = ImageBuilder.get_builder_class(target)(arguments)
+        builder.builder_backends['stub'] = StubBuilderBackend(
+            builder, self.arguments.density)
+        builder.builder_backend = 'stub'
+        # Synthetic images have no file system to read packages from
+        builder.get_installed_packages = dict
+        return builder
+
+    def build(self, arguments):
+        """Build the targets through the pipeline."""
+        Pipeline().run(arguments.targets,
+                       lambda target: self.create_builder(arguments, target))
+
+    def bench_builds(self):
+        """Time full builds of the targets, and builds with nothing to do."""
+        build_dir = os.path.join(self.work_dir, 'build')
+        arguments = self.get_build_arguments(build_dir)
+
+        def clean():
+            shutil.rmtree(build_dir, ignore_errors=True)
+            os.makedirs(build_dir)
+
+        size = self.image_size * len(arguments.targets)
+        self.measure('build', lambda: self.build(arguments), size=size,
+                     setup=clean)
+        if self.is_selected('build_skip'):
+            if not self.is_selected('build'):
+                clean()
+                self.build(arguments)
+
+            self.measure('build_skip', lambda: self.build(arguments))
+
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    def bench_previous_build_lookup(self):
+        """Time looking up a reusable build among many earlier builds."""
+        build_dir = os.path.join(self.work_dir, 'lookup')
+        os.makedirs(build_dir, exist_ok=True)
+        arguments = self.get_build_arguments(build_dir)
+        builder = self.create_builder(arguments, arguments.targets[0])
+        manifest = {
+            'target': builder.get_target_name(),
+            'fingerprint': builder.get_fingerprint(),
+            'packages': {
+                'package{}'.format(number): '1.0'
+                for number in range(1000)
+            },
+        }
+        # Only every other earlier build has artifacts left to reuse
+        for number in range(PREVIOUS_BUILDS):
+            build_stamp = 'previous{}'.format(number)
+            base_name = os.path.join(
+                build_dir, builder._get_image_base_name(build_stamp))
+            with open(base_name + '.manifest.json', 'w') as file_handle:
+                json.dump(dict(manifest, build_stamp=build_stamp,
+                               created='{:04d}'.format(number)),
+                          file_handle)
+
+            if number % 2:
+                open(base_name + '.img.xz', 'w').close()
+
+        self.measure('previous_build_lookup', lambda: {
+            'builds': PREVIOUS_BUILDS,
+            'found': bool(builder.find_previous_manifest())
+        })
+        builder.cleanup()
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    def bench_codecs(self):
+        """Time compressing the image with each codec."""
+        output_file = os.path.join(self.work_dir, 'image.compressed')
+        for name, command in CODECS:
+            name = 'compress:' + name
+            if not shutil.which(command[0]):
+                self.skip(name, command[0] + ' is not installed')
+                continue
+
+            def run(command=command):
+                with open(output_file, 'wb') as file_handle:
+                    subprocess.run(command + [self.image_file],
+                                   stdout=file_handle, check=True)
+
+                compressed = os.path.getsize(output_file)
+                return {
+                    'output_bytes': compressed,
+                    'ratio': self.image_size / compressed
+                }
+
+            self.measure(name, run, size=self.image_size)
+
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+    def bench_checksum(self):
+        """Time hashing the image the way artifacts are checksummed."""
+        self.measure('checksum:sha256', lambda: {
+            'sha256': store.get_file_hash(self.image_file)
+        }, size=self.image_size)
+
+    def bench_copies(self):
+        """Time copying the image as variant images are copied."""
+        copy_file = os.path.join(self.work_dir, 'copy.img')
+        copies = [
+            ('copy:sparse', [
+                'cp', '--reflink=auto', '--sparse=always', self.image_file,
+                copy_file
+            ]),
+            ('copy:full', [
+                'dd', 'bs=1M', 'status=none', 'if=' + self.image_file,
+                'of=' + copy_file
+            ]),
+        ]
+        for name, command in copies:
+
+            def run(command=command):
+                subprocess.run(command, check=True)
+                return {'allocated_bytes': get_allocated_size(copy_file)}
+
+            def remove():
+                if os.path.exists(copy_file):
+                    os.remove(copy_file)
+
+            self.measure(name, run, size=self.image_size, setup=remove)
+            remove()
+
+    def bench_conversions(self):
+        """Time converting the image to VM disk formats."""
+        for extension, program, command in CONVERSIONS:
+            name = 'convert:' + extension
+            vm_file = os.path.join(self.work_dir, 'image.' + extension)
+            if not shutil.which(program):
+                self.skip(name, program + ' is not installed')
+                continue
+
+            def run(command=command, vm_file=vm_file):
+                subprocess.run(command + [self.image_file, vm_file],
+                               stdout=subprocess.DEVNULL, check=True)
+                return {'output_bytes': os.path.getsize(vm_file)}
+
+            def remove(vm_file=vm_file):
+                if os.path.exists(vm_file):
+                    os.remove(vm_file)
+
+            self.measure(name, run, size=self.image_size, setup=remove)
+            remove()
+
+
+def parse_arguments(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark freedom-maker with synthetic images',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--image-size', default=IMAGE_SIZE,
+        help='Apparent size of synthetic images')
+    parser.add_argument(
+        '--density', type=float, default=DENSITY,
+        help='Share of an image filled with data, the rest being holes')
+    parser.add_argument(
+        '--repeat', type=int, default=REPEAT,
+        help='Times each benchmark runs, the median time is reported')
+    parser.add_argument(
+        '--target', action='append',
+        help='Target to build in the build benchmarks, may be given '
+        'multiple times. Defaults to ' + ', '.join(TARGETS))
+    parser.add_argument(
+        '--only', action='append', metavar='NAME',
+        help='Run only benchmarks whose name starts with NAME, may be given '
+        'multiple times')
+    parser.add_argument(
+        '--work-dir',
+        help='Directory to write images in, a temporary directory by '
+        'default')
+    parser.add_argument(
+        '--output', help='File to write results to as JSON instead of '
+        'standard output')
+    parser.add_argument('--log-level', default='warning',
+                        help='Log level of messages of builds')
+    arguments = parser.parse_args(argv)
+    arguments.target = arguments.target or TARGETS
+    return arguments
+
+
+def main(argv=None):
+    """Run the benchmarks and write their results."""
+    arguments = parse_arguments(argv)
+    logging.basicConfig(level=arguments.log_level.upper(),
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+
+    with tempfile.TemporaryDirectory(dir=arguments.work_dir) as work_dir:
+        report = Benchmark(arguments, work_dir).run()
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file_handle:
+            json.dump(report, file_handle, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == '__main__':
+    main()
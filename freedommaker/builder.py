@@ -20,12 +20,37 @@
 Worker class to run various command build the image.
 """
 
+import collections
+import datetime
+import glob
+import hashlib
+import json
 import logging
+import lzma
 import os
 import shutil
+import signal
+import sqlite3
 import subprocess
 import tempfile
-
+import threading
+import time
+
+from . import buildlog
+from . import cgroup
+from . import chunks
+from . import cpus
+from . import delta
+from . import history
+from . import image
+from . import loop
+from . import metrics
+from . import mirror
+from . import ramdisk
+from . import packages
+from . import progress
+from . import sampling
+from . import store
 from . import vmdb2
 from . import vmdebootstrap
 
@@ -33,9 +58,20 @@ BASE_PACKAGES = [
     'initramfs-tools',
 ]
 
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+def parse_size(size):
+    """Return the number of bytes in a size such as 3800M."""
+    size = size.strip().upper().rstrip('B').rstrip('I')
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+
+    return int(size)
+
+
 class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
     """Base for all image builders."""
     architecture = None
@@ -49,6 +85,11 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
     boot_offset = None
     kernel_flavor = 'default'
     debootstrap_variant = None
+    # Source packages fetched with apt-get source during customization
+    source_packages = []
+    # Whether an image built in RAM is compressed from there, never being
+    # written to disk uncompressed
+    compress_in_ram = True
 
     @classmethod
     def get_target_name(cls):
@@ -69,12 +110,70 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
             yield subclass
             yield from subclass.get_subclasses()
 
+    @classmethod
+    def get_required_tools(cls, arguments):
+        """Return the host programs needed to build this target."""
+        tools = ['sudo', 'losetup', 'kpartx', 'parted', 'xz']
+        if cls.builder_backend == 'vmdebootstrap':
+            tools.append(arguments.vmdebootstrap)
+
+        file_systems = (cls.root_filesystem_type, cls.boot_filesystem_type)
+        if 'btrfs' in file_systems:
+            tools.append('btrfs')
+
+        if 'vfat' in file_systems:
+            tools.append('mkfs.vfat')
+
+        if arguments.sign:
+            tools.append('gpg')
+
+        if arguments.build_in_ram and arguments.ram_disk == 'zram':
+            tools += ['modprobe', 'mkfs.ext4']
+
+        return tools
+
     def __init__(self, arguments):
         """Initialize object."""
         self.arguments = arguments
-        self.packages = BASE_PACKAGES
+        self.packages = list(BASE_PACKAGES)
 
         self.ram_directory = None
+        self.ram_disk = None
+        self.cpu_allocation = None
+        self.loop_manager = loop.LoopManager()
+        self.cgroup = None
+
+        # Step being executed and usage of its commands for sampling
+        self.current_stage = None
+        self.current_command = None
+        self.running_commands = set()
+        self.finished_usage = {
+            'cpu_seconds': 0,
+            'read_bytes': 0,
+            'write_bytes': 0
+        }
+        self.sampler = None
+
+        # Display of progress lines, set when building from a terminal
+        self.progress = None
+
+        # Whether commands are only being planned, see get_plan()
+        self.planning = False
+
+        # Outcome of the build for metrics
+        self.started = time.time()
+        self.completed = False
+        self.stage_durations = collections.OrderedDict()
+        self.compressions = []
+        self.reused_from = None
+        self.cache_statistics = {'package_index': collections.Counter()}
+        self.history = history.BuildHistory(self.arguments.build_dir)
+        self.history_key = history.get_key(type(self), self.arguments)
+        self.estimate = None
+        self.store = store.ArtifactStore(self.arguments.artifact_store) \
+            if self.arguments.artifact_store else None
+        self.chunk_store = chunks.ChunkStore(self.arguments.chunk_store) \
+            if self.arguments.chunk_store else None
 
         self.builder_backends = {}
         self.builder_backends['vmdebootstrap'] = \
@@ -83,14 +182,31 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
 
         self.image_file = os.path.join(
             self.arguments.build_dir, self._get_image_base_name() + '.img')
-        self.log_file = os.path.join(
-            self.arguments.build_dir, self._get_image_base_name() + '.log')
+        self.archive_file = self.image_file + '.xz'
+        # Where the raw image is, in RAM until compressed if built there
+        self.built_image_file = self.image_file
+        self.variant_images = []
+        self.uncompressed_image = False
+        self.build_log = buildlog.BuildLog(
+            os.path.join(self.arguments.build_dir,
+                         self._get_image_base_name() + '.logs'),
+            self.arguments.failure_lines)
+        self.source_archive = os.path.join(
+            self.arguments.build_dir,
+            self._get_image_base_name() + '-source.tar.gz')
+        self.resources_file = os.path.join(
+            self.arguments.build_dir,
+            self._get_image_base_name() + '.resources.csv')
 
         # Setup logging
         formatter = logging.root.handlers[0].formatter
-        self.log_handler = logging.FileHandler(
-            filename=self.log_file, mode='a')
+        self.log_handler = buildlog.BuildLogHandler(self.build_log)
         self.log_handler.setFormatter(formatter)
+        # Builds of other targets may be logging from other threads, helper
+        # threads of this build are added while they run
+        self.threads = {threading.get_ident()}
+        self.log_handler.addFilter(
+            lambda record: record.thread in self.threads)
         logger.addHandler(self.log_handler)
 
         self.customization_script = os.path.join(
@@ -98,48 +214,783 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
 
     def cleanup(self):
         """Finalize tasks."""
+        if self.build_log.file:
+            self.build_log.start_phase('cleanup')
+
         logger.info('Cleaning up')
-        if self.ram_directory:
-            self._run(['sudo', 'umount', self.ram_directory.name])
-            self.ram_directory.cleanup()
-            self.ram_directory = None
+        if self.arguments.metrics_dir:
+            self.write_metrics()
+
+        self.record_history()
 
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler.write(self.resources_file)
+            self.sampler.log_summary(logger)
+            self.sampler = None
+
+        self.loop_manager.close()
+
+        self.release_ram_disk()
+        self.release_cpus()
+
+        if self.cgroup:
+            usage = self.cgroup.get_usage()
+            logger.info(
+                'Resources used by build - peak memory: %d MiB, I/O read: '
+                '%d MiB, I/O written: %d MiB, CPU time: %d s',
+                usage.get('memory_peak', 0) // 1024**2,
+                usage['io_rbytes'] // 1024**2, usage['io_wbytes'] // 1024**2,
+                usage.get('cpu_seconds', 0))
+            self.cgroup.remove()
+            self.cgroup = None
+
+        if self.progress:
+            self.progress.update(self.get_target_name(), None)
+
+        logger.removeHandler(self.log_handler)
+        self.build_log.close()
+        if self.build_log.failed_phase:
+            logger.error('Last lines of failed phase %s, logs in %s:\n%s',
+                         self.build_log.failed_phase, self.build_log.directory,
+                         '\n'.join(self.build_log.failure_tail))
+
+    def discard(self):
+        """Stop logging for a builder that was never run."""
         logger.removeHandler(self.log_handler)
 
+    def release_ram_disk(self):
+        """Unmount the RAM disk used for building, freeing its memory."""
+        if not self.ram_directory:
+            return
+
+        statistics = self.ram_disk.get_statistics()
+        if statistics:
+            logger.info(
+                'RAM disk usage - data: %d MiB, compressed: %d MiB, '
+                'ratio: %.1f, peak RAM: %d MiB',
+                statistics['original'] // 1024**2,
+                statistics['compressed'] // 1024**2, statistics['ratio'],
+                statistics['peak'] // 1024**2)
+
+        self.ram_disk.unmount()
+        self.ram_disk = None
+        self.ram_directory.cleanup()
+        self.ram_directory = None
+        self.built_image_file = self.image_file
+
     def build(self):
         """Run the image building process."""
-        # Create empty log file owned by process runner
-        open(self.log_file, 'w').close()
+        self.prepare()
+        for stage, function in self.get_stages():
+            self.run_stage(stage, function)
+
+        self.complete()
+
+    def prepare(self):
+        """Get ready for running the build stages."""
+        self.build_log.open('prepare')
+        self.started = time.time()
+        try:
+            self.estimate = self.history.estimate(self.history_key)
+        except sqlite3.Error as exception:
+            logger.warning('Unable to read build history - %s', exception)
+
+        if self.arguments.sample_interval:
+            self.sampler = sampling.ResourceSampler(
+                self, self.arguments.sample_interval)
+            self.sampler.start()
+
+        self.reuse_previous_build()
+
+    def run_stage(self, stage, function):
+        """Run a stage of the build, attributing resources used to it."""
+        self.current_stage = stage
+        started = time.time()
+        if self.estimate:
+            remaining = max(0, self.estimate[None] - (started - self.started))
+            logger.info(
+                'Stage %s usually takes %s, target done in about %s, at %s',
+                stage, history.format_duration(self.estimate.get(stage, 0)),
+                history.format_duration(remaining),
+                time.strftime('%H:%M', time.localtime(started + remaining)))
+
+        self.build_log.start_phase(stage)
+        try:
+            function()
+        except BaseException:
+            self.build_log.fail()
+            raise
+        finally:
+            self.current_stage = None
+            self.stage_durations[stage] = time.time() - started
+
+    def fail(self):
+        """Record that the build failed, also if outside of a stage."""
+        self.build_log.fail()
+
+    def cancel(self):
+        """Stop the commands of the build, failing the running stage.
+
+        Called from another thread when the build is interrupted.
+
+        """
+        for pid in list(self.running_commands):
+            logger.info('Stopping command - %s', pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    def complete(self):
+        """Record that all stages of the build have run."""
+        self.completed = True
+        if self.store:
+            self.publish_artifacts()
+
+    def publish_artifacts(self):
+        """Add the files built to the artifact store.
+
+        Files become links to the stored files. Archives are not hashed
+        again if their checksum file is up-to-date.
+
+        """
+        base_name = self._get_image_base_name()
+        fingerprint = self.get_fingerprint()
+        try:
+            if self.arguments.pin:
+                self.store.pin(self.arguments.build_stamp)
+
+            for suffix in self._get_artifact_suffixes(base_name):
+                file_name = os.path.join(self.arguments.build_dir,
+                                         base_name + suffix)
+                self.store.publish(file_name, self.get_target_name(),
+                                   self.arguments.build_stamp, fingerprint,
+                                   self.read_checksum(file_name))
+        except (OSError, sqlite3.Error,
+                subprocess.CalledProcessError) as exception:
+            logger.warning('Unable to add artifacts to store - %s',
+                           exception)
+
+    def get_plan(self):
+        """Return what the build would do, without doing it.
+
+        Whether an earlier build would be reused is decided from cached
+        package indexes only. For every stage, a plan_ method named after the
+        stage's function returns the reason for what it does and the steps
+        it takes, with the commands they run. No command is run and nothing
+        is created. Values only known while building are shown as
+        placeholders: {cpus}, {ram_disk}, {mount} and {checkpoint}.
+
+        """
+        self.planning = True
+        try:
+            previous, reason = self.find_reusable_build(offline=True)
+            stages = []
+            for stage, function in self.get_stages():
+                if previous:
+                    plan = {
+                        'reason': 'artifacts reused from build ' +
+                        previous['build_stamp'],
+                        'steps': []
+                    }
+                else:
+                    plan = getattr(self, 'plan_' + function.__name__)()
+
+                plan['stage'] = stage
+                stages.append(plan)
+
+            return {
+                'reused_from': previous and previous['build_stamp'],
+                'reuse_reason': reason,
+                'stages': stages,
+            }
+        finally:
+            self.planning = False
+
+    def is_planned_up_to_date(self, target, dependencies=None):
+        """Return whether a step would be skipped once earlier steps ran.
+
+        Dependencies that do not exist yet are built by earlier steps, so
+        they are newer than the target.
+
+        """
+        if not all(os.path.isfile(dependency)
+                   for dependency in dependencies or []):
+            return False
+
+        return self.should_skip_step(target, dependencies)
 
-        archive_file = self.image_file + '.xz'
-        if not self.should_skip_step(archive_file):
+    def plan_make_images(self):
+        """Return the plan for building the image and its variants."""
+        if self.should_skip_step(self.archive_file):
+            plan = {'reason': 'compressed image exists', 'steps': []}
+        else:
+            plan = self.plan_make_image()
+
+        plan['steps'] += self.plan_variants()
+        return plan
+
+    def plan_make_image(self):
+        """Return the plan for creating the basic image."""
+        plan = self.builder_backends[self.builder_backend].plan_image()
+        if not self.is_planned_up_to_date(
+                self.get_manifest_file(self.image_file), [self.image_file]):
+            plan['steps'].append({
+                'description': 'Write manifest with packages installed in '
+                'image',
+                'command': None
+            })
+
+        return plan
+
+    def plan_variants(self):
+        """Return the steps building images of variants."""
+        steps = []
+        for variant in self.arguments.variant or []:
+            variant_image = variant.get_image_file(self.image_file)
+            if self.should_skip_step(variant_image + '.xz'):
+                continue
+
+            if not steps and not os.path.isfile(self.image_file) and \
+               self.should_skip_step(self.archive_file):
+                steps.append({
+                    'description': 'Uncompress image',
+                    'command': ['unxz', '--keep', self.archive_file]
+                })
+
+            steps.append({
+                'description': 'Copy image for variant ' + variant.name,
+                'command': self.get_variant_copy_command(variant_image)
+            })
+            steps += self.builder_backends[
+                self.builder_backend].plan_image_variant(
+                    variant, variant_image)
+
+        return steps
+
+    def plan_compress_images(self):
+        """Return the plan for compressing the image and its variants."""
+        steps = []
+        # An image built in RAM by this build is compressed from there
+        in_ram = self.arguments.build_in_ram and self.compress_in_ram and \
+            not self.should_skip_step(self.image_file)
+        if in_ram and not self.should_skip_step(self.archive_file):
+            steps += self.plan_compress(self.archive_file,
+                                        self.get_temp_image_file(),
+                                        'image from RAM while hashing it')
+        elif not self.should_skip_step(self.archive_file):
+            steps += self.plan_compress(self.archive_file, self.image_file,
+                                        'image')
+
+        for variant in self.arguments.variant or []:
+            variant_image = variant.get_image_file(self.image_file)
+            if not self.should_skip_step(variant_image + '.xz'):
+                steps += self.plan_compress(variant_image + '.xz',
+                                            variant_image,
+                                            'image of variant ' +
+                                            variant.name)
+
+        return {
+            'reason': 'compressed images exist' if not steps else
+            'compressed images missing or older than images',
+            'steps': steps
+        }
+
+    def plan_compress(self, archive_file, image_file, description):
+        """Return the steps compressing an image into an archive."""
+        if not self.arguments.delta_block_size:
+            return [{
+                'description': 'Compress ' + description,
+                'command': self.get_compressor() + ['--force', image_file]
+            }]
+
+        return [{
+            'description': 'Compress ' + description + ' in blocks fed by '
+            'Freedom Maker from ' + image_file,
+            'command': self.get_compressor() + ['--stdout']
+        }, {
+            'description': 'Write delta index of ' +
+            os.path.basename(archive_file),
+            'command': ['xz', '--robot', '--list', '-vv', archive_file]
+        }]
+
+    def plan_sign_archives(self):
+        """Return the plan for writing checksums and signatures."""
+        steps = []
+        for archive in self.get_archive_files():
+            if not self.is_planned_up_to_date(archive + '.sha256',
+                                              [archive]):
+                steps.append({
+                    'description': 'Write checksum of ' +
+                    os.path.basename(archive),
+                    'command': None
+                })
+
+            if self.arguments.sign and \
+               not self.is_planned_up_to_date(archive + '.sig', [archive]):
+                steps.append({
+                    'description': 'Sign ' + os.path.basename(archive),
+                    'command': self.get_sign_command(archive)
+                })
+
+        return {
+            'reason': 'checksums and signatures up-to-date' if not steps
+            else 'checksums or signatures missing or outdated',
+            'steps': steps
+        }
+
+    def get_artifact_sizes(self):
+        """Return sizes of the files built keyed by their suffix.
+
+        Uncompressed files are gone, their sizes are those recorded when
+        compressing them.
+
+        """
+        base_name = self._get_image_base_name()
+        sizes = {}
+        for suffix in self._get_artifact_suffixes(base_name):
+            sizes[suffix] = os.path.getsize(
+                os.path.join(self.arguments.build_dir, base_name + suffix))
+
+        for compression in self.compressions:
+            artifact = os.path.basename(compression['file'])[len(base_name):]
+            sizes[artifact] = compression['size']
+
+        return sizes
+
+    def record_history(self):
+        """Add the build to the build history."""
+        try:
+            self.history.record(self.history_key, self.arguments.build_stamp,
+                                self.started, time.time(), self.completed,
+                                bool(self.reused_from), self.stage_durations,
+                                self.get_artifact_sizes())
+        except (sqlite3.Error, OSError) as exception:
+            logger.warning('Unable to record build history - %s', exception)
+
+    def write_metrics(self):
+        """Write metrics of the build for Prometheus node exporter."""
+        os.makedirs(self.arguments.metrics_dir, exist_ok=True)
+        file_name = os.path.join(
+            self.arguments.metrics_dir,
+            'freedom-maker-{}.prom'.format(self.get_target_name()))
+        try:
+            metrics.write_textfile(file_name, metrics.get_build_samples(
+                self, self.completed, time.time()))
+        except OSError as exception:
+            logger.warning('Unable to write metrics - %s', exception)
+
+    def get_stages(self):
+        """Return the names and functions of all stages of the build.
+
+        Stages run one after the other. Stages of different targets may run
+        at the same time.
+
+        """
+        stages = self.get_build_stages()
+        if self.chunk_store:
+            stages.append(('chunk', self.store_chunks))
+
+        return stages
+
+    def get_build_stages(self):
+        """Return the names and functions of stages to build the target."""
+        return [
+            ('make_image', self.make_images),
+            ('compress', self.compress_images),
+            ('sign', self.sign_archives),
+        ]
+
+    def make_images(self):
+        """Build the image and the images of its variants."""
+        if not self.should_skip_step(self.archive_file):
             self.make_image()
-            self.compress(archive_file, self.image_file)
         else:
             logger.info('Compressed image exists, skipping')
 
-        self.sign(archive_file)
+        self.build_variants()
+
+    def compress_images(self):
+        """Compress the image and the images of its variants."""
+        if self.built_image_file != self.image_file:
+            self.compress_from_ram(self.archive_file)
+        elif not self.should_skip_step(self.archive_file):
+            self.compress(self.archive_file, self.image_file)
+
+        self.compress_variants()
+
+    def get_archive_files(self):
+        """Return the compressed files built for the target."""
+        return [self.archive_file] + [
+            variant.get_image_file(self.image_file) + '.xz'
+            for variant in self.arguments.variant or []
+        ]
+
+    def sign_archives(self):
+        """Write checksums and signatures of all the compressed files."""
+        for archive in self.get_archive_files():
+            self.write_checksum(archive)
+            self.sign(archive)
 
     def make_image(self):
         """Call a builder backend to create basic image."""
-        self.builder_backends[self.builder_backend].make_image()
+        try:
+            self.builder_backends[self.builder_backend].make_image()
+        finally:
+            # Only the builder backend runs emulated programs
+            self.release_cpus()
+
+        manifest_file = self.get_manifest_file(self.image_file)
+        if not self.should_skip_step(manifest_file,
+                                     [self.built_image_file]):
+            self.write_manifest(packages=self.get_installed_packages())
+
+    def get_installed_packages(self):
+        """Return a map of packages installed in the image to versions."""
+        try:
+            with image.ImageMount(self, self.built_image_file,
+                                  read_only=True) as mount:
+                return mount.get_installed_packages()
+        except (subprocess.CalledProcessError, ValueError) as exception:
+            logger.warning('Unable to read packages installed in image - %s',
+                           exception)
+            return {}
+
+    def reuse_previous_build(self):
+        """Reuse artifacts of an earlier build if nothing would change.
+
+        A previous build of the target with the same fingerprint is looked up
+        in the build directory. If every package needed by the target is
+        installed in it and still has the same version in the build mirror,
+        its artifacts are hard linked
+        under the current build stamp so that the rest of the build finds
+        them up-to-date. Return True if artifacts have been reused.
+
+        """
+        previous, _ = self.find_reusable_build()
+        if not previous:
+            return False
+
+        base_name = self._get_image_base_name()
+        previous_base_name = self._get_image_base_name(
+            previous['build_stamp'])
+        for suffix in self._get_artifact_suffixes(previous_base_name):
+            source = os.path.join(self.arguments.build_dir,
+                                  previous_base_name + suffix)
+            destination = os.path.join(self.arguments.build_dir,
+                                       base_name + suffix)
+            logger.info('Reusing %s as %s', source, destination)
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copy2(source, destination)
+
+        logger.info('Packages unchanged since build %s, reusing it',
+                    previous['build_stamp'])
+        self.reused_from = previous['build_stamp']
+        self.write_manifest(packages=previous['packages'],
+                            reused_from=previous['build_stamp'])
+        return True
+
+    def find_reusable_build(self, offline=False):
+        """Return manifest of a reusable earlier build and the reason.
+
+        Manifest is None if no earlier build can be reused. When offline,
+        only cached package indexes are compared.
+
+        """
+        if self.arguments.force:
+            return None, '--force given'
+
+        if self.arguments.variant:
+            return None, 'variants are built'
+
+        if os.path.exists(self.get_manifest_file(self.image_file)):
+            return None, 'build stamp already has a manifest'
+
+        previous = self.find_previous_manifest()
+        if not previous:
+            return None, 'no earlier build with same inputs'
+
+        components = packages.FREE_COMPONENTS if self.free \
+            else packages.NONFREE_COMPONENTS
+        try:
+            index = packages.PackageIndex.load(
+                self.arguments.build_mirror, self.arguments.distribution,
+                self.architecture, components,
+                self.get_cache_directory('indexes'), offline=offline,
+                statistics=self.cache_statistics['package_index'])
+        except (OSError, lzma.LZMAError) as exception:
+            logger.warning('Unable to read package index, not reusing '
+                           'previous build - %s', exception)
+            return None, 'unable to read package index'
+
+        if not index:
+            return None, 'package index is not cached to compare with ' \
+                'build ' + previous['build_stamp']
+
+        # Packages newly needed by the target are changes too
+        names = mirror.get_target_packages(
+            type(self), self.arguments, customization=False) + \
+            index.get_priority_packages(('required', 'important'))
+        changes = index.get_changes(previous['packages'])
+        for name, version in index.get_additions(
+                names, previous['packages']).items():
+            changes[name] = ('(none)', version)
+
+        if changes:
+            logger.info('%d packages changed since build %s, rebuilding',
+                        len(changes), previous['build_stamp'])
+            for package, (old, new) in sorted(changes.items()):
+                logger.info('Package changed: %s %s -> %s', package, old, new)
+
+            return None, '{} packages changed since build {}'.format(
+                len(changes), previous['build_stamp'])
+
+        return previous, 'packages unchanged since build {}'.format(
+            previous['build_stamp'])
+
+    def find_previous_manifest(self):
+        """Return manifest of the latest reusable build of this target."""
+        pattern = os.path.join(
+            self.arguments.build_dir,
+            self._get_image_base_name('*') + '.manifest.json')
+        fingerprint = self.get_fingerprint()
+        manifests = []
+        for manifest_file in glob.glob(pattern):
+            with open(manifest_file, 'r') as file_handle:
+                manifest = json.load(file_handle)
+
+            if manifest.get('fingerprint') == fingerprint and \
+               manifest.get('packages') and \
+               manifest['build_stamp'] != self.arguments.build_stamp and \
+               self._get_artifact_suffixes(
+                   self._get_image_base_name(manifest['build_stamp'])):
+                manifests.append(manifest)
+
+        if not manifests:
+            return None
+
+        return max(manifests, key=lambda manifest: manifest['created'])
+
+    def _get_artifact_suffixes(self, base_name):
+        """Return suffixes of finished artifacts built with a base name."""
+        suffixes = []
+        prefix = os.path.join(self.arguments.build_dir, base_name)
+        for file_name in glob.glob(glob.escape(prefix) + '*'):
+            suffix = file_name[len(prefix):]
+            if (suffix.startswith('.') or suffix.startswith('-source.')) and \
+               not suffix.endswith(('.log', '.logs', '.manifest.json',
+                                    '.temp', '.partial', '.sha256',
+                                    '.resources.csv', chunks.INDEX_SUFFIX,
+                                    delta.INDEX_SUFFIX)):
+                suffixes.append(suffix)
+
+        return suffixes
+
+    def get_fingerprint(self):
+        """Return a hash of all the inputs that go into customizing image.
+
+        An image may only be refreshed from a previous image with the same
+        fingerprint.
+
+        """
+        inputs = {
+            'target': self.get_target_name(),
+            'distribution': self.arguments.distribution,
+            'mirror': self.arguments.mirror,
+            'hostname': self.arguments.hostname,
+            'image_size': self.arguments.image_size,
+            'download_source': self.arguments.download_source,
+            'include_source': self.arguments.include_source,
+            'packages': sorted(BASE_PACKAGES + (self.arguments.package or [])),
+            'custom_packages': [
+                self._get_input_hash(package)
+                for package in self.arguments.custom_package or []
+            ],
+            'scripts': [
+                store.get_file_hash(os.path.join(
+                    os.path.dirname(__file__), script))
+                for script in ('freedombox-customize', 'hardware-setup')
+            ],
+        }
+        inputs = json.dumps(inputs, sort_keys=True).encode()
+        return hashlib.sha256(inputs).hexdigest()
+
+    @staticmethod
+    def get_manifest_file(image_file):
+        """Return the path of the manifest describing an image."""
+        if image_file.endswith('.xz'):
+            image_file = image_file[:-len('.xz')]
+
+        return image_file.rsplit('.', maxsplit=1)[0] + '.manifest.json'
+
+    @classmethod
+    def read_manifest(cls, image_file):
+        """Return the manifest of an image or None if it does not exist."""
+        try:
+            with open(cls.get_manifest_file(image_file), 'r') as file_handle:
+                return json.load(file_handle)
+        except FileNotFoundError:
+            return None
+
+    def write_manifest(self, **extra):
+        """Record the inputs of a freshly built image next to it."""
+        manifest = {
+            'target': self.get_target_name(),
+            'build_stamp': self.arguments.build_stamp,
+            'fingerprint': self.get_fingerprint(),
+            'created': datetime.datetime.now().isoformat(),
+        }
+        manifest.update(extra)
+        with open(self.get_manifest_file(self.image_file), 'w') as \
+                file_handle:
+            json.dump(manifest, file_handle, indent=4, sort_keys=True)
+
+    @staticmethod
+    def _get_input_hash(file_name):
+        """Return the hash of an input file, or its path if it is missing.
+
+        Missing files are reported later by the step using them.
+
+        """
+        try:
+            return store.get_file_hash(file_name)
+        except FileNotFoundError:
+            return 'missing:' + file_name
+
+    def build_variants(self):
+        """Build images of all variants from the base image."""
+        self.variant_images = [
+            (variant, variant.get_image_file(self.image_file))
+            for variant in self.arguments.variant or []
+            if not self.should_skip_step(
+                variant.get_image_file(self.image_file) + '.xz')
+        ]
+        if not self.variant_images:
+            return
+
+        if not os.path.isfile(self.built_image_file):
+            logger.info('Compressed image exists, uncompressing - %s',
+                        self.archive_file)
+            self._run(['unxz', '--keep', self.archive_file])
+            self.uncompressed_image = True
+
+        for variant, variant_image in self.variant_images:
+            self.make_image_variant(variant, variant_image)
+
+    def compress_variants(self):
+        """Compress the images of variants built from the base image."""
+        for _, variant_image in self.variant_images:
+            self.compress(variant_image + '.xz', variant_image)
+
+        self.variant_images = []
+        if self.uncompressed_image:
+            os.remove(self.image_file)
+            self.uncompressed_image = False
 
-    def _get_image_base_name(self):
+    def make_image_variant(self, variant, variant_image):
+        """Create a variant's image by applying its changes to a copy.
+
+        Copy is made with reflinks where the file system supports it, so
+        the variant image only consumes space for its differences.
+
+        """
+        logger.info('Building variant %s - %s', variant.name, variant_image)
+        self._run(self.get_variant_copy_command(variant_image))
+        self.builder_backends[self.builder_backend].make_image_variant(
+            variant, variant_image)
+
+    def get_variant_copy_command(self, variant_image):
+        """Return the command copying the image for a variant."""
+        return [
+            'cp', '--reflink=auto', '--sparse=always', self.built_image_file,
+            variant_image
+        ]
+
+    def _get_image_base_name(self, build_stamp=None):
         """Return the base file name of the final image."""
         free_tag = 'free' if self.free else 'nonfree'
+        build_stamp = build_stamp or self.arguments.build_stamp
 
         return 'freedombox-{distribution}-{free_tag}_{build_stamp}_{machine}' \
             '-{architecture}'.format(
                 distribution=self.arguments.distribution, free_tag=free_tag,
-                build_stamp=self.arguments.build_stamp, machine=self.machine,
+                build_stamp=build_stamp, machine=self.machine,
                 architecture=self.architecture)
 
+    def get_cache_directory(self, name):
+        """Return the absolute path of a cache directory, creating it."""
+        directory = os.path.abspath(
+            os.path.join(self.arguments.cache_dir, name))
+        if not self.planning:
+            os.makedirs(directory, exist_ok=True)
+
+        return directory
+
+    def allocate_cpus(self):
+        """Return CPUs dedicated to this build, allocating them once."""
+        if self.planning:
+            return '{cpus}'
+
+        if not self.cpu_allocation:
+            self.cpu_allocation = cpus.CPUAllocation(
+                self.arguments.emulation_cpus)
+            self.cpu_allocation.acquire()
+            logger.info('Allocated CPUs %s for build',
+                        self.cpu_allocation.get_cpu_list())
+
+        return self.cpu_allocation.get_cpu_list()
+
+    def release_cpus(self):
+        """Let other builds use the CPUs allocated to this build."""
+        if self.cpu_allocation:
+            self.cpu_allocation.release()
+            logger.info('Released CPUs allocated for build')
+            self.cpu_allocation = None
+
+    def get_resource_wrapper(self):
+        """Return a command prefix that runs a command in build's cgroup.
+
+        Group is created on first use. If cgroups can't be used, commands
+        run without limits. When planning, the group is not created.
+
+        """
+        if self.planning:
+            build_cgroup = cgroup.BuildCgroup(
+                '{}-{}'.format(self._get_image_base_name(), os.getpid()),
+                parent=self.arguments.cgroup_parent)
+            return build_cgroup.get_wrapper() if build_cgroup.locate() else []
+
+        if self.cgroup is None:
+            self.cgroup = cgroup.BuildCgroup(
+                '{}-{}'.format(self._get_image_base_name(), os.getpid()),
+                memory_max=self.arguments.memory_limit,
+                cpu_weight=self.arguments.cpu_weight,
+                io_weight=self.arguments.io_weight,
+                parent=self.arguments.cgroup_parent)
+            try:
+                created = self.cgroup.create()
+            except (OSError, subprocess.CalledProcessError) as exception:
+                logger.warning('Unable to create cgroup - %s', exception)
+                created = False
+
+            if not created:
+                logger.warning('No delegated cgroup, build resources are '
+                               'not limited or accounted')
+                self.cgroup = False
+
+        return self.cgroup.get_wrapper() if self.cgroup else []
+
     def get_temp_image_file(self):
         """Get the temporary path to where the image should be built.
 
         If building to RAM is enabled, create a temporary directory, mount
         tmpfs in it and return a path in that directory. This is so that builds
-        that happen in RAM will be faster.
+        that happen in RAM will be faster. tmpfs is limited to a little more
+        than the size of the image. With zram, a compressed RAM device is used
+        instead of tmpfs.
 
         If building to RAM is disabled, append .temp to the final file name and
         return it.
@@ -148,9 +999,15 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
         if not self.arguments.build_in_ram:
             return self.image_file + '.temp'
 
+        if self.planning:
+            return os.path.join('{ram_disk}',
+                                os.path.basename(self.image_file))
+
         self.ram_directory = tempfile.TemporaryDirectory()
-        self._run(
-            ['sudo', 'mount', '-t', 'tmpfs', 'tmpfs', self.ram_directory.name])
+        ram_disk_class = ramdisk.get_ram_disk_class(self.arguments.ram_disk)
+        self.ram_disk = ram_disk_class(self,
+                                       parse_size(self.arguments.image_size))
+        self.ram_disk.mount(self.ram_directory.name)
         return os.path.join(self.ram_directory.name,
                             os.path.basename(self.image_file))
 
@@ -161,11 +1018,181 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
                         archive_file)
             return
 
-        command = ['xz', '--no-warn', '--best', '--force']
+        size = os.path.getsize(image_file)
+        started = time.time()
+        if self.arguments.delta_block_size:
+            checksum = self.compress_to_file(image_file, archive_file)
+            os.remove(image_file)
+            self.write_checksum(archive_file, checksum)
+        else:
+            self._run(self.get_compressor() + ['--force', image_file])
+
+        self.record_compression(image_file, size, started)
+
+    def get_compressor(self):
+        """Return the command compressing files, parallel if possible."""
+        if self.arguments.delta_block_size:
+            return delta.get_compressor(self.arguments.delta_block_size)
+
         if shutil.which('pxz'):
-            command = ['pxz', '-9', '--force']
+            return ['pxz', '-9']
+
+        return ['xz', '--no-warn', '--best']
+
+    def record_compression(self, image_file, size, started):
+        """Record size and time taken to compress a file for metrics."""
+        self.compressions.append({
+            'file': image_file,
+            'size': size,
+            'seconds': time.time() - started,
+        })
+
+    def compress_from_ram(self, archive_file):
+        """Compress the image built in RAM straight into the build directory.
 
-        self._run(command + [image_file])
+        The archive is hashed as it is written, so only the archive and its
+        checksum are written to disk. The RAM disk is released right after.
+
+        """
+        size = os.path.getsize(self.built_image_file)
+        started = time.time()
+        checksum = self.compress_to_file(self.built_image_file, archive_file)
+        self.record_compression(self.built_image_file, size, started)
+        self.write_checksum(archive_file, checksum)
+        self.release_ram_disk()
+
+    def compress_to_file(self, image_file, archive_file):
+        """Compress an image into an archive and return its sha256 hash.
+
+        The archive is hashed as it is written. With --delta-block-size, the
+        image is fed to the compressor block by block, hashing each block in
+        the same pass, and the delta index is written next to the archive.
+
+        """
+        block_size = self.arguments.delta_block_size
+        command = self.get_compressor() + ['--stdout']
+        if not block_size:
+            command.append(image_file)
+
+        block_hashes = []
+        partial_file = archive_file + '.partial'
+        file_hash = hashlib.sha256()
+        logger.info('Executing command - %s', command)
+        with open(partial_file, 'wb') as file_handle:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE if block_size else subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=self.build_log.file)
+            self.current_command = command[0]
+            self.show_progress(self.current_command)
+            self.running_commands.add(process.pid)
+            feeder = None
+            if block_size:
+                feeder = threading.Thread(
+                    target=delta.feed,
+                    args=(image_file, process.stdin, block_size,
+                          block_hashes))
+                feeder.start()
+                self.threads.add(feeder.ident)
+
+            try:
+                for chunk in iter(lambda: process.stdout.read(1024 * 1024),
+                                  b''):
+                    file_hash.update(chunk)
+                    file_handle.write(chunk)
+            finally:
+                process.stdout.close()
+                if feeder:
+                    feeder.join()
+                    self.threads.discard(feeder.ident)
+
+                process.wait()
+                self.running_commands.discard(process.pid)
+                self.current_command = None
+
+            if process.returncode:
+                os.remove(partial_file)
+                raise subprocess.CalledProcessError(process.returncode,
+                                                    command)
+
+        if block_size:
+            listing = self._run_output(
+                ['xz', '--robot', '--list', '-vv', partial_file])
+            delta.write_index(
+                delta.get_index(archive_file, listing, block_size,
+                                block_hashes), archive_file)
+
+        os.rename(partial_file, archive_file)
+        return file_hash.hexdigest()
+
+    def write_checksum(self, archive, checksum=None):
+        """Write the sha256 checksum of an archive in sha256sum format."""
+        checksum_file = archive + '.sha256'
+        if self.should_skip_step(checksum_file, [archive]):
+            logger.info('Checksum file up-to-date, skipping - %s',
+                        checksum_file)
+            return
+
+        checksum = checksum or store.get_file_hash(archive)
+        with open(checksum_file, 'w') as file_handle:
+            file_handle.write('{}  {}\n'.format(checksum,
+                                                 os.path.basename(archive)))
+
+    def store_chunks(self):
+        """Add the images built to the chunk store.
+
+        With --drop-chunked-images, images are removed from the build
+        directory once the index next to them is written.
+
+        """
+        base_name = self._get_image_base_name()
+        fingerprint = self.get_fingerprint()
+        for suffix in self._get_artifact_suffixes(base_name):
+            file_name = os.path.join(self.arguments.build_dir,
+                                     base_name + suffix)
+            if not chunks.is_image(file_name):
+                continue
+
+            try:
+                self.chunk_store.add(file_name,
+                                     target=self.get_target_name(),
+                                     build_stamp=self.arguments.build_stamp,
+                                     fingerprint=fingerprint)
+            except (OSError, lzma.LZMAError) as exception:
+                logger.warning('Unable to add image to chunk store - %s',
+                               exception)
+                continue
+
+            if self.arguments.drop_chunked_images:
+                logger.info('Removing image kept in chunk store - %s',
+                            file_name)
+                os.remove(file_name)
+
+    def plan_store_chunks(self):
+        """Return the plan for adding the images to the chunk store."""
+        steps = [{'description': 'Add images to chunk store', 'command': None}]
+        if self.arguments.drop_chunked_images:
+            steps.append({
+                'description': 'Remove images from build directory',
+                'command': None
+            })
+
+        return {'reason': 'images are kept in chunk store', 'steps': steps}
+
+    @staticmethod
+    def read_checksum(archive):
+        """Return the checksum of an archive if its checksum file is newer.
+
+        """
+        checksum_file = archive + '.sha256'
+        try:
+            if os.path.getmtime(checksum_file) < os.path.getmtime(archive):
+                return None
+
+            with open(checksum_file, 'r') as file_handle:
+                return file_handle.read().split()[0]
+        except (OSError, IndexError):
+            return None
 
     def sign(self, archive):
         """Signed the final output image."""
@@ -183,7 +1210,12 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
         except FileNotFoundError:
             pass
 
-        self._run(['gpg', '--output', signature, '--detach-sig', archive])
+        self._run(self.get_sign_command(archive))
+
+    @staticmethod
+    def get_sign_command(archive):
+        """Return the command writing a detached signature of a file."""
+        return ['gpg', '--output', archive + '.sig', '--detach-sig', archive]
 
     def should_skip_step(self, target, dependencies=None):
         """Check whether a given build step may be skipped."""
@@ -207,12 +1239,71 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
         """Replace a file's extension with a new extention."""
         return file_name.rsplit('.', maxsplit=1)[0] + new_extension
 
+    def show_progress(self, status):
+        """Show the progress of the target if building from a terminal."""
+        if self.progress:
+            self.progress.update(
+                self.get_target_name(),
+                '[{}] {}'.format(self.current_stage or 'prepare', status))
+
     def _run(self, *args, **kwargs):
-        """Execute a program and log output to log file."""
+        """Execute a program and log output to log file.
+
+        Output is followed to show the progress of the program. Sections of
+        the build it announces are logged as phases of their own. Resources
+        used by the program are added to the usage of the build.
+
+        """
         logger.info('Executing command - %s', args)
-        with open(self.log_file, 'a') as file_handle:
-            subprocess.check_call(*args, stdout=file_handle,
-                                  stderr=file_handle, **kwargs)
+        command = args[0]
+        parser = progress.ProgressParser()
+        phase = self.build_log.phase and self.build_log.phase['phase']
+        process = subprocess.Popen(*args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, **kwargs)
+        self.current_command = sampling.get_command_name(command)
+        self.running_commands.add(process.pid)
+        self.show_progress(self.current_command)
+        try:
+            for line in process.stdout:
+                section = parser.section
+                if parser.feed(line.decode(errors='replace')):
+                    if parser.section != section and phase:
+                        self.build_log.start_phase(phase + ' ' +
+                                                   parser.section)
+
+                    logger.info('Progress - %s', parser.get_name())
+
+                self.build_log.write(line)
+                if self.progress:
+                    self.show_progress(parser.get_status() or
+                                       self.current_command)
+
+            _, status, usage = os.wait4(process.pid, 0)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            process.stdout.close()
+            self.running_commands.discard(process.pid)
+            self.current_command = None
+
+        process.returncode = -os.WTERMSIG(status) \
+            if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        self.finished_usage['cpu_seconds'] += usage.ru_utime + usage.ru_stime
+        self.finished_usage['read_bytes'] += usage.ru_inblock * 512
+        self.finished_usage['write_bytes'] += usage.ru_oublock * 512
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+        if parser.section and phase:
+            self.build_log.start_phase(phase)
+
+    def _run_output(self, *args, **kwargs):
+        """Execute a program, log errors to log file and return output."""
+        logger.info('Executing command - %s', args)
+        return subprocess.check_output(*args, stderr=self.build_log.file,
+                                       **kwargs).decode()
 
 
 class AMDIntelImageBuilder(ImageBuilder):
@@ -239,60 +1330,145 @@ class I386ImageBuilder(AMDIntelImageBuilder):
 class VMImageBuilder(AMDIntelImageBuilder):
     """Base image builder for all virtual machine targets."""
     vm_image_extension = None
+    compress_in_ram = False
 
-    def build(self):
-        """Run the image building process."""
-        archive_file = self.image_file + '.xz'
-        vm_file = self._replace_extension(
-            self.image_file, self.vm_image_extension)
-        vm_archive_file = vm_file + '.xz'
-
-        # Create empty log file owned by process runner
-        open(self.log_file, 'w').close()
-
-        if not self.should_skip_step(vm_archive_file):
-            if not self.should_skip_step(self.image_file):
-                if self.should_skip_step(archive_file):
-                    logger.info('Compressed image exists, uncompressing - %s',
-                                archive_file)
-                    self._run(['unxz', '--keep', archive_file])
-                else:
-                    self.make_image()
-            else:
-                logger.info('Pre-built image exists, skipping build - %s',
-                            self.image_file)
-
-            self.create_vm_file(self.image_file, vm_file)
-            os.remove(self.image_file)
-            self.compress(vm_archive_file, vm_file)
-        else:
+    def __init__(self, arguments):
+        """Initialize object."""
+        super().__init__(arguments)
+        self.vm_file = self._replace_extension(self.image_file,
+                                               self.vm_image_extension)
+        self.vm_archive_file = self.vm_file + '.xz'
+
+    def prepare(self):
+        """Get ready for running the build stages."""
+        super().prepare()
+        self._warn_unsupported_variants()
+
+    def get_build_stages(self):
+        """Return the names and functions of stages to build the target."""
+        if self.should_skip_step(self.vm_archive_file):
             logger.info('Compressed VM image exists, skipping - %s',
-                        vm_archive_file)
+                        self.vm_archive_file)
+            return [('sign', self.sign_archives)]
+
+        return [
+            ('make_image', self.make_raw_image),
+            ('convert', self.convert_image),
+            ('compress', self.compress_vm_file),
+            ('sign', self.sign_archives),
+        ]
+
+    def make_raw_image(self):
+        """Build the raw image or uncompress an earlier one."""
+        if self.should_skip_step(self.image_file):
+            logger.info('Pre-built image exists, skipping build - %s',
+                        self.image_file)
+        elif self.should_skip_step(self.archive_file):
+            logger.info('Compressed image exists, uncompressing - %s',
+                        self.archive_file)
+            self._run(['unxz', '--keep', self.archive_file])
+        else:
+            self.make_image()
+
+    def plan_make_raw_image(self):
+        """Return the plan for building the raw image."""
+        if self.should_skip_step(self.image_file):
+            return {'reason': 'pre-built image exists', 'steps': []}
+
+        if self.should_skip_step(self.archive_file):
+            return {
+                'reason': 'compressed image exists',
+                'steps': [{
+                    'description': 'Uncompress image',
+                    'command': ['unxz', '--keep', self.archive_file]
+                }]
+            }
+
+        return self.plan_make_image()
 
-        self.sign(vm_archive_file)
+    def convert_image(self):
+        """Convert the raw image to a VM image.
+
+        The raw image is removed to free its space, also if it was pre-built.
+
+        """
+        self.create_vm_file(self.image_file, self.vm_file)
+        os.remove(self.image_file)
+
+    def plan_convert_image(self):
+        """Return the plan for converting the raw image."""
+        steps = []
+        if not self.is_planned_up_to_date(self.vm_file, [self.image_file]):
+            steps.append({
+                'description': 'Convert image to VM image',
+                'command': self.get_convert_command(self.image_file,
+                                                    self.vm_file)
+            })
+
+        steps.append({'description': 'Remove raw image', 'command': None})
+        return {
+            'reason': 'VM image up-to-date' if len(steps) == 1 else
+            'VM image missing or older than raw image',
+            'steps': steps
+        }
+
+    def compress_vm_file(self):
+        """Compress the VM image."""
+        self.compress(self.vm_archive_file, self.vm_file)
+
+    def plan_compress_vm_file(self):
+        """Return the plan for compressing the VM image."""
+        if self.is_planned_up_to_date(self.vm_archive_file, [self.vm_file]):
+            return {'reason': 'compressed VM image up-to-date', 'steps': []}
+
+        return {
+            'reason': 'compressed VM image missing or older than VM image',
+            'steps': self.plan_compress(self.vm_archive_file, self.vm_file,
+                                        'VM image')
+        }
+
+    def get_archive_files(self):
+        """Return the compressed files built for the target."""
+        return [self.vm_archive_file]
 
     def create_vm_file(self, image_file, vm_file):
         """Create a VM image from image file."""
+        if self.should_skip_step(vm_file, [image_file]):
+            logger.info('VM file exists, skipping conversion - %s', vm_file)
+            return
+
+        self._run(self.get_convert_command(image_file, vm_file))
+
+    def get_convert_command(self, image_file, vm_file):
+        """Return the command converting an image file to a VM image."""
         raise Exception('Not reached')
 
+    def _warn_unsupported_variants(self):
+        """Warn that variants are only built for disk image targets."""
+        if self.arguments.variant:
+            logger.warning('Variants are not supported for VM targets, '
+                           'ignoring')
+
 
 class VirtualBoxImageBuilder(VMImageBuilder):
     """Base image builder for all VirutalBox targets."""
     vm_image_extension = '.vdi'
 
+    @classmethod
+    def get_required_tools(cls, arguments):
+        """Return the host programs needed to build this target."""
+        return super().get_required_tools(arguments) + ['VBoxManage']
+
     @classmethod
     def get_target_name(cls):
         """Return the name of the target for an image builder."""
         if getattr(cls, 'architecture', None):
             return 'virtualbox-' + cls.architecture
 
-    def create_vm_file(self, image_file, vm_file):
-        """Create a VM file from image file."""
-        if self.should_skip_step(vm_file, [image_file]):
-            logger.info('VM file exists, skipping conversion - %s', vm_file)
-            return
-
-        self._run(['VBoxManage', 'convertdd', image_file, vm_file])
+    @staticmethod
+    def get_convert_command(image_file, vm_file):
+        """Return the command converting an image file to a VM image."""
+        return ['VBoxManage', 'convertdd', image_file, vm_file]
 
 
 class VirtualBoxAmd64ImageBuilder(VirtualBoxImageBuilder):
@@ -315,79 +1491,117 @@ class VagrantImageBuilder(VirtualBoxAmd64ImageBuilder):
         """Return the name of the target for an image builder."""
         return 'vagrant'
 
-    def build(self):
-        """Run the image building process."""
-        archive_file = self.image_file + '.xz'
-        vm_file = self._replace_extension(
-            self.image_file, self.vm_image_extension)
-        vm_archive_file = vm_file + '.xz'
-        vagrant_file = self._replace_extension(
-            self.image_file, self.vagrant_extension)
+    @classmethod
+    def get_required_tools(cls, arguments):
+        """Return the host programs needed to build this target."""
+        return super().get_required_tools(arguments) + ['vagrant', 'sshpass']
 
-        # Create empty log file owned by process runner
-        open(self.log_file, 'w').close()
+    def __init__(self, arguments):
+        """Initialize object."""
+        super().__init__(arguments)
+        self.vagrant_file = self._replace_extension(self.image_file,
+                                                    self.vagrant_extension)
 
-        if self.should_skip_step(vagrant_file):
+    def get_build_stages(self):
+        """Return the names and functions of stages to build the target."""
+        if self.should_skip_step(self.vagrant_file):
             logger.info('Vagrant package exists, skipping - %s',
-                        vagrant_file)
-            return
+                        self.vagrant_file)
+            return []
 
-        if self.should_skip_step(vm_file):
-            logger.info('VM image exists, skipping - %s', vm_archive_file)
-            self.vagrant_package(vm_file, vagrant_file)
-            return
+        if self.should_skip_step(self.vm_file):
+            logger.info('VM image exists, skipping - %s', self.vm_file)
+            return [('package', self.vagrant_package)]
 
-        if self.should_skip_step(vm_archive_file):
+        if self.should_skip_step(self.vm_archive_file):
             logger.info('Compressed VM image exists, skipping - %s',
-                        vm_archive_file)
-            self._run(['unxz', '--keep', vm_archive_file])
-            self.vagrant_package(vm_file, vagrant_file)
-            return
+                        self.vm_archive_file)
+            return [('convert', self.uncompress_vm_file),
+                    ('package', self.vagrant_package)]
 
         if self.should_skip_step(self.image_file):
-            logger.info(
-                'Pre-built image exists, skipping build - %s', self.image_file)
-            self.create_vm_file(self.image_file, vm_file)
-            self.vagrant_package(vm_file, vagrant_file)
-            return
-
-        if self.should_skip_step(archive_file):
-            logger.info(
-                'Compressed image exists, uncompressing - %s', archive_file)
-            self._run(['unxz', '--keep', archive_file])
-            self.create_vm_file(self.image_file, vm_file)
-            os.remove(self.image_file)
-            self.vagrant_package(vm_file, vagrant_file)
-            return
-
-        self.make_image()
-        self.create_vm_file(self.image_file, vm_file)
-        os.remove(self.image_file)
-        self.vagrant_package(vm_file, vagrant_file)
-
-    def vagrant_package(self, vm_file, vagrant_file):
+            logger.info('Pre-built image exists, skipping build - %s',
+                        self.image_file)
+            return [('convert', self.convert_prebuilt_image),
+                    ('package', self.vagrant_package)]
+
+        return [
+            ('make_image', self.make_raw_image),
+            ('convert', self.convert_image),
+            ('package', self.vagrant_package),
+        ]
+
+    def convert_prebuilt_image(self):
+        """Convert the pre-built raw image to a VM image, keeping it."""
+        self.create_vm_file(self.image_file, self.vm_file)
+
+    def plan_convert_prebuilt_image(self):
+        """Return the plan for converting the pre-built raw image."""
+        return {
+            'reason': 'pre-built image exists',
+            'steps': [{
+                'description': 'Convert image to VM image',
+                'command': self.get_convert_command(self.image_file,
+                                                    self.vm_file)
+            }]
+        }
+
+    def uncompress_vm_file(self):
+        """Uncompress an earlier VM image."""
+        self._run(['unxz', '--keep', self.vm_archive_file])
+
+    def plan_uncompress_vm_file(self):
+        """Return the plan for uncompressing an earlier VM image."""
+        return {
+            'reason': 'compressed VM image exists',
+            'steps': [{
+                'description': 'Uncompress VM image',
+                'command': ['unxz', '--keep', self.vm_archive_file]
+            }]
+        }
+
+    def vagrant_package(self):
         """Create a vagrant package from VM file."""
-        self._run(['sudo', 'bin/vagrant-package', '--output', vagrant_file,
-                   vm_file])
+        self._run(self.get_package_command())
+
+    def plan_vagrant_package(self):
+        """Return the plan for creating the vagrant package."""
+        return {
+            'reason': '--force given' if self.arguments.force else
+            'vagrant package does not exist',
+            'steps': [{
+                'description': 'Create vagrant package',
+                'command': self.get_package_command()
+            }]
+        }
+
+    def get_package_command(self):
+        """Return the command creating a vagrant package from VM file."""
+        return [
+            'sudo', 'bin/vagrant-package', '--output', self.vagrant_file,
+            self.vm_file
+        ]
 
 
 class QemuImageBuilder(VMImageBuilder):
     """Base image builder for all Qemu targets."""
     vm_image_extension = '.qcow2'
 
+    @classmethod
+    def get_required_tools(cls, arguments):
+        """Return the host programs needed to build this target."""
+        return super().get_required_tools(arguments) + ['qemu-img']
+
     @classmethod
     def get_target_name(cls):
         """Return the name of the target for an image builder."""
         if getattr(cls, 'architecture', None):
             return 'qemu-' + cls.architecture
 
-    def create_vm_file(self, image_file, vm_file):
-        """Create a VM image file from image file."""
-        if self.should_skip_step(vm_file, [image_file]):
-            logger.info('VM file exists, skipping conversion - %s', vm_file)
-            return
-
-        self._run(['qemu-img', 'convert', '-O', 'qcow2', image_file, vm_file])
+    @staticmethod
+    def get_convert_command(image_file, vm_file):
+        """Return the command converting an image file to a VM image."""
+        return ['qemu-img', 'convert', '-O', 'qcow2', image_file, vm_file]
 
 
 class QemuAmd64ImageBuilder(QemuImageBuilder):
@@ -412,6 +1626,11 @@ class ARMImageBuilder(ImageBuilder):
         """Return the name of the target for an image builder."""
         return getattr(cls, 'machine', None)
 
+    @classmethod
+    def get_required_tools(cls, arguments):
+        """Return the host programs needed to build this target."""
+        return super().get_required_tools(arguments) + [image.EMULATOR]
+
 
 class BeagleBoneImageBuilder(ARMImageBuilder):
     """Image builder for BeagleBone target."""
@@ -481,6 +1700,12 @@ class RaspberryPiImageBuilder(ARMImageBuilder):
     boot_filesystem_type = 'vfat'
     kernel_flavor = None
 
+    @classmethod
+    def get_required_tools(cls, arguments):
+        """Return the host programs needed to build this target."""
+        # rpi-update is fetched from its git repository on the host
+        return super().get_required_tools(arguments) + ['git']
+
 
 class RaspberryPi2ImageBuilder(ARMImageBuilder):
     """Image builder for Raspberry Pi 2 target."""
@@ -489,6 +1714,7 @@ class RaspberryPi2ImageBuilder(ARMImageBuilder):
     free = False
     boot_offset = '64mib'
     kernel_flavor = 'armmp'
+    source_packages = ['raspi3-firmware']
 
 
 class RaspberryPi3ImageBuilder(ARMImageBuilder):
@@ -498,3 +1724,4 @@ class RaspberryPi3ImageBuilder(ARMImageBuilder):
     free = False
     boot_offset = '64mib'
     kernel_flavor = 'armmp'
+    source_packages = ['raspi3-firmware']
@@ -0,0 +1,193 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Logs of builds split by phase.
+
+Log messages and output of programs run by a build are written to a file for
+each phase of the build, in a directory next to the image. A file is
+compressed with xz when its phase ends. An index lists the phases in order
+with their durations and byte ranges in the whole log, which is all phase
+files decompressed one after the other:
+
+    xzcat freedombox-unstable_2019-01-01_all-amd64.logs/*.log.xz
+"""
+
+import collections
+import json
+import logging
+import lzma
+import os
+import re
+import shutil
+import time
+
+INDEX_NAME = 'index.json'
+
+# Lines of a failed phase shown on the console
+TAIL_LINES = 40
+
+
+def get_file_name(number, phase):
+    """Return the name of the log file of a phase."""
+    return '{:02d}-{}.log'.format(number, re.sub(r'[^\w.-]+', '-', phase))
+
+
+def compress(file_name):
+    """Compress a file with xz, replacing it. Return the compressed size."""
+    with open(file_name, 'rb') as source, \
+            lzma.open(file_name + '.xz', 'wb') as destination:
+        shutil.copyfileobj(source, destination, 1024 * 1024)
+
+    os.remove(file_name)
+    return os.path.getsize(file_name + '.xz')
+
+
+def read_tail(file_name, lines):
+    """Return the last lines of a file."""
+    with open(file_name, 'r', errors='replace') as file_handle:
+        return [line.rstrip('\n')
+                for line in collections.deque(file_handle, maxlen=lines)]
+
+
+class BuildLog(object):
+    """Directory of compressed logs of the phases of a build."""
+
+    def __init__(self, directory, tail_lines=TAIL_LINES):
+        """Initialize the object."""
+        self.directory = directory
+        self.tail_lines = tail_lines
+        self.phases = []
+        self.extra_files = []
+        self.file = None
+        self.phase = None
+        self.offset = 0
+        self.failed_phase = None
+        self.failure_tail = []
+
+    def open(self, phase):
+        """Remove logs of an earlier build and start the first phase."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        self.phases = []
+        self.extra_files = []
+        self.offset = 0
+        self.failed_phase = None
+        self.failure_tail = []
+        self.start_phase(phase)
+
+    def start_phase(self, phase):
+        """End the current phase and write to the log of a new one."""
+        self.end_phase()
+        file_name = get_file_name(len(self.phases) + 1, phase)
+        # Unbuffered, so that output of programs written to the file
+        # descriptor stays in order with log messages.
+        self.file = open(os.path.join(self.directory, file_name), 'ab',
+                         buffering=0)
+        self.phase = {
+            'phase': phase,
+            'file': file_name + '.xz',
+            'started': time.time(),
+        }
+
+    def fail(self):
+        """Mark the current phase as the one the build failed in."""
+        if self.phase and not self.failed_phase:
+            self.phase['failed'] = True
+            self.failed_phase = self.phase['phase']
+
+    def write(self, data):
+        """Write bytes to the log of the current phase."""
+        if self.file:
+            self.file.write(data)
+
+    def add_file(self, name):
+        """Return an empty log file for a program to write to.
+
+        The file is compressed along with the phases when the log is closed.
+        It is only created once the log is open.
+
+        """
+        file_name = os.path.join(self.directory, name)
+        if self.file:
+            open(file_name, 'w').close()
+            self.extra_files.append(name)
+
+        return file_name
+
+    def end_phase(self):
+        """Compress the log of the current phase and add it to the index."""
+        if not self.file:
+            return
+
+        file_name = self.file.name
+        self.file.close()
+        self.file = None
+        size = os.path.getsize(file_name)
+        if self.phase.get('failed'):
+            self.failure_tail = read_tail(file_name, self.tail_lines)
+
+        self.phase['finished'] = time.time()
+        self.phase['seconds'] = self.phase['finished'] - self.phase['started']
+        self.phase['offset'] = self.offset
+        self.phase['size'] = size
+        self.phase['compressed_size'] = compress(file_name)
+        self.phase.setdefault('failed', False)
+        self.offset += size
+        self.phases.append(self.phase)
+        self.phase = None
+        self.write_index()
+
+    def close(self):
+        """End the last phase and compress the logs of programs."""
+        if not self.file and not self.phases:
+            return
+
+        self.end_phase()
+        for name in self.extra_files:
+            file_name = os.path.join(self.directory, name)
+            if os.path.exists(file_name):
+                compress(file_name)
+
+        self.extra_files = []
+        self.write_index()
+
+    def write_index(self):
+        """Write the list of phases so that it is never read half written."""
+        file_name = os.path.join(self.directory, INDEX_NAME)
+        with open(file_name + '.partial', 'w') as file_handle:
+            json.dump({
+                'phases': self.phases,
+                'failed_phase': self.failed_phase,
+            }, file_handle, indent=4)
+
+        os.rename(file_name + '.partial', file_name)
+
+
+class BuildLogHandler(logging.Handler):
+    """Write log messages to the current phase of a build log."""
+
+    def __init__(self, build_log):
+        """Initialize the object."""
+        super().__init__()
+        self.build_log = build_log
+
+    def emit(self, record):
+        """Write a formatted log message."""
+        try:
+            self.build_log.write((self.format(record) + '\n').encode())
+        except Exception:
+            self.handleError(record)
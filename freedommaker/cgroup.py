@@ -0,0 +1,188 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Run the commands of a build in a control group of its own.
+
+Groups of builds are created under a parent group that the administrator
+creates and delegates to Freedom Maker, for example with:
+
+    mkdir /sys/fs/cgroup/freedom-maker
+    echo +cpu +io +memory > /sys/fs/cgroup/cgroup.subtree_control
+
+Only controllers the parent has are enabled for builds. Without the parent,
+builds are neither limited nor accounted.
+"""
+
+import logging
+import os
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# Mount points of unified cgroup hierarchy, with or without legacy hierarchy
+CGROUP_ROOTS = ['/sys/fs/cgroup', '/sys/fs/cgroup/unified']
+
+# Group under which groups of all builds are created, relative to the root
+# of the hierarchy
+PARENT_GROUP = 'freedom-maker'
+
+CONTROLLERS = ['cpu', 'io', 'memory']
+
+
+def get_root():
+    """Return the mount point of cgroup v2 hierarchy or None."""
+    for root in CGROUP_ROOTS:
+        if os.path.isfile(os.path.join(root, 'cgroup.controllers')):
+            return root
+
+    return None
+
+
+class BuildCgroup(object):
+    """Control group limiting and accounting resources used by a build."""
+
+    def __init__(self, name, memory_max=None, cpu_weight=None,
+                 io_weight=None, parent=None):
+        """Initialize the object.
+
+        Parent is the path of the delegated parent group, PARENT_GROUP under
+        the root of cgroup v2 hierarchy by default.
+
+        """
+        self.name = name
+        self.memory_max = memory_max
+        self.cpu_weight = cpu_weight
+        self.io_weight = io_weight
+        self.parent = parent
+        self.path = None
+
+    def locate(self):
+        """Set the path of the group without creating it.
+
+        Return False if the delegated parent group does not exist.
+
+        """
+        parent = self.parent
+        if not parent:
+            root = get_root()
+            if not root:
+                return False
+
+            parent = os.path.join(root, PARENT_GROUP)
+
+        if not os.path.isfile(os.path.join(parent, 'cgroup.controllers')):
+            return False
+
+        self.path = os.path.join(parent, self.name)
+        return True
+
+    def create(self):
+        """Create the group and set its limits.
+
+        Return False if the delegated parent group does not exist. Limits
+        of controllers the parent does not have are not set.
+
+        """
+        if not self.locate():
+            return False
+
+        parent = os.path.dirname(self.path)
+        with open(os.path.join(parent, 'cgroup.controllers'), 'r') as \
+                file_handle:
+            available = [
+                controller for controller in file_handle.read().split()
+                if controller in CONTROLLERS
+            ]
+
+        self._create_directory(self.path)
+        if available:
+            self._write(os.path.join(parent, 'cgroup.subtree_control'),
+                        ' '.join('+' + controller
+                                 for controller in available))
+
+        limits = {
+            'memory.max': self.memory_max,
+            'cpu.weight': self.cpu_weight,
+            'io.weight': 'default {}'.format(self.io_weight)
+            if self.io_weight else None,
+        }
+        for file_name, value in limits.items():
+            if value is None:
+                continue
+
+            if file_name.split('.')[0] not in available:
+                logger.warning('Controller of %s is not delegated to %s, '
+                               'not limiting builds', file_name, parent)
+                continue
+
+            self._write(os.path.join(self.path, file_name), value)
+
+        logger.info('Created cgroup %s with limits %s', self.path, limits)
+        return True
+
+    def get_wrapper(self):
+        """Return a command prefix that runs a command in the group."""
+        return [
+            'sudo', 'sh', '-c', 'echo $$ > "$0/cgroup.procs" && exec "$@"',
+            self.path
+        ]
+
+    def get_usage(self):
+        """Return peak memory, I/O bytes and CPU seconds used by the group."""
+        usage = {}
+        for file_name in ('memory.peak', 'memory.current'):
+            value = self._read(file_name)
+            if value is not None:
+                usage['memory_peak'] = int(value)
+                break
+
+        statistics = self._read('io.stat') or ''
+        for key in ('rbytes', 'wbytes'):
+            usage['io_' + key] = sum(
+                int(field.split('=')[1]) for field in statistics.split()
+                if field.startswith(key + '='))
+
+        for line in (self._read('cpu.stat') or '').splitlines():
+            key, value = line.split()
+            if key == 'usage_usec':
+                usage['cpu_seconds'] = int(value) / 1000000
+
+        return usage
+
+    def remove(self):
+        """Remove the group once all its processes have exited."""
+        subprocess.run(['sudo', 'rmdir', self.path])
+
+    def _read(self, file_name):
+        """Return contents of a file in the group or None."""
+        try:
+            with open(os.path.join(self.path, file_name), 'r') as \
+                    file_handle:
+                return file_handle.read().strip()
+        except (FileNotFoundError, PermissionError):
+            return None
+
+    @staticmethod
+    def _create_directory(path):
+        """Create a group as root."""
+        subprocess.check_call(['sudo', 'mkdir', '-p', path])
+
+    @staticmethod
+    def _write(file_name, value):
+        """Write a value into a cgroup file as root."""
+        subprocess.check_call(
+            ['sudo', 'sh', '-c', 'echo "$1" > "$0"', file_name, str(value)])
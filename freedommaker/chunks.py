@@ -0,0 +1,312 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Store of images split into chunks, keeping identical chunks once.
+
+Images of targets sharing an architecture and images of consecutive builds
+of a target are mostly the same. An image is split into chunks named by the
+sha256 hash of their contents, each compressed with xz on its own, and a
+chunk is only stored if no image stored before has it. An index lists the
+chunks of an image in order, so that the image can be reassembled.
+
+Compressed images are decompressed before splitting, as compressed data
+differs entirely after the first change. Reassembling such an image gives
+the uncompressed image.
+
+Chunks have a fixed size and start at multiples of it. Disk images and VM
+images allocate data in aligned blocks, so identical data is found at
+aligned offsets and content-defined chunk boundaries would not find more of
+it. Chunks of zeros, the holes of sparse images, are not stored.
+
+Images of old builds are removed by prune(), along with the chunks that no
+image left needs. Images are added while holding a shared lock of the store
+and pruning holds it exclusively, so that no chunk is removed that an image
+being added relies on.
+"""
+
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import lzma
+import os
+import threading
+import time
+
+CHUNK_SIZE = 64 * 1024
+
+CHUNKS_DIRECTORY = 'chunks'
+
+INDEXES_DIRECTORY = 'indexes'
+
+LOCK_NAME = 'lock'
+
+# Suffix of an index next to the image it lists the chunks of
+INDEX_SUFFIX = '.chunks'
+
+# Images worth splitting, other files hardly share any data
+EXTENSIONS = ('.img', '.vdi', '.qcow2')
+
+ZERO_CHUNK = bytes(CHUNK_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+def is_image(file_name):
+    """Return whether a file is an image, possibly compressed."""
+    if file_name.endswith('.xz'):
+        file_name = file_name[:-len('.xz')]
+
+    return file_name.endswith(EXTENSIONS)
+
+
+def read_index(file_name):
+    """Return an index written by ChunkStore.add()."""
+    with lzma.open(file_name, 'rt') as file_handle:
+        return json.load(file_handle)
+
+
+def write_index(index, file_name):
+    """Write an index so that it is never read half written."""
+    with lzma.open(file_name + '.partial', 'wt') as file_handle:
+        json.dump(index, file_handle)
+
+    os.rename(file_name + '.partial', file_name)
+
+
+class ChunkStore(object):
+    """Directory of chunks of images and indexes to reassemble them."""
+
+    def __init__(self, directory):
+        """Initialize the object."""
+        self.directory = directory
+
+    def get_chunk_file(self, chunk_hash):
+        """Return the path of the stored chunk with a hash."""
+        return os.path.join(self.directory, CHUNKS_DIRECTORY, chunk_hash[:2],
+                            chunk_hash)
+
+    def get_index_file(self, name):
+        """Return the path of the stored index of an image file name."""
+        return os.path.join(self.directory, INDEXES_DIRECTORY,
+                            os.path.basename(name) + INDEX_SUFFIX)
+
+    def add(self, file_name, **metadata):
+        """Split an image into stored chunks and return its index.
+
+        The index is kept in the store and written next to the image. It
+        includes metadata given, such as target and build stamp, and the
+        time it was added.
+
+        """
+        with self._lock(fcntl.LOCK_SH):
+            return self._add(file_name, metadata)
+
+    def _add(self, file_name, metadata):
+        """Split an image into stored chunks and return its index."""
+        index = dict(metadata)
+        index.update({
+            'name': os.path.basename(file_name),
+            'created': time.time(),
+            'compressed': file_name.endswith('.xz'),
+            'chunk_size': CHUNK_SIZE,
+            'chunks': [],
+        })
+        content_hash = hashlib.sha256()
+        size = 0
+        new_chunks = 0
+        opener = lzma.open if index['compressed'] else open
+        with opener(file_name, 'rb') as file_handle:
+            for chunk in iter(lambda: file_handle.read(CHUNK_SIZE), b''):
+                content_hash.update(chunk)
+                size += len(chunk)
+                if chunk == ZERO_CHUNK:
+                    index['chunks'].append(None)
+                    continue
+
+                chunk_hash = hashlib.sha256(chunk).hexdigest()
+                index['chunks'].append(chunk_hash)
+                if self._add_chunk(chunk_hash, chunk):
+                    new_chunks += 1
+
+        index['size'] = size
+        index['sha256'] = content_hash.hexdigest()
+        os.makedirs(os.path.join(self.directory, INDEXES_DIRECTORY),
+                    exist_ok=True)
+        write_index(index, self.get_index_file(file_name))
+        write_index(index, file_name + INDEX_SUFFIX)
+        logger.info('Stored %d new of %d chunks of %s', new_chunks,
+                    len(index['chunks']), file_name)
+        return index
+
+    def _add_chunk(self, chunk_hash, chunk):
+        """Store a chunk unless already stored. Return whether it was new."""
+        chunk_file = self.get_chunk_file(chunk_hash)
+        if os.path.exists(chunk_file):
+            return False
+
+        os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+        # Builds in other threads or processes may store the same chunk
+        partial_file = '{}.{}-{}.partial'.format(chunk_file, os.getpid(),
+                                                 threading.get_ident())
+        with open(partial_file, 'wb') as file_handle:
+            file_handle.write(lzma.compress(chunk, preset=0))
+
+        os.rename(partial_file, chunk_file)
+        return True
+
+    @contextlib.contextmanager
+    def _lock(self, operation):
+        """Hold a shared or exclusive lock of the store."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_NAME), 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_indexes(self):
+        """Return the file names and contents of stored indexes."""
+        indexes = []
+        directory = os.path.join(self.directory, INDEXES_DIRECTORY)
+        with contextlib.suppress(FileNotFoundError):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(INDEX_SUFFIX):
+                    file_name = os.path.join(directory, name)
+                    indexes.append((file_name, read_index(file_name)))
+
+        return indexes
+
+    def prune(self, keep):
+        """Keep images of the latest build stamps of each target only.
+
+        Build stamps are ordered by when their images were added, as they
+        need not sort by date. Indexes of images of older build stamps are
+        removed, and so are
+        chunks that no index left lists. Indexes written next to removed
+        images can no longer be extracted. Return the number of indexes and
+        chunks removed.
+
+        """
+        with self._lock(fcntl.LOCK_EX):
+            indexes = self.get_indexes()
+            build_stamps = collections.defaultdict(dict)
+            for _, index in indexes:
+                stamps = build_stamps[index.get('target')]
+                build_stamp = index.get('build_stamp')
+                stamps[build_stamp] = max(stamps.get(build_stamp, 0),
+                                          index.get('created', 0))
+
+            kept = {
+                target: sorted(stamps, key=stamps.get, reverse=True)[:keep]
+                for target, stamps in build_stamps.items()
+            }
+            needed = set()
+            removed_indexes = 0
+            for file_name, index in indexes:
+                if index.get('build_stamp') in kept[index.get('target')]:
+                    needed.update(index['chunks'])
+                else:
+                    logger.info('Removing image from chunk store - %s',
+                                index['name'])
+                    os.remove(file_name)
+                    removed_indexes += 1
+
+            removed_chunks = 0
+            directory = os.path.join(self.directory, CHUNKS_DIRECTORY)
+            for path, _, names in os.walk(directory):
+                for name in names:
+                    if name not in needed and not name.endswith('.partial'):
+                        os.remove(os.path.join(path, name))
+                        removed_chunks += 1
+
+        return removed_indexes, removed_chunks
+
+    def find_index(self, name):
+        """Return the index of an image given its index file or name."""
+        if not os.path.isfile(name):
+            name = self.get_index_file(name[:-len(INDEX_SUFFIX)]
+                                       if name.endswith(INDEX_SUFFIX)
+                                       else name)
+
+        return read_index(name)
+
+    def extract(self, index, file_name):
+        """Reassemble an image, uncompressed, from its chunks.
+
+        Holes are left for chunks of zeros. Raise ValueError if the result
+        does not match the image that was stored.
+
+        """
+        content_hash = hashlib.sha256()
+        zero_chunk = bytes(index['chunk_size'])
+        partial_file = file_name + '.partial'
+        with open(partial_file, 'wb') as file_handle:
+            for chunk_hash in index['chunks']:
+                if chunk_hash is None:
+                    chunk = zero_chunk
+                    file_handle.seek(len(chunk), os.SEEK_CUR)
+                else:
+                    with open(self.get_chunk_file(chunk_hash), 'rb') as \
+                            chunk_file:
+                        chunk = lzma.decompress(chunk_file.read())
+
+                    file_handle.write(chunk)
+
+                content_hash.update(chunk)
+
+            file_handle.truncate(index['size'])
+
+        if content_hash.hexdigest() != index['sha256']:
+            os.remove(partial_file)
+            raise ValueError('Reassembled image differs from stored image - '
+                             '{}'.format(index['name']))
+
+        os.rename(partial_file, file_name)
+
+    def get_statistics(self):
+        """Return sizes of images stored and of the chunks they take."""
+        statistics = {
+            'images': 0,
+            'image_bytes': 0,
+            'chunks': 0,
+            'chunk_bytes': 0,
+            'stored_bytes': 0,
+        }
+        chunks = {}
+        for _, index in self.get_indexes():
+            statistics['images'] += 1
+            statistics['image_bytes'] += index['size']
+            for number, chunk_hash in enumerate(index['chunks']):
+                if chunk_hash:
+                    chunks[chunk_hash] = min(
+                        index['chunk_size'],
+                        index['size'] - number * index['chunk_size'])
+
+        statistics['chunks'] = len(chunks)
+        statistics['chunk_bytes'] = sum(chunks.values())
+        for chunk_hash in chunks:
+            with contextlib.suppress(FileNotFoundError):
+                statistics['stored_bytes'] += os.path.getsize(
+                    self.get_chunk_file(chunk_hash))
+
+        statistics['ratio'] = statistics['image_bytes'] / \
+            statistics['stored_bytes'] if statistics['stored_bytes'] else 0
+        return statistics
@@ -0,0 +1,105 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Give concurrent builds CPUs of their own.
+"""
+
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Lock files shared by all Freedom Maker processes on the host
+LOCK_DIRECTORY = os.path.join(tempfile.gettempdir(), 'freedom-maker-cpus')
+
+# Seconds to wait before trying again when all CPUs are taken
+WAIT_INTERVAL = 5
+
+
+class CPUAllocation(object):
+    """CPUs dedicated to a build, not shared with other builds on the host.
+
+    A CPU is held by keeping a lock on its lock file. Locks are released by
+    the kernel if the process dies, so allocations never leak.
+
+    """
+
+    def __init__(self, count=1, lock_directory=LOCK_DIRECTORY):
+        """Initialize the object."""
+        self.count = count
+        self.lock_directory = lock_directory
+        self.cpus = []
+        self._lock_files = []
+
+    def acquire(self, wait=True):
+        """Lock the requested number of CPUs, waiting for them if needed.
+
+        Return the list of allocated CPUs or None if they are not available
+        and wait is False.
+
+        """
+        available = sorted(os.sched_getaffinity(0))
+        count = max(1, min(self.count, len(available)))
+        os.makedirs(self.lock_directory, exist_ok=True)
+        waiting = False
+        while True:
+            for cpu in available:
+                if len(self.cpus) == count:
+                    break
+
+                self._try_lock(cpu)
+
+            if len(self.cpus) == count:
+                return self.cpus
+
+            self.release()
+            if not wait:
+                return None
+
+            if not waiting:
+                logger.info('All CPUs are used by other builds, waiting')
+                waiting = True
+
+            time.sleep(WAIT_INTERVAL)
+
+    def release(self):
+        """Unlock all allocated CPUs."""
+        for lock_file in self._lock_files:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+        self._lock_files = []
+        self.cpus = []
+
+    def get_cpu_list(self):
+        """Return allocated CPUs in the list format of taskset."""
+        return ','.join(str(cpu) for cpu in self.cpus)
+
+    def _try_lock(self, cpu):
+        """Allocate a CPU if no other build holds it."""
+        lock_file = open(os.path.join(self.lock_directory, str(cpu)), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return
+
+        self.cpus.append(cpu)
+        self._lock_files.append(lock_file)
@@ -0,0 +1,367 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Build daemon that queues build requests of local clients.
+
+The daemon listens on a UNIX socket. A client sends a single JSON line with
+the arguments of the build and receives JSON lines with status, log
+messages and progress of the build until a final result message. Builds run
+one after the other, so that they don't race on files in the build
+directory, and package indexes stay loaded between builds. A request
+identical to one that is queued or running joins it instead of building
+again.
+
+Only the user running the daemon may connect to its socket. Requests only
+set what is built and where, see REQUEST_ARGUMENTS. Everything else, such
+as the vmdebootstrap executable that is run as root and the limits of
+builds, are the daemon's own arguments.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+
+from .variant import ImageVariant
+
+logger = logging.getLogger(__name__)
+
+# Name of the socket in build directory when none is given
+SOCKET_NAME = 'freedom-maker.sock'
+
+# Arguments holding paths that are relative to client's directory
+PATH_ARGUMENTS = [
+    'build_dir', 'cache_dir', 'local_mirror', 'custom_package', 'metrics_dir',
+    'artifact_store', 'chunk_store'
+]
+
+# Arguments that a request may set
+REQUEST_ARGUMENTS = [
+    'targets', 'build_stamp', 'image_size', 'build_mirror', 'mirror',
+    'distribution', 'download_source', 'include_source', 'package',
+    'custom_package', 'variant', 'build_dir', 'cache_dir', 'local_mirror',
+    'hostname', 'sign', 'force', 'refresh_from', 'resume', 'build_in_ram',
+    'ram_disk', 'metrics_dir', 'failure_lines', 'artifact_store',
+    'store_quota', 'pin', 'chunk_store', 'drop_chunked_images',
+    'chunk_retention', 'delta_block_size'
+]
+
+
+class DaemonError(Exception):
+    """Build daemon could not be started."""
+    pass
+
+
+def get_request(arguments):
+    """Return a build request for the daemon from command line arguments."""
+    request = {
+        key: value
+        for key, value in vars(arguments).items()
+        if key in REQUEST_ARGUMENTS
+    }
+    for key in PATH_ARGUMENTS:
+        value = request.get(key)
+        if isinstance(value, list):
+            request[key] = [os.path.abspath(path) for path in value]
+        elif value:
+            request[key] = os.path.abspath(value)
+
+    if request.get('build_mirror') and os.path.isdir(request['build_mirror']):
+        request['build_mirror'] = os.path.abspath(request['build_mirror'])
+
+    if request.get('variant'):
+        request['variant'] = [vars(variant) for variant in request['variant']]
+
+    return request
+
+
+def check_request(request):
+    """Raise ValueError if a request sets arguments it may not."""
+    if not isinstance(request, dict) or 'targets' not in request:
+        raise ValueError('Request has no targets')
+
+    refused = sorted(set(request) - set(REQUEST_ARGUMENTS))
+    if refused:
+        raise ValueError('Arguments not accepted from clients - {}'.format(
+            ', '.join(refused)))
+
+
+def get_arguments(request, defaults):
+    """Return command line arguments of a build request.
+
+    Arguments that the request does not set are taken from defaults, the
+    arguments of the daemon.
+
+    """
+    check_request(request)
+    arguments = argparse.Namespace(**vars(defaults))
+    arguments.command = None
+    vars(arguments).update(request)
+    if arguments.variant:
+        arguments.variant = [
+            ImageVariant(**variant) for variant in arguments.variant
+        ]
+
+    return arguments
+
+
+def submit(socket_path, arguments, output=sys.stdout):
+    """Send a build to the daemon and show its progress.
+
+    Return the exit status for the command line.
+
+    """
+    request = get_request(arguments)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            logger.error('No build daemon is listening on %s', socket_path)
+            return 2
+
+        connection.sendall(json.dumps({'arguments': request}).encode() +
+                           b'\n')
+        for line in connection.makefile('rb'):
+            message = json.loads(line.decode())
+            if message['type'] == 'log':
+                print(message['message'], file=output, flush=True)
+            elif message['type'] == 'status':
+                print('Job {} {}{}'.format(
+                    message['job'], message['state'],
+                    ', joined identical request'
+                    if message.get('joined') else ''),
+                      file=output, flush=True)
+            elif message['type'] == 'progress':
+                print('Stage {} of {} {}'.format(
+                    message['stage'], message['target'], message['state']),
+                      file=output, flush=True)
+            elif message['type'] == 'result':
+                if message['status'] != 'done':
+                    logger.error('Build failed - %s', message.get('error'))
+                    return 1
+
+                return 0
+
+    logger.error('Connection to build daemon lost')
+    return 1
+
+
+class Job(object):
+    """Build requested by one or more clients."""
+
+    def __init__(self, number, request):
+        """Initialize the object."""
+        self.number = number
+        self.request = request
+        self.state = 'queued'
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        """Return a queue receiving messages about the job from now on."""
+        messages = queue.Queue()
+        with self.lock:
+            self.subscribers.append(messages)
+
+        return messages
+
+    def unsubscribe(self, messages):
+        """Stop sending messages to a queue."""
+        with self.lock:
+            self.subscribers.remove(messages)
+
+    def publish(self, message):
+        """Send a message to all subscribers of the job."""
+        with self.lock:
+            for messages in self.subscribers:
+                messages.put(message)
+
+
+class BuildDaemon(object):
+    """Queue of build requests executed one after the other."""
+
+    def __init__(self, socket_path, execute, arguments):
+        """Initialize the object.
+
+        execute is called with arguments and a progress listener to run a
+        build. arguments are those of the daemon, used for what requests
+        don't set.
+
+        """
+        self.socket_path = socket_path
+        self.execute = execute
+        self.arguments = arguments
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.current_job = None
+        self.numbers = itertools.count(1)
+        self.server = None
+
+    def serve(self):
+        """Accept requests on the socket until interrupted."""
+        self._remove_stale_socket()
+        log_handler = _JobLogHandler(self)
+        log_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'))
+        logging.getLogger('freedommaker').addHandler(log_handler)
+
+        threading.Thread(target=self.run_jobs, name='jobs',
+                         daemon=True).start()
+        server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, _RequestHandler, bind_and_activate=False)
+        try:
+            # Clients may not connect before the socket is private
+            server.server_bind()
+            os.chmod(self.socket_path, 0o600)
+            server.server_activate()
+        except OSError:
+            server.server_close()
+            raise
+
+        server.daemon_threads = True
+        server.build_daemon = self
+        self.server = server
+        logger.info('Build daemon listening on %s', self.socket_path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+            logging.getLogger('freedommaker').removeHandler(log_handler)
+
+    def stop(self):
+        """Stop accepting requests, from another thread than serve()."""
+        self.server.shutdown()
+
+    def submit(self, request):
+        """Queue a request or join an identical one that is not finished.
+
+        Return the job, a queue of its messages and whether an existing job
+        was joined.
+
+        """
+        key = json.dumps(request, sort_keys=True)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job:
+                return job, job.subscribe(), True
+
+            job = Job(next(self.numbers), request)
+            messages = job.subscribe()
+            self.jobs[key] = job
+            self.queue.put((key, job))
+            logger.info('Queued job %d - %s', job.number,
+                        ' '.join(request['targets']))
+            return job, messages, False
+
+    def run_jobs(self):
+        """Run queued jobs one after the other."""
+        while True:
+            key, job = self.queue.get()
+            job.state = 'running'
+            job.publish({'type': 'status', 'job': job.number,
+                         'state': job.state})
+            self.current_job = job
+            result = {'type': 'result', 'job': job.number, 'status': 'done'}
+            try:
+                self.execute(get_arguments(job.request, self.arguments),
+                             lambda target, stage, state: job.publish({
+                                 'type': 'progress',
+                                 'target': target,
+                                 'stage': stage,
+                                 'state': state,
+                             }))
+            except BaseException as exception:  # pylint: disable=broad-except
+                logger.exception('Job %d failed', job.number)
+                result.update(status='failed', error=str(exception) or
+                              type(exception).__name__)
+            finally:
+                self.current_job = None
+                with self.lock:
+                    del self.jobs[key]
+
+                job.publish(result)
+
+    def _remove_stale_socket(self):
+        """Remove socket of a daemon that died, fail if one is running."""
+        if not os.path.exists(self.socket_path):
+            return
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            try:
+                connection.connect(self.socket_path)
+            except ConnectionRefusedError:
+                os.remove(self.socket_path)
+                return
+
+        raise DaemonError('A build daemon is already listening on {}'.format(
+            self.socket_path))
+
+
+class _JobLogHandler(logging.Handler):
+    """Send log messages to the clients of the running job."""
+
+    def __init__(self, build_daemon):
+        """Initialize the object."""
+        super().__init__()
+        self.build_daemon = build_daemon
+
+    def emit(self, record):
+        """Send a log message to the clients."""
+        job = self.build_daemon.current_job
+        if job:
+            job.publish({'type': 'log', 'message': self.format(record)})
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Connection of a client submitting a build."""
+
+    def handle(self):
+        """Queue the request and stream messages until it is finished."""
+        try:
+            request = json.loads(self.rfile.readline().decode())['arguments']
+            check_request(request)
+        except (ValueError, KeyError) as exception:
+            self.send({'type': 'result', 'status': 'failed',
+                       'error': 'Invalid request - {}'.format(exception)})
+            return
+
+        job, messages, joined = self.server.build_daemon.submit(request)
+        try:
+            self.send({'type': 'status', 'job': job.number,
+                       'state': job.state, 'joined': joined})
+            while True:
+                message = messages.get()
+                self.send(message)
+                if message['type'] == 'result':
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info('Client of job %d disconnected', job.number)
+        finally:
+            job.unsubscribe(messages)
+
+    def send(self, message):
+        """Send a message to the client."""
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+        self.wfile.flush()
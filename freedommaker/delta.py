@@ -0,0 +1,210 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Indexes of compressed images for downloading only the blocks that changed.
+
+An image is compressed by xz into blocks of a fixed uncompressed size, each
+of which can be decompressed on its own. The image is fed to xz block by
+block, hashing every block on the way. Once compressed, the offsets of the
+blocks in the archive are read from xz and an index is written next to the
+archive. For every block, it lists its offset and size in the image and in
+the archive, and the sha256 hash of its contents.
+
+A client with the image of an earlier build hashes its blocks at the same
+offsets and only downloads the byte ranges of the archive holding blocks
+that differ, see update().
+"""
+
+import hashlib
+import json
+import lzma
+import os
+
+INDEX_SUFFIX = '.delta.json'
+
+# Identifier of the LZMA2 filter in xz block headers
+LZMA2_FILTER = 0x21
+
+
+def get_compressor(block_size):
+    """Return the command compressing standard input in blocks."""
+    return [
+        'xz', '--threads=0', '--best', '--block-size={}'.format(block_size)
+    ]
+
+
+def feed(image_file, stream, block_size, block_hashes):
+    """Write an image to a stream block by block, appending their hashes.
+
+    The stream is closed at the end.
+
+    """
+    try:
+        with open(image_file, 'rb') as file_handle:
+            for block in iter(lambda: file_handle.read(block_size), b''):
+                block_hashes.append(hashlib.sha256(block).hexdigest())
+                stream.write(block)
+    except BrokenPipeError:
+        # Compressor failed, its exit status is reported
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def get_index(archive_file, listing, block_size, block_hashes):
+    """Return the index of an archive.
+
+    listing is the output of xz --robot --list -vv for the archive.
+
+    """
+    blocks = []
+    for line in listing.splitlines():
+        fields = line.split('\t')
+        if fields[0] != 'block':
+            continue
+
+        blocks.append({
+            'offset': int(fields[5]),
+            'size': int(fields[7]),
+            'compressed_offset': int(fields[4]),
+            'compressed_size': int(fields[6]),
+        })
+
+    if len(blocks) != len(block_hashes) or \
+       any(block['offset'] != number * block_size
+           for number, block in enumerate(blocks)):
+        raise ValueError('Blocks of archive do not match blocks of image - '
+                         '{}'.format(archive_file))
+
+    for block, block_hash in zip(blocks, block_hashes):
+        block['sha256'] = block_hash
+
+    return {
+        'archive': os.path.basename(archive_file),
+        'block_size': block_size,
+        'size': sum(block['size'] for block in blocks),
+        'blocks': blocks,
+    }
+
+
+def write_index(index, archive_file):
+    """Write the index of an archive next to it.
+
+    The index is replaced, not rewritten, as it may be linked to a file in
+    the artifact store.
+
+    """
+    file_name = archive_file + INDEX_SUFFIX
+    with open(file_name + '.partial', 'w') as file_handle:
+        json.dump(index, file_handle, indent=4)
+
+    os.rename(file_name + '.partial', file_name)
+
+
+def read_varint(data, position):
+    """Return a variable length integer of xz headers and where it ends."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def decompress_block(data):
+    """Return the contents of a block of an archive on its own."""
+    header_size = (data[0] + 1) * 4
+    flags = data[1]
+    position = 2
+    if flags & 0x40:
+        _, position = read_varint(data, position)
+
+    if flags & 0x80:
+        _, position = read_varint(data, position)
+
+    filters = []
+    for _ in range((flags & 0x03) + 1):
+        filter_id, position = read_varint(data, position)
+        properties_size, position = read_varint(data, position)
+        filters.append((filter_id, data[position:position +
+                                        properties_size]))
+        position += properties_size
+
+    if len(filters) != 1 or filters[0][0] != LZMA2_FILTER:
+        raise ValueError('Block is not compressed with LZMA2 alone')
+
+    bits = filters[0][1][0] & 0x3f
+    dict_size = 0xffffffff if bits == 40 else \
+        (2 | (bits & 1)) << (bits // 2 + 11)
+    decompressor = lzma.LZMADecompressor(
+        lzma.FORMAT_RAW, filters=[{
+            'id': lzma.FILTER_LZMA2,
+            'dict_size': dict_size
+        }])
+    return decompressor.decompress(data[header_size:])
+
+
+def get_changed_blocks(index, image_file):
+    """Return the blocks of an index that differ in an earlier image."""
+    changed = []
+    with open(image_file, 'rb') as file_handle:
+        for block in index['blocks']:
+            file_handle.seek(block['offset'])
+            data = file_handle.read(block['size'])
+            if hashlib.sha256(data).hexdigest() != block['sha256']:
+                changed.append(block)
+
+    return changed
+
+
+def update(index, image_file, read_range):
+    """Update an earlier image in place to the image of an index.
+
+    read_range is called with offset and size of a byte range of the
+    archive, for example to download it with an HTTP range request, and
+    returns its bytes. Return the number of bytes read.
+
+    """
+    read = 0
+    changed = get_changed_blocks(index, image_file)
+    with open(image_file, 'r+b') as file_handle:
+        for block in changed:
+            try:
+                data = decompress_block(
+                    read_range(block['compressed_offset'],
+                               block['compressed_size']))
+            except lzma.LZMAError:
+                data = None
+
+            if data is None or \
+               hashlib.sha256(data).hexdigest() != block['sha256']:
+                raise ValueError('Downloaded block is damaged - {}'.format(
+                    block['offset']))
+
+            file_handle.seek(block['offset'])
+            file_handle.write(data)
+            read += block['compressed_size']
+
+        file_handle.truncate(index['size'])
+
+    return read
@@ -0,0 +1,233 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Record durations and sizes of builds to estimate and compare later builds.
+
+History is kept in an SQLite database in the build directory. Builds are
+compared only with earlier builds of the same target, backend, distribution
+and configuration.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import sqlite3
+import statistics
+import sys
+
+DATABASE_NAME = 'history.sqlite3'
+
+# Number of earlier successful builds that make up the baseline
+BASELINE_BUILDS = 10
+
+# A stage is slower than its baseline if it takes this much longer
+REGRESSION_FACTOR = 1.25
+REGRESSION_SECONDS = 30
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    target TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    distribution TEXT NOT NULL,
+    configuration TEXT NOT NULL,
+    build_stamp TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    success INTEGER NOT NULL,
+    reused INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS builds_key
+    ON builds (target, backend, distribution, configuration);
+CREATE TABLE IF NOT EXISTS stages (
+    build INTEGER NOT NULL REFERENCES builds (id),
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    build INTEGER NOT NULL REFERENCES builds (id),
+    artifact TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+'''
+
+
+def get_key(builder_class, arguments):
+    """Return what builds must have in common to be compared."""
+    configuration = {
+        'architecture': builder_class.architecture,
+        'machine': builder_class.machine,
+        'free': builder_class.free,
+        'root_filesystem_type': builder_class.root_filesystem_type,
+        'kernel_flavor': builder_class.kernel_flavor,
+        'image_size': arguments.image_size,
+        'build_in_ram': arguments.ram_disk if arguments.build_in_ram else None,
+        'variants': sorted(variant.name
+                           for variant in arguments.variant or []),
+    }
+    return (builder_class.get_target_name(), builder_class.builder_backend,
+            arguments.distribution, json.dumps(configuration, sort_keys=True))
+
+
+def format_duration(seconds):
+    """Return a short human readable duration."""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+
+    if seconds >= 60:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+
+    return '{}s'.format(seconds)
+
+
+def find_regressions(durations):
+    """Return stages of the latest build that are slower than baseline.
+
+    durations maps stage names to durations of successful builds, the latest
+    first.
+
+    """
+    regressions = []
+    for stage, values in durations.items():
+        if len(values) < 2:
+            continue
+
+        latest = values[0]
+        baseline = statistics.median(values[1:BASELINE_BUILDS + 1])
+        if latest > baseline * REGRESSION_FACTOR and \
+           latest - baseline > REGRESSION_SECONDS:
+            regressions.append((stage, latest, baseline))
+
+    return regressions
+
+
+class BuildHistory(object):
+    """Database of durations and sizes of earlier builds."""
+
+    def __init__(self, build_dir):
+        """Initialize the object."""
+        self.file_name = os.path.join(build_dir, DATABASE_NAME)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Return a connection to the database committing on success."""
+        connection = sqlite3.connect(self.file_name, timeout=60)
+        try:
+            connection.executescript(SCHEMA)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def record(self, key, build_stamp, started, finished, success, reused,
+               stages, sizes):
+        """Add a finished build to the history.
+
+        Builds that reused an earlier build are not used for estimates.
+
+        """
+        with self.connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO builds (target, backend, distribution, '
+                'configuration, build_stamp, started, finished, success, '
+                'reused) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (build_stamp, started, finished, int(success),
+                       int(reused)))
+            build = cursor.lastrowid
+            connection.executemany(
+                'INSERT INTO stages (build, stage, seconds) VALUES (?, ?, ?)',
+                [(build, stage, seconds) for stage, seconds in stages.items()])
+            connection.executemany(
+                'INSERT INTO artifacts (build, artifact, size) '
+                'VALUES (?, ?, ?)',
+                [(build, artifact, size) for artifact, size in sizes.items()])
+
+    def get_keys(self, targets=None):
+        """Return keys of all builds, only of some targets if given."""
+        with self.connect() as connection:
+            keys = connection.execute(
+                'SELECT DISTINCT target, backend, distribution, '
+                'configuration FROM builds ORDER BY target').fetchall()
+
+        return [key for key in keys if not targets or key[0] in targets]
+
+    def get_durations(self, key, limit=BASELINE_BUILDS + 1):
+        """Return durations of recent successful builds, the latest first.
+
+        Durations are keyed by stage, with the whole build under None.
+
+        """
+        with self.connect() as connection:
+            builds = connection.execute(
+                'SELECT id, finished - started FROM builds WHERE target = ? '
+                'AND backend = ? AND distribution = ? AND configuration = ? '
+                'AND success AND NOT reused ORDER BY finished DESC LIMIT ?',
+                key + (limit, )).fetchall()
+            durations = collections.OrderedDict()
+            durations[None] = [seconds for _, seconds in builds]
+            for build, _ in builds:
+                for stage, seconds in connection.execute(
+                        'SELECT stage, seconds FROM stages WHERE build = ? '
+                        'ORDER BY rowid', (build, )):
+                    durations.setdefault(stage, []).append(seconds)
+
+        return durations
+
+    def estimate(self, key):
+        """Return expected duration of a build and its stages or None."""
+        durations = self.get_durations(key, BASELINE_BUILDS)
+        if not durations[None]:
+            return None
+
+        return collections.OrderedDict(
+            (stage, statistics.median(values))
+            for stage, values in durations.items())
+
+    def report(self, targets=None, output=sys.stdout):
+        """Print the latest build of each kind against its baseline.
+
+        Return whether any stage got slower than its baseline.
+
+        """
+        slower = False
+        line = '{:<22} {:<14} {:<12} {:<12} {:>8} {:>9} {:>7}  {}'
+        print(line.format('Target', 'Backend', 'Distribution', 'Stage',
+                          'Latest', 'Baseline', 'Change', ''), file=output)
+        for key in self.get_keys(targets):
+            durations = self.get_durations(key)
+            if not durations[None]:
+                continue
+
+            regressions = {
+                stage: baseline
+                for stage, _, baseline in find_regressions(durations)
+            }
+            for stage, values in durations.items():
+                baseline = statistics.median(values[1:]) \
+                    if len(values) > 1 else None
+                change = '{:+.0%}'.format(values[0] / baseline - 1) \
+                    if baseline else ''
+                print(line.format(
+                    key[0], key[1], key[2], stage or 'total',
+                    format_duration(values[0]),
+                    format_duration(baseline) if baseline else '-', change,
+                    'SLOWER' if stage in regressions else ''), file=output)
+                slower = slower or stage in regressions
+
+        return slower
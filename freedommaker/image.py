@@ -0,0 +1,150 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Access the file systems inside a built disk image.
+"""
+
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Mount points of the partitions preceding the root partition, nearest first.
+# Root file system is always the last partition in images built by Freedom
+# Maker.
+BOOT_MOUNT_POINTS = ['boot', 'boot/firmware']
+
+VIRTUAL_FILE_SYSTEMS = ['dev', 'dev/pts', 'proc', 'sys']
+
+EMULATOR = '/usr/bin/qemu-arm-static'
+
+
+class ImageMount(object):
+    """Attach a disk image to a loop device and mount its file systems."""
+
+    def __init__(self, builder, image_file, read_only=False):
+        """Initialize the object."""
+        self.builder = builder
+        self.image_file = image_file
+        self.read_only = read_only
+        self.loop_device = None
+        self.partitions = []
+        self.root_directory = None
+        self.mount_points = []
+        self.installed_emulator = None
+
+    def __enter__(self):
+        """Attach and mount the image."""
+        try:
+            self.attach()
+            self.mount_root()
+        except BaseException:
+            self.detach()
+            raise
+
+        return self
+
+    def __exit__(self, *exc):
+        """Unmount and detach the image."""
+        self.detach()
+
+    def attach(self):
+        """Setup loop device and partition mappings for the image."""
+        self.loop_device, self.partitions = \
+            self.builder.loop_manager.attach(self.image_file,
+                                             read_only=self.read_only)
+        logger.info('Attached image %s to %s with partitions %s',
+                    self.image_file, self.loop_device, self.partitions)
+
+    def detach(self):
+        """Unmount everything and remove loop device and mappings."""
+        if self.installed_emulator:
+            self.builder._run(['sudo', 'rm', '-f', self.installed_emulator])
+            self.installed_emulator = None
+
+        for mount_point in reversed(self.mount_points):
+            if os.path.ismount(mount_point):
+                self.builder._run(['sudo', 'umount', mount_point])
+
+        self.mount_points = []
+
+        if self.root_directory:
+            os.rmdir(self.root_directory)
+            self.root_directory = None
+
+        if self.loop_device:
+            self.builder.loop_manager.detach(self.loop_device)
+            self.loop_device = None
+
+    def mount(self, device, path, *options):
+        """Mount a device at a path relative to root directory."""
+        mount_point = os.path.join(self.root_directory, path)
+        self.builder._run(['sudo', 'mount'] + list(options) +
+                          [device, mount_point])
+        self.mount_points.append(mount_point)
+
+    def mount_root(self):
+        """Mount the root file system in a temporary directory."""
+        if not self.partitions:
+            raise ValueError('No partitions found in image - {}'.format(
+                self.image_file))
+
+        self.root_directory = tempfile.mkdtemp()
+        options = ['-o', 'ro'] if self.read_only else []
+        self.mount(self.partitions[-1], '', *options)
+
+    def mount_boot(self):
+        """Mount the boot partitions inside the root file system."""
+        boot_partitions = reversed(self.partitions[:-1])
+        for partition, path in zip(boot_partitions, BOOT_MOUNT_POINTS):
+            self.mount(partition, path)
+
+    def mount_virtual_file_systems(self):
+        """Bind mount host's virtual file systems needed for chroot."""
+        for path in VIRTUAL_FILE_SYSTEMS:
+            self.mount('/' + path, path, '--bind')
+
+    def install_emulator(self, architecture):
+        """Make binaries of a foreign architecture runnable in chroot."""
+        if architecture in ('i386', 'amd64'):
+            return
+
+        emulator = self.get_path(EMULATOR)
+        if os.path.exists(emulator):
+            return
+
+        self.builder._run(['sudo', 'cp', EMULATOR, emulator])
+        self.installed_emulator = emulator
+
+    def chroot(self, command, **kwargs):
+        """Run a command inside the root file system."""
+        self.builder._run(['sudo', 'chroot', self.root_directory] + command,
+                          **kwargs)
+
+    def get_installed_packages(self):
+        """Return a map of installed package names to their versions."""
+        output = self.builder._run_output([
+            'dpkg-query', '--admindir', self.get_path('/var/lib/dpkg'), '-W',
+            '-f', '${Package}:${Architecture} ${Version}\\n'
+        ])
+        return dict(line.split(' ', maxsplit=1)
+                    for line in output.splitlines() if line)
+
+    def get_path(self, path):
+        """Return the host path of a path inside the image."""
+        return os.path.join(self.root_directory, path.lstrip('/'))
@@ -0,0 +1,317 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Manage loop devices and device mapper partitions used by builds.
+
+Every build records the loop devices it attaches with their images, and the
+image files that other tools (vmdebootstrap, kpartx) may attach, in a
+registry file that it keeps locked while running. Registries that are no
+longer locked belong to builds that died and everything recorded in them is
+torn down. As the kernel reuses loop devices, a device is only torn down if
+it is still backed by the image recorded for it.
+"""
+
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Registries shared by all Freedom Maker processes on the host
+REGISTRY_DIRECTORY = os.path.join(tempfile.gettempdir(),
+                                  'freedom-maker-loops')
+
+# Threads tearing down devices and signals received meanwhile, see
+# deferring()
+_teardowns = 0
+_pending_signals = []
+_teardown_lock = threading.Lock()
+
+
+def get_loop_devices(image_file=None):
+    """Return loop devices, only those backed by a file if given."""
+    output = subprocess.check_output(['losetup', '--json']).decode()
+    if not output:
+        return []
+
+    devices = []
+    for device in json.loads(output)['loopdevices']:
+        back_file = (device['back-file'] or '').rsplit(' (deleted)', 1)[0]
+        if image_file is None or back_file == image_file:
+            devices.append(device['name'])
+
+    return devices
+
+
+def get_back_file(loop_device):
+    """Return the file backing a loop device, None if not attached."""
+    try:
+        output = subprocess.check_output(
+            ['losetup', '--list', '--noheadings', '-O', 'BACK-FILE',
+             loop_device], stderr=subprocess.DEVNULL).decode().strip()
+    except subprocess.CalledProcessError:
+        return None
+
+    return output.rsplit(' (deleted)', 1)[0] or None
+
+
+def get_mappings(loop_device):
+    """Return device mapper partitions of a loop device."""
+    name = os.path.basename(loop_device)
+    return sorted(glob.glob('/dev/mapper/' + name + 'p*'))
+
+
+def teardown(loop_device):
+    """Unmount, remove partition mappings and detach a loop device."""
+    devices = get_mappings(loop_device) + [loop_device]
+    with open('/proc/mounts', 'r') as file_handle:
+        mounts = [line.split()[:2] for line in file_handle]
+
+    for source, mount_point in reversed(mounts):
+        if source in devices:
+            _run(['sudo', 'umount', '--lazy', mount_point])
+
+    for mapping in reversed(devices[:-1]):
+        _run(['sudo', 'dmsetup', 'remove', '--retry', mapping])
+
+    _run(['sudo', 'losetup', '--detach', loop_device])
+
+
+def collect_garbage(registry_directory=REGISTRY_DIRECTORY):
+    """Teardown devices recorded by builds that are no longer running."""
+    if not os.path.isdir(registry_directory):
+        return
+
+    with _global_lock(registry_directory):
+        for registry_file in glob.glob(
+                os.path.join(registry_directory, '*.json')):
+            with open(registry_file, 'r') as file_handle:
+                try:
+                    fcntl.flock(file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                try:
+                    registry = json.load(file_handle)
+                except ValueError:
+                    registry = {}
+
+                logger.info('Cleaning up devices of dead build %s - %s',
+                            registry.get('pid'), registry)
+                _teardown_registry(registry)
+                os.remove(registry_file)
+
+
+def _teardown_registry(registry):
+    """Teardown all devices recorded in a registry.
+
+    Devices are recorded with the images backing them. A device that is no
+    longer backed by its image may belong to another build and is skipped.
+
+    """
+    devices = {}
+    for entry in registry.get('devices', []):
+        if isinstance(entry, list):
+            devices[entry[0]] = entry[1]
+        else:
+            # Image of the device is unknown
+            devices[entry] = None
+
+    for image_file in registry.get('images', []):
+        for device in get_loop_devices(image_file):
+            devices[device] = image_file
+
+    for device, image_file in sorted(devices.items()):
+        back_file = get_back_file(device)
+        if image_file is None or back_file is None or \
+           os.path.realpath(back_file) != os.path.realpath(image_file):
+            logger.info('Not tearing down %s, no longer backed by %s',
+                        device, image_file)
+            continue
+
+        teardown(device)
+
+
+@contextlib.contextmanager
+def _global_lock(registry_directory):
+    """Serialize changes to registries among all builds."""
+    with open(os.path.join(registry_directory, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def deferring(handler):
+    """Return a signal handler waiting for devices to be torn down.
+
+    Signals are handled in the main thread while any thread may be tearing
+    down devices. A signal received meanwhile is sent again once no thread
+    is tearing down devices anymore.
+
+    """
+    def handle(signum, frame):
+        if _teardowns:
+            logger.info('Signal %d received, handling it once devices are '
+                        'torn down', signum)
+            _pending_signals.append(signum)
+        else:
+            handler(signum, frame)
+
+    return handle
+
+
+@contextlib.contextmanager
+def _signals_blocked():
+    """Do not let an interrupt leave devices half torn down.
+
+    Only signals with handlers from deferring() are held back.
+
+    """
+    global _teardowns
+    with _teardown_lock:
+        _teardowns += 1
+
+    try:
+        yield
+    finally:
+        with _teardown_lock:
+            _teardowns -= 1
+            signals = []
+            if not _teardowns:
+                signals = list(_pending_signals)
+                del _pending_signals[:]
+
+        for signum in signals:
+            os.kill(os.getpid(), signum)
+
+
+def _run(command):
+    """Run a cleanup command, logging instead of raising on failure."""
+    logger.info('Executing command - %s', command)
+    process = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+    if process.returncode:
+        logger.warning('Command failed - %s: %s', command,
+                       process.stdout.decode().strip())
+
+
+class LoopManager(object):
+    """Loop devices and partition mappings held by a build."""
+
+    def __init__(self, registry_directory=REGISTRY_DIRECTORY):
+        """Initialize the object."""
+        self.registry_directory = registry_directory
+        self.registry_file = None
+        self.devices = []
+        self.images = []
+
+    def attach(self, image_file, read_only=False):
+        """Attach an image to a free loop device and map its partitions.
+
+        Return the loop device and the device mapper partitions.
+
+        """
+        options = ['--read-only'] if read_only else []
+        with self._locked():
+            loop_device = subprocess.check_output(
+                ['sudo', 'losetup', '--find', '--show'] + options +
+                [image_file]).decode().strip()
+            self.devices.append([loop_device, os.path.realpath(image_file)])
+            self._save()
+
+        try:
+            subprocess.check_call(['sudo', 'kpartx', '-avs', loop_device],
+                                  stdout=subprocess.DEVNULL)
+        except BaseException:
+            self.detach(loop_device)
+            raise
+
+        return loop_device, get_mappings(loop_device)
+
+    def detach(self, loop_device):
+        """Remove partition mappings and detach a loop device."""
+        with _signals_blocked():
+            teardown(loop_device)
+            with self._locked():
+                self.devices = [
+                    entry for entry in self.devices if entry[0] != loop_device
+                ]
+                self._save()
+
+    def track_image(self, image_file):
+        """Record an image that other tools may attach to loop devices."""
+        with self._locked():
+            self.images.append(os.path.abspath(image_file))
+            self._save()
+
+    def release_image(self, image_file):
+        """Teardown all loop devices backed by an image and forget it."""
+        image_file = os.path.abspath(image_file)
+        with _signals_blocked():
+            for device in get_loop_devices(image_file):
+                teardown(device)
+
+            with self._locked():
+                if image_file in self.images:
+                    self.images.remove(image_file)
+
+                self._save()
+
+    def close(self):
+        """Teardown everything held by the build and remove its registry."""
+        if not self.registry_file:
+            return
+
+        with _signals_blocked():
+            _teardown_registry({'devices': self.devices,
+                                'images': self.images})
+            with _global_lock(self.registry_directory):
+                os.remove(self.registry_file.name)
+                self.registry_file.close()
+                self.registry_file = None
+                self.devices = []
+                self.images = []
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Create the registry of this build if needed and lock changes."""
+        os.makedirs(self.registry_directory, exist_ok=True)
+        with _global_lock(self.registry_directory):
+            if not self.registry_file:
+                self.registry_file = tempfile.NamedTemporaryFile(
+                    mode='w', dir=self.registry_directory,
+                    prefix='{}-'.format(os.getpid()), suffix='.json',
+                    delete=False)
+                fcntl.flock(self.registry_file, fcntl.LOCK_EX)
+
+            yield
+
+    def _save(self):
+        """Write the devices held by this build to its registry."""
+        self.registry_file.seek(0)
+        self.registry_file.truncate()
+        json.dump({'pid': os.getpid(), 'devices': self.devices,
+                   'images': self.images}, self.registry_file)
+        self.registry_file.flush()
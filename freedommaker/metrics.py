@@ -0,0 +1,122 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Write metrics of builds for the textfile collector of Prometheus node
+exporter.
+"""
+
+import os
+
+PREFIX = 'freedommaker_'
+
+# Name, type and help text of metrics in the order they are written
+METRICS = [
+    ('build_success', 'gauge',
+     'Whether the last build of the target succeeded'),
+    ('build_timestamp_seconds', 'gauge',
+     'Time the last build of the target finished'),
+    ('build_duration_seconds', 'gauge', 'Duration of the last build'),
+    ('build_reused', 'gauge',
+     'Whether artifacts of an earlier build were reused'),
+    ('stage_duration_seconds', 'gauge', 'Duration of a build stage'),
+    ('artifact_size_bytes', 'gauge', 'Size of a file built'),
+    ('compression_duration_seconds', 'gauge',
+     'Time taken to compress a file'),
+    ('compression_throughput_bytes_per_second', 'gauge',
+     'Uncompressed bytes compressed per second'),
+    ('cache_requests', 'gauge',
+     'Lookups in a cache during the build by result'),
+    ('cache_hit_ratio', 'gauge', 'Share of lookups found in a cache'),
+]
+
+
+def format_labels(labels):
+    """Return labels in the text exposition format."""
+    return ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+
+def format_metrics(samples):
+    """Return text exposition of samples given as name, labels and value."""
+    lines = []
+    for name, metric_type, help_text in METRICS:
+        values = [(labels, value) for sample_name, labels, value in samples
+                  if sample_name == name]
+        if not values:
+            continue
+
+        lines.append('# HELP {}{} {}'.format(PREFIX, name, help_text))
+        lines.append('# TYPE {}{} {}'.format(PREFIX, name, metric_type))
+        for labels, value in values:
+            lines.append('{}{}{{{}}} {}'.format(PREFIX, name,
+                                                 format_labels(labels),
+                                                 repr(float(value))))
+
+    return '\n'.join(lines) + '\n'
+
+
+def get_build_samples(builder, success, finished):
+    """Return metric samples describing a finished build."""
+    target = {'target': builder.get_target_name()}
+    build = dict(target, backend=builder.builder_backend)
+    samples = [
+        ('build_success', build, int(success)),
+        ('build_timestamp_seconds', build, finished),
+        ('build_duration_seconds', build, finished - builder.started),
+        ('build_reused', target, int(bool(builder.reused_from))),
+    ]
+    for stage, seconds in builder.stage_durations.items():
+        samples.append(('stage_duration_seconds', dict(build, stage=stage),
+                        seconds))
+
+    for artifact, size in sorted(builder.get_artifact_sizes().items()):
+        samples.append(('artifact_size_bytes',
+                        dict(target, artifact=artifact), size))
+
+    base_name = builder._get_image_base_name()
+    for compression in builder.compressions:
+        artifact = os.path.basename(compression['file'])[len(base_name):]
+        labels = dict(target, artifact=artifact)
+        samples.append(('compression_duration_seconds', labels,
+                        compression['seconds']))
+        if compression['seconds']:
+            samples.append(('compression_throughput_bytes_per_second',
+                            labels,
+                            compression['size'] / compression['seconds']))
+
+    for cache, statistics in sorted(builder.cache_statistics.items()):
+        for result in ('hits', 'misses'):
+            samples.append(('cache_requests',
+                            dict(target, cache=cache, result=result),
+                            statistics[result]))
+
+        total = statistics['hits'] + statistics['misses']
+        if total:
+            samples.append(('cache_hit_ratio', dict(target, cache=cache),
+                            statistics['hits'] / total))
+
+    return samples
+
+
+def write_textfile(file_name, samples):
+    """Write samples to a file so that it is never collected half written."""
+    with open(file_name + '.partial', 'w') as file_handle:
+        file_handle.write(format_metrics(samples))
+
+    os.rename(file_name + '.partial', file_name)
@@ -0,0 +1,303 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Maintain a local partial Debian mirror with the packages builds need.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import lzma
+import os
+import subprocess
+import urllib.request
+
+from . import builder
+from . import packages
+from . import store
+
+logger = logging.getLogger(__name__)
+
+# Public key with which the mirror's indexes are signed
+KEY_FILE = 'mirror.gpg'
+
+# Architectures, components and packages the mirror was synchronized for
+SYNC_FILE = 'sync.json'
+
+# Kernel installed by vmdebootstrap when no kernel flavor is chosen
+DEFAULT_KERNEL_FLAVORS = {
+    'amd64': 'amd64',
+    'i386': '686',
+    'armel': 'marvell',
+    'armhf': 'armmp',
+    'arm64': 'arm64',
+}
+
+BOOT_LOADER_PACKAGES = {
+    'grub': ['grub-pc'],
+    'u-boot': ['u-boot-tools', 'u-boot'],
+    None: [],
+}
+
+# Packages installed by freedombox-customize and hardware-setup
+CUSTOMIZATION_PACKAGES = [
+    'binutils', 'ca-certificates', 'dpkg-dev', 'flash-kernel',
+    'freedombox-setup', 'gdebi-core', 'git-core', 'kmod', 'u-boot-rpi',
+    'wget'
+]
+
+
+def get_target_packages(builder_class, arguments, customization=True):
+    """Return the names of packages explicitly installed for a target.
+
+    Packages that the customization scripts install only on some machines
+    are included unless customization is False.
+
+    """
+    names = builder.BASE_PACKAGES + \
+        BOOT_LOADER_PACKAGES[getattr(builder_class, 'boot_loader', None)] + \
+        (arguments.package or [])
+    if customization:
+        names += CUSTOMIZATION_PACKAGES
+
+    for variant in arguments.variant or []:
+        names += variant.packages
+
+    if 'btrfs' in (builder_class.root_filesystem_type,
+                   builder_class.boot_filesystem_type):
+        names.append('btrfs-progs')
+
+    flavor = builder_class.kernel_flavor
+    if flavor == 'default':
+        flavor = DEFAULT_KERNEL_FLAVORS[builder_class.architecture]
+
+    if flavor:
+        names.append('linux-image-' + flavor)
+
+    return names
+
+
+def get_target_source_packages(builder_class, arguments):
+    """Return the names of source packages fetched for a target."""
+    names = list(builder_class.source_packages)
+    if arguments.download_source:
+        names += get_target_packages(builder_class, arguments)
+
+    return names
+
+
+class LocalMirror(object):
+    """Partial Debian mirror in a local directory."""
+
+    def __init__(self, directory, distribution):
+        """Initialize the object."""
+        self.directory = os.path.abspath(directory)
+        self.distribution = distribution
+
+    @property
+    def url(self):
+        """Return the URL with which the mirror can be used."""
+        return 'file://' + self.directory
+
+    @property
+    def key_file(self):
+        """Return the path of the key with which the mirror is signed."""
+        return os.path.join(self.directory, KEY_FILE)
+
+    @property
+    def sync_file(self):
+        """Return the path of the record of what the mirror was synced for."""
+        return os.path.join(self.directory, SYNC_FILE)
+
+    def is_synced(self):
+        """Return whether the mirror has been synchronized."""
+        return os.path.isfile(self._get_dists_path('InRelease')) and \
+            os.path.isfile(self.key_file)
+
+    def covers(self, architectures, components, sources=None):
+        """Return whether the mirror was synchronized for a build.
+
+        Architectures and components are given as to sync(). Every
+        architecture and component must have been synchronized, with at
+        least the packages requested now. The mirror carries no source
+        packages and never covers a build that needs any of sources.
+
+        """
+        if sources or not self.is_synced():
+            return False
+
+        try:
+            with open(self.sync_file, 'r') as file_handle:
+                synced = json.load(file_handle)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        if not set(components) <= set(synced['components']):
+            return False
+
+        return all(
+            set(names) <= set(synced['architectures'].get(architecture, []))
+            for architecture, names in architectures.items())
+
+    def sync(self, upstream, architectures, components, cache_directory,
+             key=None):
+        """Download packages needed from upstream mirror and write indexes.
+
+        Architectures are a map of architecture names to the names of
+        packages that must be installable from the mirror for them. Required
+        and important packages, which debootstrap installs, are always
+        included.
+
+        """
+        selected = {}
+        for architecture, names in sorted(architectures.items()):
+            index = packages.PackageIndex.load(
+                upstream, self.distribution, architecture, components,
+                cache_directory)
+            names = sorted(set(names)) + index.get_priority_packages(
+                ('required', 'important'))
+            closure, missing = index.resolve(names)
+            for name in missing:
+                logger.warning('Package not available for %s - %s',
+                               architecture, name)
+
+            logger.info('Resolved %d packages for %s', len(closure),
+                        architecture)
+            selected[architecture] = [index.get(name)
+                                      for name in sorted(closure)]
+
+        upstream = packages.get_mirror_url(upstream)
+        for stanzas in selected.values():
+            for stanza in stanzas:
+                self.download(upstream, stanza)
+
+        self.write_indexes(selected, components)
+        self.sign(key)
+        with open(self.sync_file, 'w') as file_handle:
+            json.dump({
+                'components': components,
+                'architectures': {
+                    architecture: sorted(set(names))
+                    for architecture, names in architectures.items()
+                },
+            }, file_handle, indent=4, sort_keys=True)
+
+    def download(self, upstream, stanza):
+        """Download a package into pool unless it is already present."""
+        path = os.path.join(self.directory, stanza['Filename'])
+        if os.path.isfile(path) and \
+           store.get_file_hash(path) == stanza['SHA256']:
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        url = upstream + '/' + stanza['Filename']
+        logger.info('Downloading - %s', url)
+        with urllib.request.urlopen(url) as response, \
+                open(path + '.partial', 'wb') as file_handle:
+            file_hash = hashlib.sha256()
+            for chunk in iter(lambda: response.read(1024 * 1024), b''):
+                file_hash.update(chunk)
+                file_handle.write(chunk)
+
+        if file_hash.hexdigest() != stanza['SHA256']:
+            os.remove(path + '.partial')
+            raise ValueError('Checksum mismatch for {}'.format(url))
+
+        os.rename(path + '.partial', path)
+
+    def write_indexes(self, selected, components):
+        """Write package lists and the release file of the mirror."""
+        index_files = []
+        for architecture, stanzas in sorted(selected.items()):
+            for component in components:
+                contents = '\n'.join(
+                    packages.format_stanza(stanza) for stanza in stanzas
+                    if packages.get_component(stanza) == component)
+                name = os.path.join(component, 'binary-' + architecture,
+                                    'Packages')
+                os.makedirs(os.path.dirname(self._get_dists_path(name)),
+                            exist_ok=True)
+                contents = contents.encode()
+                for file_name, data in ((name, contents),
+                                        (name + '.xz',
+                                         lzma.compress(contents))):
+                    with open(self._get_dists_path(file_name), 'wb') as \
+                            file_handle:
+                        file_handle.write(data)
+
+                    index_files.append(
+                        (hashlib.sha256(data).hexdigest(), len(data),
+                         file_name))
+
+        date = datetime.datetime.utcnow().strftime(
+            '%a, %d %b %Y %H:%M:%S UTC')
+        release = {
+            'Origin': 'Freedom Maker',
+            'Label': 'Freedom Maker',
+            'Suite': self.distribution,
+            'Codename': self.distribution,
+            'Date': date,
+            'Architectures': ' '.join(sorted(selected)),
+            'Components': ' '.join(components),
+            'SHA256': ''.join('\n{} {:>16} {}'.format(*index_file)
+                              for index_file in index_files),
+        }
+        with open(self._get_dists_path('Release'), 'w') as file_handle:
+            file_handle.write(packages.format_stanza(release))
+
+    def sign(self, key=None):
+        """Sign the release file and export the public key used."""
+        release = self._get_dists_path('Release')
+        options = ['--batch', '--yes']
+        if key:
+            options += ['--local-user', key]
+
+        subprocess.check_call(['gpg'] + options + [
+            '--clearsign', '--output', self._get_dists_path('InRelease'),
+            release
+        ])
+        subprocess.check_call(['gpg'] + options + [
+            '--detach-sign', '--armor', '--output', release + '.gpg', release
+        ])
+
+        # Only the key that signed, not other keys in the keyring
+        signing_key = self._get_signing_key(
+            self._get_dists_path('InRelease'))
+        with open(self.key_file, 'wb') as file_handle:
+            subprocess.check_call(
+                ['gpg', '--batch', '--export', signing_key],
+                stdout=file_handle)
+
+    @staticmethod
+    def _get_signing_key(file_name):
+        """Return fingerprint of the primary key that signed a file."""
+        output = subprocess.check_output(
+            ['gpg', '--batch', '--status-fd', '1', '--verify', file_name],
+            stderr=subprocess.DEVNULL).decode()
+        for line in output.splitlines():
+            fields = line.split()
+            if fields[:2] == ['[GNUPG:]', 'VALIDSIG']:
+                # Primary key fingerprint is last unless signed by it
+                return fields[11] if len(fields) > 11 else fields[2]
+
+        raise ValueError('No valid signature - {}'.format(file_name))
+
+    def _get_dists_path(self, file_name):
+        """Return the path of an index file of the distribution."""
+        return os.path.join(self.directory, 'dists', self.distribution,
+                            file_name)
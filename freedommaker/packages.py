@@ -0,0 +1,383 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Read package indexes of a Debian mirror.
+"""
+
+import collections
+import gzip
+import hashlib
+import io
+import logging
+import lzma
+import os
+import re
+import threading
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# Number of parsed package indexes kept loaded by a process
+LOADED_INDEXES = 16
+
+FREE_COMPONENTS = ['main']
+NONFREE_COMPONENTS = ['main', 'contrib', 'non-free']
+
+
+def get_mirror_url(mirror):
+    """Return URL of a mirror which may also be given as a local directory."""
+    if os.path.isdir(mirror):
+        return 'file://' + os.path.abspath(mirror)
+
+    return mirror.rstrip('/')
+
+
+def parse_stanzas(file_handle):
+    """Iterate over stanzas of a Debian control file as dictionaries."""
+    stanza = {}
+    field = None
+    for line in file_handle:
+        line = line.rstrip('\n')
+        if not line.strip():
+            if stanza:
+                yield stanza
+
+            stanza = {}
+            field = None
+        elif line[0] in ' \t':
+            if field:
+                stanza[field] += '\n' + line.strip()
+        else:
+            field, _, value = line.partition(':')
+            stanza[field] = value.strip()
+
+    if stanza:
+        yield stanza
+
+
+RELEASE_FILES = ['InRelease', 'Release']
+
+# Relationships without which a package can not be installed
+REQUIRED_DEPENDENCY_FIELDS = ['Pre-Depends', 'Depends']
+
+# Relationships that apt follows when installing a package with default
+# settings.
+DEPENDENCY_FIELDS = REQUIRED_DEPENDENCY_FIELDS + ['Recommends']
+
+PACKAGES_FILES = ['Packages.xz', 'Packages.gz', 'Packages']
+
+
+def decompress(file_name, content):
+    """Return decompressed contents of an index file based on its name."""
+    if file_name.endswith('.xz'):
+        return lzma.decompress(content)
+
+    if file_name.endswith('.gz'):
+        return gzip.decompress(content)
+
+    return content
+
+
+def format_stanza(stanza):
+    """Return a stanza of a Debian control file as a string."""
+    lines = []
+    for field, value in stanza.items():
+        separator = ': ' if value and not value.startswith('\n') else ':'
+        lines.append(field + separator + value.replace('\n', '\n '))
+
+    return '\n'.join(lines) + '\n'
+
+
+def parse_relations(value):
+    """Return alternatives of each relation in a dependency field.
+
+    Versions, architecture qualifiers and build profiles are dropped as the
+    mirror only carries a single version of each package.
+
+    """
+    relations = []
+    for relation in value.split(','):
+        alternatives = []
+        for alternative in relation.split('|'):
+            alternative = re.sub(r'\(.*?\)|\[.*?\]|<.*?>', '', alternative)
+            alternative = alternative.strip().split(':')[0]
+            if alternative:
+                alternatives.append(alternative)
+
+        if alternatives:
+            relations.append(alternatives)
+
+    return relations
+
+
+def get_component(stanza):
+    """Return the archive component a package belongs to."""
+    section = stanza.get('Section', '')
+    return section.split('/')[0] if '/' in section else 'main'
+
+
+class IndexCache(object):
+    """Download files from a mirror and keep them in a local cache."""
+
+    def __init__(self, cache_directory):
+        """Initialize the object."""
+        self.cache_directory = cache_directory
+
+    def get_path(self, url):
+        """Return the path in cache for a URL."""
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.cache_directory, name)
+
+    def fetch(self, url):
+        """Download a URL into cache and return its contents."""
+        logger.info('Fetching - %s', url)
+        with urllib.request.urlopen(url) as response:
+            content = response.read()
+
+        path = self.get_path(url)
+        with open(path + '.partial', 'wb') as file_handle:
+            file_handle.write(content)
+
+        os.rename(path + '.partial', path)
+        return content
+
+    def read(self, url):
+        """Return contents of a URL from cache, None if not cached."""
+        try:
+            with open(self.get_path(url), 'rb') as file_handle:
+                return file_handle.read()
+        except FileNotFoundError:
+            return None
+
+    def fetch_first(self, base_url, file_names, offline=False):
+        """Return name and contents of the first available file.
+
+        When offline, only the cache is looked at and (None, None) is returned
+        if none of the files are cached. Otherwise, error of the last file is
+        raised if none could be downloaded.
+
+        """
+        for file_name in file_names:
+            url = base_url + '/' + file_name
+            if offline:
+                content = self.read(url)
+                if content is not None:
+                    return file_name, content
+            else:
+                try:
+                    return file_name, self.fetch(url)
+                except OSError:
+                    if file_name == file_names[-1]:
+                        raise
+
+        return None, None
+
+    def read_first(self, base_url, file_names):
+        """Return name and contents of the first file available in cache."""
+        return self.fetch_first(base_url, file_names, offline=True)
+
+
+class PackageIndex(object):
+    """Binary packages available in a mirror for an architecture."""
+
+    # Parsed indexes of this process keyed by mirror and release file hash,
+    # least recently used first
+    _loaded = collections.OrderedDict()
+    _loaded_lock = threading.Lock()
+
+    def __init__(self, packages=None):
+        """Initialize the object."""
+        self.packages = packages or {}
+        self._providers = None
+
+    @classmethod
+    def load(cls, mirror, distribution, architecture, components,
+             cache_directory, offline=False, statistics=None):
+        """Load index of a mirror, using cached copies when unchanged.
+
+        Mirror's release file is always fetched and package lists are only
+        downloaded again when it has changed. When offline, only cached files
+        are used and None is returned if they are not available.
+
+        If statistics is given, it is a counter of hits and misses of package
+        lists in the cache.
+
+        """
+        if statistics is None:
+            statistics = collections.Counter()
+
+        mirror = get_mirror_url(mirror)
+        cache = IndexCache(cache_directory)
+        dists_url = '{}/dists/{}'.format(mirror, distribution)
+        _, cached_release = cache.read_first(dists_url, RELEASE_FILES)
+        if offline:
+            release = cached_release
+            if release is None:
+                return None
+        else:
+            _, release = cache.fetch_first(dists_url, RELEASE_FILES)
+
+        key = (mirror, distribution, architecture, tuple(components),
+               hashlib.sha256(release).hexdigest())
+        with cls._loaded_lock:
+            if key in cls._loaded:
+                cls._loaded.move_to_end(key)
+                statistics['hits'] += len(components)
+                return cls._loaded[key]
+
+        index = cls()
+        for component in components:
+            packages_url = '{}/{}/binary-{}'.format(dists_url, component,
+                                                    architecture)
+            file_name, content = cache.read_first(packages_url,
+                                                  PACKAGES_FILES)
+            if content is None or release != cached_release:
+                if offline:
+                    return None
+
+                statistics['misses'] += 1
+                file_name, content = cache.fetch_first(packages_url,
+                                                       PACKAGES_FILES)
+            else:
+                statistics['hits'] += 1
+
+            content = decompress(file_name, content).decode('utf-8')
+            index.read(io.StringIO(content))
+
+        with cls._loaded_lock:
+            cls._loaded[key] = index
+            while len(cls._loaded) > LOADED_INDEXES:
+                cls._loaded.popitem(last=False)
+
+        return index
+
+    @classmethod
+    def load_file(cls, file_name):
+        """Load index from a local Packages file, optionally compressed."""
+        openers = {'.xz': lzma.open, '.gz': gzip.open}
+        opener = openers.get(os.path.splitext(file_name)[1], open)
+        index = cls()
+        with opener(file_name, 'rt', encoding='utf-8') as file_handle:
+            index.read(file_handle)
+
+        return index
+
+    def read(self, file_handle):
+        """Add packages from a Packages file to the index."""
+        for stanza in parse_stanzas(file_handle):
+            self.packages[stanza['Package']] = stanza
+
+        self._providers = None
+
+    def get_priority_packages(self, priorities):
+        """Return names of packages with given priorities or essential."""
+        return sorted(
+            name for name, stanza in self.packages.items()
+            if stanza.get('Priority') in priorities or
+            stanza.get('Essential') == 'yes')
+
+    def get_providers(self, name):
+        """Return names of real packages that provide a package name."""
+        if self._providers is None:
+            self._providers = {}
+            for package, stanza in self.packages.items():
+                for alternatives in parse_relations(stanza.get('Provides',
+                                                               '')):
+                    self._providers.setdefault(alternatives[0],
+                                               []).append(package)
+
+        if name in self.packages:
+            return [name]
+
+        return sorted(self._providers.get(name, []))
+
+    def resolve(self, names, fields=None, installed=()):
+        """Return the closure of packages needed to install given packages.
+
+        fields are the relationships followed, DEPENDENCY_FIELDS by default.
+        Among the alternatives and providers of a relation, one that is
+        installed or already selected is preferred, otherwise the first
+        available one is chosen. Return the selected package names and the
+        requested names not available.
+
+        """
+        fields = fields or DEPENDENCY_FIELDS
+        installed = set(installed)
+        selected = set()
+        missing = [name for name in names if not self.get_providers(name)]
+        queue = [[name] for name in names if name not in missing]
+        while queue:
+            providers = [
+                provider for alternative in queue.pop()
+                for provider in self.get_providers(alternative)
+            ]
+            chosen = [
+                provider for provider in providers
+                if provider in selected or provider in installed
+            ] or providers
+            if not chosen or chosen[0] in selected:
+                continue
+
+            name = chosen[0]
+            selected.add(name)
+            stanza = self.packages[name]
+            for field in fields:
+                queue.extend(parse_relations(stanza.get(field, '')))
+
+        return selected, missing
+
+    def get(self, name):
+        """Return the stanza of a package or None if it is not available."""
+        return self.packages.get(name)
+
+    def get_version(self, name):
+        """Return version of a package or None if it is not available."""
+        stanza = self.get(name)
+        return stanza['Version'] if stanza else None
+
+    def get_changes(self, installed_packages):
+        """Return packages whose versions in index differ from installed.
+
+        Installed packages are a map of 'name:architecture' to version.
+        Packages that are not available in the index, such as those
+        installed from custom DEB files, are ignored.
+
+        """
+        changes = {}
+        for package, version in installed_packages.items():
+            name = package.split(':')[0]
+            available = self.get_version(name)
+            if available and available != version:
+                changes[package] = (version, available)
+
+        return changes
+
+    def get_additions(self, names, installed_packages):
+        """Return packages needed to install given ones that are missing.
+
+        The closure of the given packages is compared with installed
+        packages, a map of 'name:architecture' to version. Only required
+        relationships are followed as recommended packages may have been
+        left out. A relation is satisfied by any installed alternative or
+        provider. Return a map of the names of packages not installed to
+        their versions in index.
+
+        """
+        installed = {package.split(':')[0] for package in installed_packages}
+        closure, _ = self.resolve(names, REQUIRED_DEPENDENCY_FIELDS,
+                                  installed)
+        return {name: self.get_version(name) for name in closure - installed}
@@ -0,0 +1,219 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Run the stages of several builds at the same time.
+
+Every target is built in a worker thread that runs the stages of its
+builder one after the other. Before starting a stage, a build waits for a
+slot of that stage, so that while one target is being compressed the next
+one can already be built. There are only as many workers as stages may run
+at the same time, further targets wait for a worker.
+
+After a build fails, no further stages start. When building is
+interrupted, the commands of running stages are stopped as well.
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Number of builds that may run a stage at the same time
+STAGE_LIMITS = {
+    'make_image': 1,
+    'convert': 1,
+    'compress': 2,
+    'sign': 1,
+    'package': 1,
+    'chunk': 1,
+}
+
+
+def parse_stage_limit(value):
+    """Parse a STAGE=COUNT command line value."""
+    try:
+        stage, count = value.split('=')
+        count = int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected STAGE=COUNT, got {}'.format(value))
+
+    if stage not in STAGE_LIMITS:
+        raise argparse.ArgumentTypeError('unknown stage {}, choose from {}'.
+                                         format(stage,
+                                                ', '.join(STAGE_LIMITS)))
+
+    if count < 1:
+        raise argparse.ArgumentTypeError('stage limit must be at least 1')
+
+    return stage, count
+
+
+class Pipeline(object):
+    """Executor of build stages with a concurrency limit per stage."""
+
+    def __init__(self, limits=None, listener=None):
+        """Initialize the object.
+
+        listener, if given, is called with target, stage and state whenever
+        a stage is waiting, started, done, failed or skipped.
+
+        """
+        limits = dict(STAGE_LIMITS, **dict(limits or {}))
+        self.semaphores = {
+            stage: threading.BoundedSemaphore(count)
+            for stage, count in limits.items()
+        }
+        self.workers = sum(limits.values())
+        self.failed = threading.Event()
+        self.builders = set()
+        self.lock = threading.Lock()
+        self.listener = listener
+        self.timeline = []
+        self.started = None
+
+    def run(self, targets, create_builder):
+        """Build all targets, raising the first error after all have ended.
+
+        create_builder is called with a target in the thread that builds
+        the target and returns its builder.
+
+        """
+        self.started = time.time()
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(len(targets),
+                                       self.workers))) as executor:
+            try:
+                futures = [
+                    executor.submit(self.build, target, create_builder)
+                    for target in targets
+                ]
+                for future in futures:
+                    exception = future.exception()
+                    if exception:
+                        errors.append(exception)
+            except BaseException:
+                self.cancel()
+                raise
+            finally:
+                self.report()
+
+        if errors:
+            raise errors[0]
+
+    def build(self, target, create_builder):
+        """Run all stages of a target one after the other."""
+        threading.current_thread().name = target
+        if self.failed.is_set():
+            logger.info('Not building target after failure - %s', target)
+            return
+
+        logger.info('Building target - %s', target)
+        builder = create_builder(target)
+        with self.lock:
+            self.builders.add(builder)
+
+        try:
+            builder.prepare()
+            for stage, function in builder.get_stages():
+                if not self.run_stage(builder, target, stage, function):
+                    logger.info('Stopping target after failure - %s', target)
+                    return
+
+            builder.complete()
+            logger.info('Target complete - %s', target)
+        except BaseException:
+            self.failed.set()
+            builder.fail()
+            logger.error('Target failed - %s', target)
+            raise
+        finally:
+            with self.lock:
+                self.builders.discard(builder)
+
+            builder.cleanup()
+
+    def cancel(self):
+        """Stop all builds, including the commands they are running."""
+        self.failed.set()
+        with self.lock:
+            builders = list(self.builders)
+
+        for builder in builders:
+            builder.cancel()
+
+    def run_stage(self, builder, target, stage, function):
+        """Run a stage once a slot for it is free and record its timing.
+
+        Return False if the stage is skipped because a build failed while
+        waiting for the slot.
+
+        """
+        queued = time.time()
+        self.notify(target, stage, 'waiting')
+        with self.semaphores[stage]:
+            if self.failed.is_set():
+                self.notify(target, stage, 'skipped')
+                return False
+
+            started = time.time()
+            status = 'failed'
+            self.notify(target, stage, 'started')
+            try:
+                builder.run_stage(stage, function)
+                status = 'done'
+            finally:
+                self.notify(target, stage, status)
+                self.timeline.append({
+                    'target': target,
+                    'stage': stage,
+                    'queued': queued - self.started,
+                    'started': started - self.started,
+                    'ended': time.time() - self.started,
+                    'status': status,
+                })
+
+        return True
+
+    def notify(self, target, stage, state):
+        """Tell the listener about progress of a stage."""
+        if self.listener:
+            self.listener(target, stage, state)
+
+    def report(self):
+        """Log when each stage ran and how long it waited for a slot."""
+        if not self.timeline:
+            return
+
+        logger.info('Stage timeline (seconds since start):')
+        width = max(len(entry['target']) for entry in self.timeline)
+        for entry in sorted(self.timeline, key=lambda item: item['started']):
+            logger.info(
+                '  %-*s %-10s %8.1f - %8.1f, waited %6.1f, %s', width,
+                entry['target'], entry['stage'], entry['started'],
+                entry['ended'], entry['started'] - entry['queued'],
+                entry['status'])
+
+        total = time.time() - self.started
+        busy = sum(entry['ended'] - entry['started']
+                   for entry in self.timeline)
+        logger.info('Stages took %.1f seconds in %.1f seconds of building',
+                    busy, total)
@@ -0,0 +1,172 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Plans of builds, showing what they would do without building.
+
+For every target, the builder and its backend compute the commands each
+stage would run and why, from the files in the build directory. No command
+is run, so nothing needs root, loop devices or the network. Stages are then
+laid out the way the pipeline would run them, with durations predicted from
+the build history.
+"""
+
+import heapq
+import json
+import logging
+import os
+import shlex
+import sqlite3
+
+from . import history
+from .builder import ImageBuilder
+from .pipeline import STAGE_LIMITS
+
+logger = logging.getLogger(__name__)
+
+
+def get_target_plan(target, arguments, build_history):
+    """Return the plan of building a target."""
+    cls = ImageBuilder.get_builder_class(target)
+    builder = cls(arguments)
+    try:
+        plan = builder.get_plan()
+    finally:
+        builder.discard()
+
+    estimate = None
+    if os.path.exists(build_history.file_name):
+        try:
+            estimate = build_history.estimate(builder.history_key)
+        except sqlite3.Error as exception:
+            logger.warning('Unable to read build history - %s', exception)
+
+    for stage in plan['stages']:
+        # Stages with nothing to do are over at once
+        stage['seconds'] = (estimate or {}).get(stage['stage']) \
+            if stage['steps'] else 0
+
+    plan.update({
+        'target': target,
+        'builder': cls.__name__,
+        'backend': cls.builder_backend,
+        'artifacts': builder.get_archive_files(),
+    })
+    return plan
+
+
+def schedule(plans, limits=None):
+    """Set when each stage starts and finishes in the pipeline.
+
+    Stages of all targets are started in the order they become ready, each
+    waiting for the earliest free slot of its stage. Stages without a
+    predicted duration are taken to be over at once. Return the time all
+    targets are done.
+
+    """
+    limits = dict(STAGE_LIMITS, **dict(limits or {}))
+    slots = {stage: [0] * count for stage, count in limits.items()}
+    ready = [(0, index, 0) for index in range(len(plans))]
+    heapq.heapify(ready)
+    finished = 0
+    while ready:
+        time, index, position = heapq.heappop(ready)
+        stages = plans[index]['stages']
+        if position == len(stages):
+            finished = max(finished, time)
+            continue
+
+        stage = stages[position]
+        stage_slots = slots.get(stage['stage'])
+        if stage_slots:
+            time = max(time, heapq.heappop(stage_slots))
+
+        stage['start'] = time
+        stage['finish'] = time + (stage['seconds'] or 0)
+        if stage_slots is not None:
+            heapq.heappush(stage_slots, stage['finish'])
+
+        heapq.heappush(ready, (stage['finish'], index, position + 1))
+
+    return finished
+
+
+def get_plan(targets, arguments):
+    """Return the plans of building targets and when they are done."""
+    build_history = history.BuildHistory(arguments.build_dir)
+    plans = [
+        get_target_plan(target, arguments, build_history)
+        for target in targets
+    ]
+    return {
+        'targets': plans,
+        'seconds': schedule(plans, arguments.stage_limit),
+    }
+
+
+def format_command(command):
+    """Return a command as it would be typed in a shell."""
+    return ' '.join(shlex.quote(argument) for argument in command)
+
+
+def format_plan(plan):
+    """Return the plans of building targets as text."""
+    lines = []
+    for target in plan['targets']:
+        lines.append('{} ({}, {} backend)'.format(
+            target['target'], target['builder'], target['backend']))
+        if target['reused_from']:
+            lines.append('  Reusing an earlier build - ' +
+                         target['reuse_reason'])
+        else:
+            lines.append('  Not reusing an earlier build - ' +
+                         target['reuse_reason'])
+
+        for stage in target['stages']:
+            if stage['steps'] and stage['seconds'] is None:
+                duration = 'unknown duration'
+            else:
+                duration = 'about ' + history.format_duration(
+                    stage['seconds'])
+
+            lines.append('  {} at {}, {}: {}'.format(
+                stage['stage'], history.format_duration(stage['start']),
+                duration, stage['reason']))
+            for step in stage['steps']:
+                lines.append('    - ' + step['description'])
+                if step['command']:
+                    lines.append('      $ ' + format_command(step['command']))
+
+            if not stage['steps']:
+                lines.append('    - Nothing to do')
+
+        for artifact in target['artifacts']:
+            lines.append('  Artifact: ' + artifact)
+
+        lines.append('')
+
+    lines.append('All targets done in about ' +
+                 history.format_duration(plan['seconds']))
+    return '\n'.join(lines)
+
+
+def write_plan(plan, output, plan_format='text'):
+    """Write the plans of building targets in a format."""
+    if plan_format == 'json':
+        json.dump(plan, output, indent=4)
+        output.write('\n')
+    else:
+        output.write(format_plan(plan) + '\n')
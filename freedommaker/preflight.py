@@ -0,0 +1,198 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Check that all targets can be built before starting any of the builds.
+"""
+
+import glob
+import logging
+import os
+import shutil
+
+from . import image
+from . import packages
+from .builder import ImageBuilder, parse_size
+from .mirror import get_target_packages
+
+logger = logging.getLogger(__name__)
+
+# Directories with administrator programs that may not be in user's PATH
+SYSTEM_PATHS = ['/usr/local/sbin', '/usr/sbin', '/sbin']
+
+BINFMT_DIRECTORY = '/proc/sys/fs/binfmt_misc'
+
+
+class PreflightError(Exception):
+    """Problems were found that would make builds fail."""
+
+
+def find_tool(tool):
+    """Return whether a program is available on the host."""
+    path = os.pathsep.join([os.environ.get('PATH', os.defpath)] +
+                           SYSTEM_PATHS)
+    return shutil.which(tool, path=path) is not None
+
+
+class Preflight(object):
+    """Quick checks of everything builds need from the host and mirror."""
+
+    def __init__(self, arguments):
+        """Initialize the object."""
+        self.arguments = arguments
+        self.problems = []
+        self.indexes = {}
+
+    def report(self, target, message, *args):
+        """Record a problem found for a target."""
+        self.problems.append((target, message % args))
+
+    def run(self, targets):
+        """Check all targets and raise an error listing every problem."""
+        builder_classes = []
+        for target in targets:
+            cls = ImageBuilder.get_builder_class(target)
+            if cls:
+                builder_classes.append(cls)
+            else:
+                self.report(target, 'Unknown target')
+
+        for cls in builder_classes:
+            self.check_packages(cls)
+            self.check_tools(cls)
+            self.check_emulation(cls)
+
+        self.check_loop_devices()
+        self.check_disk_space(len(builder_classes))
+
+        for target, problem in self.problems:
+            logger.error('Preflight: %s - %s', target, problem)
+
+        if self.problems:
+            raise PreflightError('{} problems found before building'.format(
+                len(self.problems)))
+
+        logger.info('Preflight checks passed')
+
+    def get_index(self, architecture, free):
+        """Return cached package index of the build mirror or None."""
+        components = packages.FREE_COMPONENTS if free \
+            else packages.NONFREE_COMPONENTS
+        key = (architecture, tuple(components))
+        if key not in self.indexes:
+            cache_directory = os.path.join(self.arguments.cache_dir,
+                                           'indexes')
+            self.indexes[key] = packages.PackageIndex.load(
+                self.arguments.build_mirror, self.arguments.distribution,
+                architecture, components, cache_directory, offline=True)
+
+        return self.indexes[key]
+
+    def check_packages(self, cls):
+        """Check that packages and kernel of a target are available."""
+        index = self.get_index(cls.architecture, cls.free)
+        if not index:
+            logger.info('Package index of %s is not cached, not checking '
+                        'packages for %s', self.arguments.build_mirror,
+                        cls.get_target_name())
+            return
+
+        names = get_target_packages(cls, self.arguments, customization=False)
+        for name in sorted(set(names)):
+            if not index.get_providers(name):
+                self.report(cls.get_target_name(),
+                            'Package %s not available for %s in %s', name,
+                            cls.architecture, self.arguments.build_mirror)
+
+        for package in self.arguments.custom_package or []:
+            if not os.path.isfile(package):
+                self.report(cls.get_target_name(),
+                            'Custom package %s does not exist', package)
+
+    def check_tools(self, cls):
+        """Check that the programs used to build a target are installed."""
+        for tool in cls.get_required_tools(self.arguments):
+            if not find_tool(tool):
+                self.report(cls.get_target_name(), 'Program %s not found',
+                            tool)
+
+    def check_emulation(self, cls):
+        """Check that foreign binaries can be run in the chroot."""
+        if cls.architecture in ('i386', 'amd64'):
+            return
+
+        entries = glob.glob(os.path.join(BINFMT_DIRECTORY, 'qemu-arm*'))
+        for entry in entries:
+            with open(entry, 'r') as file_handle:
+                contents = file_handle.read()
+
+            if contents.startswith('enabled') and image.EMULATOR in contents:
+                return
+
+        self.report(cls.get_target_name(),
+                    'binfmt_misc is not setup to run %s binaries with %s',
+                    cls.architecture, image.EMULATOR)
+
+    def check_loop_devices(self):
+        """Check that a loop device can be found for building."""
+        if os.path.exists('/dev/loop-control'):
+            return
+
+        free = [
+            device for device in glob.glob('/sys/block/loop*')
+            if not os.path.exists(os.path.join(device, 'loop',
+                                               'backing_file'))
+        ]
+        if len(free) < 2:
+            self.report('host', 'Not enough free loop devices, %d available',
+                        len(free))
+
+    def check_disk_space(self, targets):
+        """Check that there is space for the images of all targets."""
+        image_size = parse_size(self.arguments.image_size)
+        images = targets * (1 + len(self.arguments.variant or []))
+        statistics = os.statvfs(self.arguments.build_dir)
+        available = statistics.f_bavail * statistics.f_frsize
+        if available < image_size * images:
+            self.report('host', 'Only %d MiB free in %s, %d images need %d '
+                        'MiB', available // 1024**2, self.arguments.build_dir,
+                        images, image_size * images // 1024**2)
+
+        if self.arguments.build_in_ram and self.arguments.ram_disk == 'tmpfs':
+            memory = self._get_available_memory()
+            if memory is not None and memory < image_size:
+                self.report('host', 'Only %d MiB of memory available, image '
+                            'needs %d MiB', memory // 1024**2,
+                            image_size // 1024**2)
+
+            memory_limit = self.arguments.memory_limit
+            if memory_limit and memory_limit <= image_size:
+                self.report('host', 'Memory limit of %d MiB leaves no room '
+                            'for building besides the image of %d MiB',
+                            memory_limit // 1024**2, image_size // 1024**2)
+
+    @staticmethod
+    def _get_available_memory():
+        """Return the memory available on the host in bytes."""
+        try:
+            with open('/proc/meminfo', 'r') as file_handle:
+                for line in file_handle:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except FileNotFoundError:
+            pass
+
+        return None
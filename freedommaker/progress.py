@@ -0,0 +1,265 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Follow progress of builds from output of the programs they run.
+
+Output of vmdebootstrap, debootstrap, apt, dpkg and the customization script
+is parsed into a phase with counts of packages or bytes done. A line for each
+running target is drawn on the terminal below log messages.
+"""
+
+import collections
+import re
+import shutil
+import threading
+import time
+
+from .history import format_duration
+
+# Seconds between redraws of the progress lines
+REDRAW_INTERVAL = 0.5
+
+# Messages of vmdebootstrap and the section of the build they start
+VMDEBOOTSTRAP_SECTIONS = [
+    ('Creating disk image', 'create image'),
+    ('Creating partitions', 'partition'),
+    ('Creating filesystem', 'make filesystem'),
+    ('Debootstrapping', 'debootstrap'),
+    ('Running customize script', 'customize'),
+    ('Installing extlinux', 'install boot loader'),
+    ('Installing GRUB', 'install boot loader'),
+    ('Cleaning up', 'clean up'),
+]
+
+# Customization script markers, not the 'set -x' trace of the echo
+CUSTOMIZE_PHASE = re.compile(r'^info: phase - (\S+)$')
+
+DEBOOTSTRAP_RETRIEVE = re.compile(r'^I: Retrieving \S+ \S+$')
+DEBOOTSTRAP_EXTRACT = re.compile(r'^I: Extracting \S+\.\.\.$')
+DEBOOTSTRAP_UNPACK = re.compile(r'^I: Unpacking \S+\.\.\.$')
+DEBOOTSTRAP_CONFIGURE = re.compile(r'^I: Configuring \S+\.\.\.$')
+
+APT_SUMMARY = re.compile(r'^(\d+) upgraded, (\d+) newly installed')
+APT_NEED = re.compile(r'^Need to get ([\d.,]+ [kMG]?B)[ /]')
+APT_GET = re.compile(r'^Get:\d+ .* \[([\d.,]+ [kMG]?B)\]$')
+DPKG_UNPACK = re.compile(r'^Unpacking \S+ ')
+DPKG_SETUP = re.compile(r'^Setting up \S+ ')
+
+APT_UNITS = {'B': 1, 'kB': 1000, 'MB': 1000**2, 'GB': 1000**3}
+
+
+def parse_apt_size(size):
+    """Return the number of bytes of a size printed by apt."""
+    number, unit = size.split()
+    return int(float(number.replace(',', '')) * APT_UNITS[unit])
+
+
+class ProgressParser(object):
+    """Phase and progress of a program read from its output.
+
+    The section is the part of the build announced by vmdebootstrap or the
+    customization script. The phase is the work of debootstrap, apt or dpkg
+    within it that packages or bytes are counted for.
+
+    """
+
+    def __init__(self):
+        """Initialize the object."""
+        self.section = None
+        self.phase = None
+        self.done = 0
+        self.total = None
+        self.bytes_done = 0
+        self.bytes_total = None
+        self.phase_started = time.monotonic()
+        self.retrieved_packages = 0
+        self.apt_packages = None
+
+    def get_name(self):
+        """Return the section and phase being run."""
+        return ' / '.join(name for name in (self.section, self.phase) if name)
+
+    def feed(self, line):
+        """Update progress from a line of output.
+
+        Return whether a new section or phase started.
+
+        """
+        line = line.strip()
+        for message, section in VMDEBOOTSTRAP_SECTIONS:
+            if line.startswith(message):
+                return self._start_section(section)
+
+        match = CUSTOMIZE_PHASE.match(line)
+        if match:
+            return self._start_section('customize ' + match.group(1))
+
+        if DEBOOTSTRAP_RETRIEVE.match(line):
+            self.retrieved_packages += 1
+            return self._count('debootstrap retrieve')
+
+        if DEBOOTSTRAP_EXTRACT.match(line):
+            return self._count('debootstrap extract', self.retrieved_packages)
+
+        if DEBOOTSTRAP_UNPACK.match(line):
+            return self._count('debootstrap unpack')
+
+        if DEBOOTSTRAP_CONFIGURE.match(line):
+            return self._count('debootstrap configure')
+
+        match = APT_SUMMARY.match(line)
+        if match:
+            self.apt_packages = int(match.group(1)) + int(match.group(2))
+            self.bytes_total = None
+            return False
+
+        match = APT_NEED.match(line)
+        if match:
+            self.bytes_total = parse_apt_size(match.group(1))
+            return False
+
+        match = APT_GET.match(line)
+        if match:
+            changed = self._count('apt download', self.apt_packages)
+            self.bytes_done += parse_apt_size(match.group(1))
+            return changed
+
+        if DPKG_UNPACK.match(line):
+            return self._count('dpkg unpack', self.apt_packages)
+
+        if DPKG_SETUP.match(line):
+            return self._count('dpkg set up', self.apt_packages)
+
+        return False
+
+    def _start_section(self, section):
+        """Start a section of the build, return whether it is new."""
+        if section == self.section:
+            return False
+
+        self.section = section
+        self._start_phase(None, None)
+        return True
+
+    def _count(self, phase, total=None):
+        """Count a package done in a phase, return whether phase is new."""
+        changed = phase != self.phase
+        if changed:
+            self._start_phase(phase, total)
+
+        self.done += 1
+        return changed
+
+    def _start_phase(self, phase, total):
+        """Reset the counts for a new phase."""
+        self.phase = phase
+        self.done = 0
+        self.total = total
+        self.bytes_done = 0
+        self.phase_started = time.monotonic()
+
+    def get_status(self, now=None):
+        """Return a short description of the progress of the phase."""
+        parts = [self.get_name()]
+        if not self.phase:
+            return parts[0]
+
+        elapsed = (now or time.monotonic()) - self.phase_started
+        if self.phase == 'apt download' and self.bytes_total:
+            done, total = self.bytes_done, self.bytes_total
+            parts.append('{}/{} MiB'.format(done // 1024**2,
+                                            total // 1024**2))
+            rate = done / elapsed if elapsed > 0 else 0
+            rate_text = '{:.1f} MiB/s'.format(rate / 1024**2)
+        else:
+            done, total = self.done, self.total
+            parts.append('{}/{}'.format(done, total or '?'))
+            rate = done / elapsed if elapsed > 0 else 0
+            rate_text = '{:.1f}/s'.format(rate)
+
+        if total:
+            parts.append('{:.0%}'.format(min(done / total, 1)))
+
+        parts.append(rate_text)
+        if total and rate and done < total:
+            parts.append('ETA ' + format_duration((total - done) / rate))
+
+        return ' '.join(parts)
+
+
+class ProgressDisplay(object):
+    """Progress lines of running targets drawn below log messages.
+
+    The display is also the stream of the console log handler, so that log
+    messages are written above the progress lines instead of through them.
+
+    """
+
+    def __init__(self, stream, interval=REDRAW_INTERVAL):
+        """Initialize the object."""
+        self.stream = stream
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.statuses = collections.OrderedDict()
+        self.lines_drawn = 0
+        self.last_drawn = 0
+
+    def update(self, target, status):
+        """Set the progress line of a target, removing it if status is None.
+
+        Redraws are limited to one every interval.
+
+        """
+        with self.lock:
+            if status is None:
+                self.statuses.pop(target, None)
+            else:
+                self.statuses[target] = status
+                if time.monotonic() - self.last_drawn < self.interval:
+                    return
+
+            self._clear()
+            self._draw()
+            self.stream.flush()
+
+    def write(self, text):
+        """Write text above the progress lines."""
+        with self.lock:
+            self._clear()
+            self.stream.write(text)
+            if text.endswith('\n'):
+                self._draw()
+
+    def flush(self):
+        """Flush the underlying stream."""
+        self.stream.flush()
+
+    def _clear(self):
+        """Erase the progress lines drawn."""
+        if self.lines_drawn:
+            self.stream.write('\r\033[{}A\033[J'.format(self.lines_drawn))
+            self.lines_drawn = 0
+
+    def _draw(self):
+        """Draw the progress lines, each cut to the width of the terminal."""
+        width = shutil.get_terminal_size().columns - 1
+        for target, status in self.statuses.items():
+            line = '{}: {}'.format(target, status)
+            self.stream.write(line[:width] + '\n')
+
+        self.lines_drawn = len(self.statuses)
+        self.last_drawn = time.monotonic()
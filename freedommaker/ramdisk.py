@@ -0,0 +1,156 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+File systems in RAM to build images in.
+"""
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+ZRAM_CONTROL = '/sys/class/zram-control'
+
+# Fast compressors in the order of preference
+ZRAM_ALGORITHMS = ['lz4', 'lzo-rle', 'lzo']
+
+# Room on tmpfs besides the image, as a fraction of its size, for file system
+# overhead and files written next to it
+TMPFS_HEADROOM = 0.1
+
+
+def get_ram_disk_class(kind):
+    """Return the RAM disk class for a --ram-disk choice."""
+    return {'tmpfs': TmpfsRamDisk, 'zram': ZramRamDisk}[kind]
+
+
+class TmpfsRamDisk(object):
+    """tmpfs that holds files uncompressed in RAM."""
+
+    def __init__(self, builder, size):
+        """Initialize the object."""
+        self.builder = builder
+        self.size = size
+        self.directory = None
+
+    def mount(self, directory):
+        """Mount the file system at a directory."""
+        size = int(self.size * (1 + TMPFS_HEADROOM))
+        self.builder._run([
+            'sudo', 'mount', '-t', 'tmpfs', '-o', 'size={}'.format(size),
+            'tmpfs', directory
+        ])
+        self.directory = directory
+
+    def unmount(self):
+        """Unmount the file system, freeing the RAM it used."""
+        if self.directory is None:
+            return
+
+        self.builder._run(['sudo', 'umount', self.directory])
+        self.directory = None
+
+    def get_statistics(self):
+        """Return the memory used by compressed RAM disks, None otherwise."""
+        return None
+
+
+class ZramRamDisk(TmpfsRamDisk):
+    """File system on a compressed RAM block device.
+
+    Zero filled and unused parts of the image take almost no memory and the
+    rest is compressed with a fast compressor.
+
+    """
+
+    def __init__(self, builder, size):
+        """Initialize the object."""
+        super().__init__(builder, size)
+        self.device = None
+
+    def mount(self, directory):
+        """Create a zram device, make a file system on it and mount it."""
+        self.builder._run(['sudo', 'modprobe', 'zram'])
+        self.device = 'zram' + self.builder._run_output(
+            ['sudo', 'cat', os.path.join(ZRAM_CONTROL, 'hot_add')]).strip()
+        try:
+            self._setup(directory)
+        except BaseException:
+            self.unmount()
+            raise
+
+        logger.info('Mounted /dev/%s using %s compression at %s',
+                    self.device, self._read('comp_algorithm'), directory)
+
+    def _setup(self, directory):
+        """Make a file system on the zram device and mount it."""
+        algorithms = self._read('comp_algorithm').replace('[', '').replace(
+            ']', '').split()
+        for algorithm in ZRAM_ALGORITHMS:
+            if algorithm in algorithms:
+                self._write('comp_algorithm', algorithm)
+                break
+
+        # Unused space on the device takes no memory, leave plenty for file
+        # system overhead.
+        self._write('disksize', self.size * 2)
+        device = '/dev/' + self.device
+        self.builder._run([
+            'sudo', 'mkfs.ext4', '-q', '-m', '0', '-E',
+            'lazy_itable_init=0,lazy_journal_init=0,nodiscard', device
+        ])
+        self.builder._run(
+            ['sudo', 'mount', '-o', 'discard', device, directory])
+        self.directory = directory
+        self.builder._run(['sudo', 'chmod', '1777', directory])
+
+    def unmount(self):
+        """Unmount the file system and remove the zram device."""
+        super().unmount()
+        if self.device is None:
+            return
+
+        self._write('reset', 1)
+        self.builder._run([
+            'sudo', 'sh', '-c', 'echo "$1" > "$0"',
+            os.path.join(ZRAM_CONTROL, 'hot_remove'), self.device[len('zram'):]
+        ])
+        self.device = None
+
+    def get_statistics(self):
+        """Return the memory used by the device in bytes."""
+        fields = [int(field) for field in self._read('mm_stat').split()]
+        original, compressed, _, _, peak = fields[:5]
+        return {
+            'original': original,
+            'compressed': compressed,
+            'ratio': original / compressed if compressed else 0,
+            'peak': peak,
+        }
+
+    def _read(self, attribute):
+        """Return the value of an attribute of the device."""
+        with open(os.path.join('/sys/block', self.device, attribute),
+                  'r') as file_handle:
+            return file_handle.read().strip()
+
+    def _write(self, attribute, value):
+        """Set an attribute of the device."""
+        self.builder._run([
+            'sudo', 'sh', '-c', 'echo "$1" > "$0"',
+            os.path.join('/sys/block', self.device, attribute), str(value)
+        ])
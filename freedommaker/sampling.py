@@ -0,0 +1,265 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Sample resources used by a build and attribute them to its steps.
+
+CPU time, memory and I/O of the commands a builder runs are read from /proc
+for commands that are running and from resource usage of commands that have
+exited. Network traffic of the host and statistics of the build's cgroup are
+recorded alongside. Every sample is attributed to the stage and command that
+the builder is executing when it is taken.
+"""
+
+import collections
+import csv
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Programs that only run another command given after their options
+WRAPPERS = ['sudo', 'env', 'nice', 'ionice']
+
+COUNTERS = [
+    'cpu_seconds', 'read_bytes', 'write_bytes', 'net_rx_bytes',
+    'net_tx_bytes', 'cgroup_read_bytes', 'cgroup_write_bytes'
+]
+
+COLUMNS = ['time', 'stage', 'command'] + COUNTERS + [
+    'rss_bytes', 'cgroup_memory_bytes'
+]
+
+
+def get_command_name(command):
+    """Return the name of the program a command runs, skipping wrappers."""
+    words = list(command)
+    while words:
+        name = os.path.basename(words.pop(0))
+        if name in WRAPPERS:
+            while words and (words[0].startswith('-') or '=' in words[0]):
+                words.pop(0)
+        elif name == 'taskset':
+            while words and words[0].startswith('-'):
+                words.pop(0)
+
+            del words[:1]
+        elif name == 'sh' and words[:1] == ['-c'] and \
+                len(words) > 2 and 'exec "$@"' in words[1]:
+            del words[:3]
+        else:
+            return name
+
+    return None
+
+
+def read_process(pid):
+    """Return CPU seconds, RSS and I/O bytes of a process and parent PID.
+
+    CPU time includes children that the process has waited for.
+
+    """
+    with open('/proc/{}/stat'.format(pid), 'r') as file_handle:
+        # Process name may contain spaces and parentheses
+        fields = file_handle.read().rsplit(')', 1)[1].split()
+
+    usage = {
+        'ppid': int(fields[1]),
+        'cpu_seconds': sum(int(field) for field in fields[11:15]) /
+        CLOCK_TICKS,
+        'rss_bytes': int(fields[21]) * PAGE_SIZE,
+        'read_bytes': 0,
+        'write_bytes': 0,
+    }
+    try:
+        with open('/proc/{}/io'.format(pid), 'r') as file_handle:
+            for line in file_handle:
+                key, value = line.split(':')
+                if key in ('read_bytes', 'write_bytes'):
+                    usage[key] = int(value)
+    except (PermissionError, FileNotFoundError):
+        # Commands run as root can't be inspected by other users
+        pass
+
+    return usage
+
+
+def get_processes():
+    """Return usage of all processes on the host keyed by PID."""
+    processes = {}
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                processes[int(name)] = read_process(name)
+            except (FileNotFoundError, ProcessLookupError, IndexError):
+                pass
+
+    return processes
+
+
+def get_network_bytes():
+    """Return bytes received and sent on all interfaces except loopback."""
+    received, sent = 0, 0
+    with open('/proc/net/dev', 'r') as file_handle:
+        for line in file_handle.readlines()[2:]:
+            interface, fields = line.split(':', 1)
+            if interface.strip() != 'lo':
+                fields = fields.split()
+                received += int(fields[0])
+                sent += int(fields[8])
+
+    return received, sent
+
+
+class ResourceSampler(object):
+    """Thread sampling resources used by the commands of a builder."""
+
+    def __init__(self, builder, interval):
+        """Initialize the object."""
+        self.builder = builder
+        self.interval = interval
+        self.samples = []
+        self.summary = collections.OrderedDict()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self._baseline = None
+        self._previous = None
+
+    def start(self):
+        """Start sampling in the background."""
+        self._started = time.time()
+        self._baseline = self.read()
+        self._previous = dict(self._baseline)
+        self._thread = threading.Thread(
+            target=self._sample_loop, daemon=True,
+            name='sampler-' + threading.current_thread().name)
+        self._thread.start()
+        self.builder.threads.add(self._thread.ident)
+
+    def stop(self):
+        """Stop sampling after taking a last sample."""
+        if not self._thread:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self.builder.threads.discard(self._thread.ident)
+        self._thread = None
+        self.sample()
+
+    def read(self):
+        """Return cumulative counters and current memory of the build."""
+        usage = {key: 0 for key in COUNTERS}
+        usage.update(self.builder.finished_usage)
+        usage['rss_bytes'] = 0
+
+        processes = get_processes()
+        children = collections.defaultdict(list)
+        for pid, process in processes.items():
+            children[process['ppid']].append(pid)
+
+        pids = list(self.builder.running_commands)
+        while pids:
+            pid = pids.pop()
+            process = processes.get(pid)
+            if not process:
+                continue
+
+            for key in ('cpu_seconds', 'read_bytes', 'write_bytes'):
+                usage[key] += process[key]
+
+            usage['rss_bytes'] += process['rss_bytes']
+            # Children that were waited for are counted in their parent
+            pids.extend(children[pid])
+
+        usage['net_rx_bytes'], usage['net_tx_bytes'] = get_network_bytes()
+        usage['cgroup_memory_bytes'] = 0
+        if self.builder.cgroup:
+            cgroup_usage = self.builder.cgroup.get_usage()
+            usage['cgroup_read_bytes'] = cgroup_usage['io_rbytes']
+            usage['cgroup_write_bytes'] = cgroup_usage['io_wbytes']
+            usage['cgroup_memory_bytes'] = cgroup_usage.get('memory_peak', 0)
+
+        return usage
+
+    def sample(self):
+        """Record a sample and attribute it to the current step."""
+        usage = self.read()
+        now = time.time()
+        stage = self.builder.current_stage or ''
+        command = self.builder.current_command or ''
+        sample = {'time': round(now - self._started, 1), 'stage': stage,
+                  'command': command}
+        for key in COUNTERS:
+            sample[key] = max(0, usage[key] - self._baseline[key])
+
+        sample['rss_bytes'] = usage['rss_bytes']
+        sample['cgroup_memory_bytes'] = usage['cgroup_memory_bytes']
+        self.samples.append(sample)
+
+        step = self.summary.setdefault((stage, command), {
+            'seconds': 0,
+            'rss_bytes': 0,
+            **{key: 0 for key in COUNTERS}
+        })
+        step['seconds'] += now - self._previous.get('time', self._started)
+        for key in COUNTERS:
+            step[key] += max(0, usage[key] - self._previous[key])
+
+        step['rss_bytes'] = max(step['rss_bytes'], usage['rss_bytes'])
+        self._previous = dict(usage, time=now)
+
+    def write(self, file_name):
+        """Write the samples as CSV time series."""
+        with open(file_name, 'w') as file_handle:
+            writer = csv.DictWriter(file_handle, COLUMNS)
+            writer.writeheader()
+            for sample in self.samples:
+                writer.writerow({
+                    key: round(value, 2) if isinstance(value, float) else value
+                    for key, value in sample.items()
+                })
+
+    def log_summary(self, log):
+        """Log a table of resources used by each step of the build."""
+        log.info('Resources used by step:')
+        log.info('  %-10s %-16s %8s %6s %9s %9s %9s %9s %9s', 'stage',
+                 'command', 'seconds', 'CPU%', 'RSS MiB', 'read MiB',
+                 'write MiB', 'cg w MiB', 'net MiB')
+        mib = 1024**2
+        for (stage, command), step in self.summary.items():
+            log.info(
+                '  %-10s %-16s %8.1f %6.0f %9.0f %9.0f %9.0f %9.0f %9.0f',
+                stage or '-', command or '-', step['seconds'],
+                100 * step['cpu_seconds'] / step['seconds']
+                if step['seconds'] else 0, step['rss_bytes'] / mib,
+                step['read_bytes'] / mib, step['write_bytes'] / mib,
+                step['cgroup_write_bytes'] / mib,
+                (step['net_rx_bytes'] + step['net_tx_bytes']) / mib)
+
+    def _sample_loop(self):
+        """Take samples until stopped."""
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except OSError as exception:
+                logger.warning('Unable to sample resources - %s', exception)
@@ -0,0 +1,287 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Content-addressed store of built files.
+
+Files built are added to the store under the sha256 hash of their contents
+and their names in the build directory become hard links to the stored
+file, so identical files of different builds take space once. Where hard
+links are not possible, such as across file systems, files are stored as
+reflinks where the file system supports it and as copies otherwise. The
+names in build directories are then replaced with reflinks to the stored
+files if possible. Either way, their device and inode are recorded so that
+they are removed with the stored file.
+
+An SQLite database next to the stored files records the target, build stamp
+and fingerprint of the inputs of every file name published, and when each
+stored file was last used. When the store grows beyond a quota, the least
+recently used files are removed along with their names in build
+directories, except for those of pinned build stamps such as releases.
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import sqlite3
+import subprocess
+import time
+
+DATABASE_NAME = 'store.sqlite3'
+
+OBJECTS_DIRECTORY = 'objects'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    added REAL NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_inode ON objects (device, inode);
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL REFERENCES objects (hash),
+    target TEXT NOT NULL,
+    build_stamp TEXT NOT NULL,
+    fingerprint TEXT,
+    published REAL NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_hash ON artifacts (hash);
+CREATE TABLE IF NOT EXISTS pins (
+    build_stamp TEXT PRIMARY KEY,
+    pinned REAL NOT NULL
+);
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def get_file_hash(file_name):
+    """Return the sha256 hash of a file's contents."""
+    file_hash = hashlib.sha256()
+    with open(file_name, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def link(source, destination):
+    """Hard link a file, or copy it sharing blocks where possible."""
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        subprocess.check_call([
+            'cp', '--reflink=auto', '--sparse=always', source, destination
+        ])
+
+
+def reflink(source, destination):
+    """Copy a file sharing all its blocks, return whether it was possible."""
+    try:
+        subprocess.check_call(['cp', '--reflink=always', source, destination],
+                              stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(destination)
+
+        return False
+
+    return True
+
+
+class ArtifactStore(object):
+    """Directory of built files named by their content."""
+
+    def __init__(self, directory):
+        """Initialize the object."""
+        self.directory = directory
+        self.file_name = os.path.join(directory, DATABASE_NAME)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Return a connection to the database committing on success."""
+        os.makedirs(self.directory, exist_ok=True)
+        connection = sqlite3.connect(self.file_name, timeout=60)
+        try:
+            connection.executescript(SCHEMA)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_object_file(self, file_hash):
+        """Return the path of the stored file with a hash."""
+        return os.path.join(self.directory, OBJECTS_DIRECTORY, file_hash[:2],
+                            file_hash)
+
+    def publish(self, path, target, build_stamp, fingerprint=None,
+                checksum=None):
+        """Add a built file to the store and return its hash.
+
+        If the store already has the contents, the file is replaced with a
+        link to the stored file. A file that is already a link to a stored
+        file is not hashed again. checksum, if given, is the known sha256
+        hash of the file.
+
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.connect() as connection:
+            row = connection.execute(
+                'SELECT hash FROM objects WHERE device = ? AND inode = ?',
+                (stat.st_dev, stat.st_ino)).fetchone()
+
+        file_hash = row[0] if row else checksum or get_file_hash(path)
+        object_file = self.get_object_file(file_hash)
+        os.makedirs(os.path.dirname(object_file), exist_ok=True)
+        with contextlib.suppress(FileExistsError):
+            link(path, object_file)
+
+        if not os.path.samefile(path, object_file):
+            try:
+                os.link(object_file, path + '.store')
+                shared = True
+            except OSError:
+                # Store is on another file system
+                shared = reflink(object_file, path + '.store')
+
+            if shared:
+                logger.info('Sharing contents of %s with stored file %s',
+                            path, object_file)
+                os.replace(path + '.store', path)
+            else:
+                logger.info('Keeping copy of stored file %s - %s',
+                            object_file, path)
+
+        path_stat = os.stat(path)
+        stat = os.stat(object_file)
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO objects (hash, size, device, inode, '
+                'added, used) VALUES (?, ?, ?, ?, ?, ?)',
+                (file_hash, stat.st_blocks * 512, stat.st_dev, stat.st_ino,
+                 now, now))
+            connection.execute('UPDATE objects SET used = ? WHERE hash = ?',
+                               (now, file_hash))
+            connection.execute(
+                'INSERT OR REPLACE INTO artifacts (path, hash, target, '
+                'build_stamp, fingerprint, published, device, inode) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, file_hash, target, build_stamp, fingerprint, now,
+                 path_stat.st_dev, path_stat.st_ino))
+
+        return file_hash
+
+    def pin(self, build_stamp):
+        """Protect files of a build stamp from being evicted."""
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO pins (build_stamp, pinned) '
+                'VALUES (?, ?)', (build_stamp, time.time()))
+
+    def unpin(self, build_stamp):
+        """Let files of a build stamp be evicted again."""
+        with self.connect() as connection:
+            connection.execute('DELETE FROM pins WHERE build_stamp = ?',
+                               (build_stamp, ))
+
+    def get_pins(self):
+        """Return the pinned build stamps."""
+        with self.connect() as connection:
+            return [
+                build_stamp for build_stamp, in connection.execute(
+                    'SELECT build_stamp FROM pins ORDER BY build_stamp')
+            ]
+
+    def get_size(self):
+        """Return the bytes of disk used by stored files."""
+        with self.connect() as connection:
+            return connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+
+    def evict(self, quota):
+        """Remove least recently used files until the store fits a quota.
+
+        Names of an evicted file in build directories are removed too, as
+        the space is only freed with the last link, and so are copies of it
+        made where names could not be linked. Files of pinned build
+        stamps are kept even if the store remains over quota. Return the
+        hashes of evicted files.
+
+        """
+        evicted = []
+        with self.connect() as connection:
+            size = connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+            candidates = connection.execute(
+                'SELECT hash, size FROM objects WHERE hash NOT IN ('
+                'SELECT hash FROM artifacts JOIN pins USING (build_stamp)) '
+                'ORDER BY used').fetchall()
+            for file_hash, object_size in candidates:
+                if size <= quota:
+                    break
+
+                artifacts = connection.execute(
+                    'SELECT path, device, inode FROM artifacts '
+                    'WHERE hash = ?', (file_hash, )).fetchall()
+                self._remove(file_hash, artifacts)
+                connection.execute('DELETE FROM artifacts WHERE hash = ?',
+                                   (file_hash, ))
+                connection.execute('DELETE FROM objects WHERE hash = ?',
+                                   (file_hash, ))
+                size -= object_size
+                evicted.append(file_hash)
+
+        if size > quota:
+            logger.warning('Artifact store is over quota with pinned builds '
+                           '- %d MiB', size // 1024**2)
+
+        return evicted
+
+    def _remove(self, file_hash, artifacts):
+        """Remove a stored file and its names in build directories.
+
+        artifacts are the paths of names with their device and inode. A
+        name that is not a link to the stored file is only removed if it is
+        still the copy that was published, the inode of which may have been
+        reused for another file since.
+
+        """
+        object_file = self.get_object_file(file_hash)
+        for path, device, inode in artifacts:
+            # A later build may have replaced the name with another file
+            with contextlib.suppress(FileNotFoundError):
+                stat = os.stat(path)
+                if os.path.samefile(path, object_file) or \
+                   ((stat.st_dev, stat.st_ino) == (device, inode) and
+                        get_file_hash(path) == file_hash):
+                    logger.info('Evicting artifact - %s', path)
+                    os.remove(path)
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path + '.sha256')
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(object_file)
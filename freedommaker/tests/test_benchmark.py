@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for benchmarks with synthetic images.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from freedommaker import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    """Tests for benchmarks with synthetic images."""
+
+    def test_sparse_image(self):
+        """Test that images are written with holes and are reproducible."""
+        with tempfile.TemporaryDirectory() as directory:
+            file_names = [os.path.join(directory, name)
+                          for name in ('first.img', 'second.img')]
+            for file_name in file_names:
+                written = benchmark.write_sparse_image(file_name, 16 * 1024**2,
+                                                       0.5)
+
+            self.assertEqual(written % benchmark.CHUNK_SIZE, 0)
+            self.assertLess(written, 16 * 1024**2)
+            self.assertEqual(os.path.getsize(file_names[0]), 16 * 1024**2)
+            self.assertLessEqual(benchmark.get_allocated_size(file_names[0]),
+                                 written + benchmark.CHUNK_SIZE)
+            contents = []
+            for file_name in file_names:
+                with open(file_name, 'rb') as file_handle:
+                    contents.append(file_handle.read())
+
+            self.assertEqual(contents[0], contents[1])
+
+    def test_run(self):
+        """Test running the benchmarks with a stub build of a target."""
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            benchmark.main([
+                '--image-size', '4M', '--density', '0.5', '--repeat', '1',
+                '--target', 'amd64', '--work-dir', directory, '--output',
+                output
+            ])
+            with open(output, 'r') as file_handle:
+                report = json.load(file_handle)
+
+        self.assertEqual(report['image_size'], 4 * 1024**2)
+        results = {result['name']: result for result in report['results']}
+        for name in ('scheduler', 'build', 'build_skip',
+                     'previous_build_lookup', 'compress:xz',
+                     'checksum:sha256', 'copy:sparse'):
+            self.assertIn('seconds', results[name])
+
+        self.assertEqual(results['scheduler']['stages'],
+                         benchmark.SCHEDULER_TARGETS *
+                         len(benchmark.SCHEDULER_STAGES))
+        self.assertTrue(results['previous_build_lookup']['found'])
+        self.assertGreater(results['compress:xz']['ratio'], 1)
+        self.assertLess(results['copy:sparse']['allocated_bytes'],
+                        results['copy:full']['allocated_bytes'])
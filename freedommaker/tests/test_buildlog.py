@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for logs of builds split by phase.
+"""
+
+import json
+import logging
+import lzma
+import os
+import subprocess
+import tempfile
+import unittest
+
+from freedommaker import buildlog
+
+
+class TestBuildLog(unittest.TestCase):
+    """Tests for logs of builds split by phase."""
+
+    def setUp(self):
+        """Create a build log in a temporary directory."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_directory = os.path.join(self.directory.name, 'amd64.logs')
+        self.build_log = buildlog.BuildLog(self.log_directory, tail_lines=2)
+
+    def tearDown(self):
+        """Remove the build log."""
+        self.directory.cleanup()
+
+    def read(self, file_name):
+        """Return contents of a compressed log file."""
+        with lzma.open(os.path.join(self.log_directory, file_name)) as file:
+            return file.read()
+
+    def test_phases(self):
+        """Test that phases are compressed and indexed in order."""
+        logger = logging.getLogger('freedommaker.tests.buildlog')
+        handler = buildlog.BuildLogHandler(self.build_log)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        self.build_log.open('prepare')
+        logger.warning('preparing')
+        self.build_log.start_phase('make_image customize packages')
+        subprocess.check_call(['echo', 'output'], stdout=self.build_log.file)
+        self.build_log.write(b'one\ntwo\nthree\n')
+        program_log = self.build_log.add_file('program.log')
+        with open(program_log, 'w') as file_handle:
+            file_handle.write('program\n')
+
+        self.build_log.fail()
+        self.build_log.start_phase('cleanup')
+        self.build_log.close()
+
+        self.assertEqual(sorted(os.listdir(self.log_directory)), [
+            '01-prepare.log.xz', '02-make_image-customize-packages.log.xz',
+            '03-cleanup.log.xz', 'index.json', 'program.log.xz'
+        ])
+        self.assertEqual(self.read('01-prepare.log.xz'), b'preparing\n')
+        self.assertEqual(
+            self.read('02-make_image-customize-packages.log.xz'),
+            b'output\none\ntwo\nthree\n')
+        self.assertEqual(self.read('program.log.xz'), b'program\n')
+
+        with open(os.path.join(self.log_directory, 'index.json')) as file:
+            index = json.load(file)
+
+        self.assertEqual(index['failed_phase'],
+                         'make_image customize packages')
+        phases = [(phase['phase'], phase['offset'], phase['size'],
+                   phase['failed']) for phase in index['phases']]
+        self.assertEqual(phases, [
+            ('prepare', 0, 10, False),
+            ('make_image customize packages', 10, 21, True),
+            ('cleanup', 31, 0, False),
+        ])
+        self.assertEqual(self.build_log.failure_tail, ['two', 'three'])
+
+    def test_reopen(self):
+        """Test that logs of an earlier build are removed."""
+        self.build_log.open('prepare')
+        self.build_log.close()
+        self.build_log.open('prepare')
+        self.build_log.close()
+        self.assertEqual(sorted(os.listdir(self.log_directory)),
+                         ['01-prepare.log.xz', 'index.json'])
+
+    def test_close_unopened(self):
+        """Test that a log never opened is not written."""
+        self.build_log.close()
+        self.assertFalse(os.path.exists(self.log_directory))
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for accounting resources used by a build.
+"""
+
+import os
+import tempfile
+import unittest
+
+from freedommaker.cgroup import BuildCgroup
+
+
+class StubCgroup(BuildCgroup):
+    """Group created in a plain directory without root."""
+
+    @staticmethod
+    def _create_directory(path):
+        """Create a directory for the group."""
+        os.makedirs(path)
+
+    @staticmethod
+    def _write(file_name, value):
+        """Write a value into a file of the group."""
+        with open(file_name, 'w') as file_handle:
+            file_handle.write(str(value))
+
+
+class TestBuildCgroup(unittest.TestCase):
+    """Tests for accounting resources used by a build."""
+
+    def test_create(self):
+        """Test that only controllers of the delegated parent are used."""
+        with tempfile.TemporaryDirectory() as directory:
+            parent = os.path.join(directory, 'freedom-maker')
+            group = StubCgroup('build', memory_max=1024**3, io_weight=200,
+                               parent=parent)
+            self.assertFalse(group.create())
+            self.assertEqual(os.listdir(directory), [])
+
+            os.makedirs(parent)
+            with open(os.path.join(parent, 'cgroup.controllers'), 'w') as \
+                    file_handle:
+                file_handle.write('cpuset cpu memory pids\n')
+
+            self.assertTrue(group.create())
+            self.assertEqual(group.path, os.path.join(parent, 'build'))
+            with open(os.path.join(parent, 'cgroup.subtree_control')) as \
+                    file_handle:
+                self.assertEqual(file_handle.read(), '+cpu +memory')
+
+            self.assertEqual(sorted(os.listdir(group.path)), ['memory.max'])
+            self.assertEqual(os.listdir(directory), ['freedom-maker'])
+
+    def test_usage(self):
+        """Test reading resource usage of a group."""
+        files = {
+            'memory.peak': '4294967296\n',
+            'io.stat': '8:0 rbytes=1048576 wbytes=2097152 rios=1 wios=2\n'
+                       '8:16 rbytes=1048576 wbytes=0 rios=1 wios=0\n',
+            'cpu.stat': 'usage_usec 1500000\nuser_usec 1000000\n',
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name, contents in files.items():
+                with open(os.path.join(directory, file_name), 'w') as \
+                        file_handle:
+                    file_handle.write(contents)
+
+            group = BuildCgroup('test')
+            group.path = directory
+            self.assertEqual(group.get_usage(), {
+                'memory_peak': 4294967296,
+                'io_rbytes': 2097152,
+                'io_wbytes': 2097152,
+                'cpu_seconds': 1.5,
+            })
+            self.assertEqual(group.get_wrapper()[-1], directory)
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for the store of images split into chunks.
+"""
+
+import hashlib
+import lzma
+import os
+import random
+import tempfile
+import unittest
+
+from freedommaker import chunks
+
+
+class TestChunkStore(unittest.TestCase):
+    """Tests for the store of images split into chunks."""
+
+    def setUp(self):
+        """Create an empty chunk store and build directory."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.build_dir = os.path.join(self.directory.name, 'build')
+        os.makedirs(self.build_dir)
+        self.store = chunks.ChunkStore(
+            os.path.join(self.directory.name, 'chunks'))
+        generator = random.Random(0)
+        self.data = bytes(
+            generator.getrandbits(8) for _ in range(4 * chunks.CHUNK_SIZE))
+
+    def tearDown(self):
+        """Remove the chunk store and build directory."""
+        self.directory.cleanup()
+
+    def write_image(self, name, contents):
+        """Write an image, compressed if its name ends with .xz."""
+        file_name = os.path.join(self.build_dir, name)
+        opener = lzma.open if name.endswith('.xz') else open
+        with opener(file_name, 'wb') as file_handle:
+            file_handle.write(contents)
+
+        return file_name
+
+    def test_add_extract(self):
+        """Test that images share chunks and are reassembled."""
+        first = self.data + bytes(chunks.CHUNK_SIZE) + b'end'
+        second = self.data[:-1] + b'x' + bytes(chunks.CHUNK_SIZE) + b'end'
+        self.store.add(self.write_image('first.img', first),
+                       target='amd64', build_stamp='2019-01-01')
+        index = self.store.add(self.write_image('second.img.xz', second),
+                               target='amd64', build_stamp='2019-01-02')
+        self.assertTrue(index['compressed'])
+        self.assertEqual(index['build_stamp'], '2019-01-02')
+        self.assertIsNone(index['chunks'][4])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.build_dir, 'second.img.xz.chunks')))
+
+        statistics = self.store.get_statistics()
+        self.assertEqual(statistics['images'], 2)
+        self.assertEqual(statistics['image_bytes'], 2 * len(first))
+        self.assertEqual(statistics['chunks'], 6)
+        self.assertEqual(statistics['chunk_bytes'],
+                         5 * chunks.CHUNK_SIZE + 3)
+        self.assertGreater(statistics['ratio'], 1)
+
+        os.remove(os.path.join(self.build_dir, 'second.img.xz'))
+        output = os.path.join(self.build_dir, 'second.img')
+        self.store.extract(self.store.find_index('second.img.xz'), output)
+        with open(output, 'rb') as file_handle:
+            self.assertEqual(file_handle.read(), second)
+
+    def test_damaged_chunk(self):
+        """Test that a damaged chunk is not extracted silently."""
+        index = self.store.add(self.write_image('image.img', self.data))
+        with open(self.store.get_chunk_file(index['chunks'][0]),
+                  'wb') as file_handle:
+            file_handle.write(lzma.compress(b'damaged'))
+
+        output = os.path.join(self.build_dir, 'output.img')
+        with self.assertRaises(ValueError):
+            self.store.extract(index, output)
+
+        self.assertEqual(sorted(os.listdir(self.build_dir)),
+                         ['image.img', 'image.img.chunks'])
+
+    def test_prune(self):
+        """Test that images of old builds and their chunks are removed."""
+        chunk_size = chunks.CHUNK_SIZE
+        old = self.data[:chunk_size] + b'o' * chunk_size
+        for name, build_stamp, contents in [
+                ('old.img', '2019-01-01', old),
+                ('first.img', '2019-01-02', self.data),
+                ('second.img', '2019-01-03', self.data[:-1] + b'x'),
+        ]:
+            self.store.add(self.write_image(name, contents), target='amd64',
+                           build_stamp=build_stamp)
+
+        self.store.add(self.write_image('other.img', self.data),
+                       target='i386', build_stamp='2019-01-01')
+
+        self.assertEqual(self.store.prune(2), (1, 1))
+        self.assertEqual(
+            sorted(index['name'] for _, index in self.store.get_indexes()),
+            ['first.img', 'other.img', 'second.img'])
+        self.assertFalse(os.path.exists(self.store.get_chunk_file(
+            hashlib.sha256(b'o' * chunk_size).hexdigest())))
+
+        file_name = os.path.join(self.build_dir, 'extracted.img')
+        for _, index in self.store.get_indexes():
+            self.store.extract(index, file_name)
+
+        self.assertEqual(self.store.prune(2), (0, 0))
+
+    def test_prune_order(self):
+        """Test that build stamps are ordered by when images were added."""
+        for name, build_stamp in [('first.img', 'zeta'),
+                                  ('second.img', None),
+                                  ('third.img', 'alpha')]:
+            self.store.add(self.write_image(name, self.data), target='amd64',
+                           build_stamp=build_stamp)
+
+        self.assertEqual(self.store.prune(2)[0], 1)
+        self.assertEqual(
+            sorted(index['name'] for _, index in self.store.get_indexes()),
+            ['second.img', 'third.img'])
+
+    def test_is_image(self):
+        """Test which built files are split into chunks."""
+        self.assertTrue(chunks.is_image('freedombox.img.xz'))
+        self.assertTrue(chunks.is_image('freedombox.qcow2'))
+        self.assertFalse(chunks.is_image('freedombox.img.xz.sig'))
+        self.assertFalse(chunks.is_image('freedombox-source.tar.gz'))
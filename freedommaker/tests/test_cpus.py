@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for allocating CPUs to concurrent builds.
+"""
+
+import os
+import tempfile
+import unittest
+
+from freedommaker.cpus import CPUAllocation
+
+
+class TestCPUAllocation(unittest.TestCase):
+    """Tests for allocating CPUs to concurrent builds."""
+
+    def setUp(self):
+        """Setup test case."""
+        self.lock_directory = tempfile.TemporaryDirectory()
+        self.cpus = sorted(os.sched_getaffinity(0))
+
+    def tearDown(self):
+        """Cleanup after test case."""
+        self.lock_directory.cleanup()
+
+    def test_exclusive(self):
+        """Test that concurrent builds do not share CPUs."""
+        allocations = []
+        for _ in self.cpus:
+            allocation = CPUAllocation(1, self.lock_directory.name)
+            self.assertEqual(len(allocation.acquire(wait=False)), 1)
+            allocations.append(allocation)
+
+        allocated = [allocation.cpus[0] for allocation in allocations]
+        self.assertEqual(sorted(allocated), self.cpus)
+
+        extra = CPUAllocation(1, self.lock_directory.name)
+        self.assertIsNone(extra.acquire(wait=False))
+
+        allocations[0].release()
+        self.assertEqual(extra.acquire(wait=False), [allocated[0]])
+        self.assertEqual(extra.get_cpu_list(), str(allocated[0]))
+
+    def test_count(self):
+        """Test that a build may be given several CPUs."""
+        allocation = CPUAllocation(len(self.cpus) + 1,
+                                   self.lock_directory.name)
+        self.assertEqual(allocation.acquire(wait=False), self.cpus)
+        allocation.release()
+        self.assertEqual(allocation.cpus, [])
+
+    def test_release_twice(self):
+        """Test that releasing an allocation again does nothing."""
+        allocation = CPUAllocation(len(self.cpus), self.lock_directory.name)
+        allocation.acquire(wait=False)
+        allocation.release()
+        allocation.release()
+        self.assertEqual(allocation.get_cpu_list(), '')
+
+        other = CPUAllocation(len(self.cpus), self.lock_directory.name)
+        self.assertEqual(other.acquire(wait=False), self.cpus)
+        other.release()
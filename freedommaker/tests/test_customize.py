@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for functions of the customization script run in the image.
+"""
+
+import hashlib
+import os
+import subprocess
+import tempfile
+import unittest
+
+CUSTOMIZE = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                         'freedombox-customize')
+
+# Packages installed in the image as listed by dpkg-query, with the source
+# downloaded by apt-get faked for them
+CHROOT_STUB = '''
+chroot() {
+    shift
+    if [ "$1" = dpkg-query ]; then
+        printf 'hello=2.10-1\\nbash=1:5.0-4\\nhello=2.10-1\\n'
+    fi
+}
+'''
+
+# Root file system on btrfs with a boot partition, snapshots are copies
+BTRFS_STUB = '''
+stat() {
+    echo btrfs
+}
+mountpoint() {
+    [ "$2" = "$rootdir/boot" ]
+}
+btrfs() {
+    case "$2" in
+        snapshot) mkdir "$5" && echo "$4" > "$5/source" ;;
+        delete) rm -rf "$3" ;;
+    esac
+}
+customize_debootstrap() {
+    echo debootstrap >> "$rootdir/phases"
+}
+customize_packages() {
+    echo packages >> "$rootdir/phases"
+}
+customize_hardware() {
+    echo hardware >> "$rootdir/phases"
+}
+checkpoint_dir="$rootdir/.freedom-maker-checkpoints"
+resume_from="$RESUME_FROM"
+'''
+
+# Commands run in the image, recorded in a file
+CHROOT_RECORDER = '''
+chroot() {
+    shift
+    echo "$*" >> "$rootdir/commands"
+}
+'''
+
+DSC = '''Format: 3.0 (quilt)
+Source: bash
+Checksums-Sha256:
+ {0} 5 bash_5.0.orig.tar.xz
+ {1} 6 bash_5.0-4.debian.tar.xz
+Files:
+'''
+
+GIT_ENVIRONMENT = {
+    'GIT_AUTHOR_NAME': 'Freedom Maker',
+    'GIT_AUTHOR_EMAIL': 'freedom-maker@example.org',
+    'GIT_COMMITTER_NAME': 'Freedom Maker',
+    'GIT_COMMITTER_EMAIL': 'freedom-maker@example.org',
+}
+
+
+class TestCustomize(unittest.TestCase):
+    """Tests for functions of the customization script."""
+
+    def setUp(self):
+        """Create a directory for files used by the script."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.temp_dir = os.path.join(self.directory.name, 'tmp')
+        os.makedirs(self.temp_dir)
+
+    def tearDown(self):
+        """Remove the files used by the script."""
+        self.directory.cleanup()
+
+    def call(self, script, *arguments, **environment):
+        """Run shell code with the script's functions and return output.
+
+        Raise CalledProcessError if the code fails.
+
+        """
+        environment = dict(os.environ, TMPDIR=self.temp_dir, **environment)
+        return subprocess.check_output(
+            ['bash', '-c', 'source "$0"; ' + script, CUSTOMIZE] +
+            list(arguments), env=environment,
+            stderr=subprocess.DEVNULL).decode()
+
+    def git(self, repository, *arguments):
+        """Run a git command in a repository and return its output."""
+        return subprocess.check_output(
+            ['git', '-C', repository] + list(arguments),
+            env=dict(os.environ, **GIT_ENVIRONMENT),
+            stderr=subprocess.DEVNULL).decode().strip()
+
+    def commit_file(self, repository, contents):
+        """Commit a file named blob to a repository and return the commit."""
+        with open(os.path.join(repository, 'blob'), 'w') as file_handle:
+            file_handle.write(contents)
+
+        self.git(repository, 'add', 'blob')
+        self.git(repository, 'commit', '-m', contents)
+        return self.git(repository, 'rev-parse', 'HEAD')
+
+    def fetch_git_file(self, repository, commit, **environment):
+        """Fetch the file of a commit with the script and return result."""
+        destination = os.path.join(self.directory.name, 'fetched')
+        output = self.call('fetch_cached_git_file "$@"', repository, commit,
+                           'blob', destination, **environment)
+        with open(destination) as file_handle:
+            return output, file_handle.read()
+
+    def download_sources(self):
+        """Download sources with the script and return the manifest."""
+        manifest = os.path.join(self.directory.name, 'manifest')
+        self.call(CHROOT_STUB + 'download_sources "$1"', manifest,
+                  rootdir=os.path.join(self.directory.name, 'root'),
+                  SOURCE_CACHE=self.source_cache)
+        with open(manifest) as file_handle:
+            return file_handle.read().splitlines()
+
+    def test_source_cache_empty(self):
+        """Test that an empty manifest is written if nothing is cached."""
+        self.source_cache = os.path.join(self.directory.name, 'sources')
+        os.makedirs(os.path.join(self.source_cache, 'pool'))
+        os.makedirs(os.path.join(self.source_cache, 'dsc'))
+        self.assertEqual(self.download_sources(), [])
+
+    def test_source_cache(self):
+        """Test that cached sources are indexed and listed by hash."""
+        self.source_cache = os.path.join(self.directory.name, 'sources')
+        os.makedirs(os.path.join(self.source_cache, 'pool'))
+        os.makedirs(os.path.join(self.source_cache, 'dsc'))
+        orig_hash = hashlib.sha256(b'orig').hexdigest()
+        debian_hash = hashlib.sha256(b'debian').hexdigest()
+        contents = DSC.format(orig_hash, debian_hash).encode()
+        with open(os.path.join(self.source_cache, 'pool', 'bash_5.0-4.dsc'),
+                  'wb') as file_handle:
+            file_handle.write(contents)
+
+        dsc_hash = hashlib.sha256(contents).hexdigest()
+        self.assertEqual(self.download_sources(), [
+            debian_hash + '  bash_5.0-4.debian.tar.xz',
+            dsc_hash + '  bash_5.0-4.dsc',
+            orig_hash + '  bash_5.0.orig.tar.xz',
+        ])
+        link = os.path.join(self.source_cache, 'dsc', dsc_hash)
+        self.assertEqual(os.readlink(link), '../pool/bash_5.0-4.dsc')
+
+    def run_phases(self, *phases, **environment):
+        """Run customization phases and return the phases that ran."""
+        root = os.path.join(self.directory.name, 'root')
+        os.makedirs(os.path.join(root, 'boot'), exist_ok=True)
+        with open(os.path.join(root, 'boot', 'vmlinuz'), 'w'):
+            pass
+
+        self.call(BTRFS_STUB + 'for phase in "$@"; do run_phase "$phase"; '
+                  'done', *phases, rootdir=root, **environment)
+        with open(os.path.join(root, 'phases')) as file_handle:
+            return file_handle.read().split()
+
+    def test_take_checkpoint(self):
+        """Test that every phase ends with a checkpoint."""
+        self.assertEqual(self.run_phases('debootstrap', 'packages'),
+                         ['debootstrap', 'packages'])
+        directory = os.path.join(self.directory.name, 'root',
+                                 '.freedom-maker-checkpoints')
+        self.assertEqual(sorted(os.listdir(directory)), [
+            'debootstrap', 'debootstrap-boot.tar', 'packages',
+            'packages-boot.tar'
+        ])
+        boot = subprocess.check_output(
+            ['tar', '--list', '--file',
+             os.path.join(directory, 'packages-boot.tar')]).decode()
+        self.assertIn('./vmlinuz', boot.split())
+
+        # Checkpoint of a phase run again replaces the earlier one
+        with open(os.path.join(directory, 'packages', 'stale'), 'w'):
+            pass
+
+        self.run_phases('packages')
+        self.assertEqual(os.listdir(os.path.join(directory, 'packages')),
+                         ['source'])
+
+    def test_no_checkpoint(self):
+        """Test that a phase may be run without taking a checkpoint."""
+        self.run_phases('debootstrap')
+        root = os.path.join(self.directory.name, 'root')
+        self.call(BTRFS_STUB + 'run_phase packages no-checkpoint',
+                  rootdir=root)
+        with open(os.path.join(root, 'phases')) as file_handle:
+            self.assertEqual(file_handle.read().split(),
+                             ['debootstrap', 'packages'])
+
+        directory = os.path.join(root, '.freedom-maker-checkpoints')
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['debootstrap', 'debootstrap-boot.tar'])
+
+    def test_resume_phases(self):
+        """Test that phases up to the checkpoint resumed from are skipped."""
+        self.assertEqual(
+            self.run_phases('debootstrap', 'packages', 'hardware',
+                            RESUME_FROM='packages'), ['hardware'])
+
+    def test_variant(self):
+        """Test that the packages of a variant are installed in its image."""
+        root = os.path.join(self.directory.name, 'root')
+        for directory in ('etc/apt', 'usr/sbin', 'tmp'):
+            os.makedirs(os.path.join(root, directory))
+
+        with open(os.path.join(root, 'etc', 'hosts'), 'w') as file_handle:
+            file_handle.write('127.0.1.1\tfreedombox\n')
+
+        custom_package = os.path.join(self.directory.name, 'plinth_1.deb')
+        open(custom_package, 'w').close()
+        self.call(CHROOT_RECORDER + 'cd "$rootdir"; customize_variant',
+                  rootdir=root,
+                  BUILD_MIRROR='http://deb.debian.org/debian',
+                  SUITE='unstable', VARIANT_HOSTNAME='office',
+                  VARIANT_PACKAGES='tor privoxy',
+                  VARIANT_CUSTOM_PACKAGES=custom_package)
+        with open(os.path.join(root, 'commands')) as file_handle:
+            self.assertEqual(file_handle.read().splitlines(), [
+                'apt-get update', 'apt-get install -y tor privoxy',
+                'apt-get install -y /tmp/plinth_1.deb', 'apt-get clean'
+            ])
+
+        with open(os.path.join(root, 'etc', 'hostname')) as file_handle:
+            self.assertEqual(file_handle.read(), 'office\n')
+
+        self.assertEqual(sorted(os.listdir(os.path.join(root, 'tmp'))), [])
+        self.assertEqual(os.listdir(os.path.join(root, 'usr', 'sbin')), [])
+
+    def test_git_blob_cache(self):
+        """Test that repositories are only fetched for missing commits."""
+        repository = os.path.join(self.directory.name, 'repository')
+        os.makedirs(repository)
+        self.git(repository, 'init', '--quiet')
+        first = self.commit_file(repository, 'first')
+        cache = os.path.join(self.directory.name, 'blobs')
+
+        output, contents = self.fetch_git_file(repository, first,
+                                               BLOB_CACHE=cache)
+        self.assertIn('blob cache miss', output)
+        self.assertEqual(contents, 'first')
+
+        output, contents = self.fetch_git_file(repository, first,
+                                               BLOB_CACHE=cache)
+        self.assertIn('blob cache hit', output)
+        self.assertEqual(contents, 'first')
+
+        second = self.commit_file(repository, 'second')
+        output, contents = self.fetch_git_file(repository, second,
+                                               BLOB_CACHE=cache)
+        self.assertIn('blob cache miss', output)
+        self.assertEqual(contents, 'second')
+
+        # Cached commits are found without the repository
+        os.rename(repository, repository + '.moved')
+        output, contents = self.fetch_git_file(repository, first,
+                                               BLOB_CACHE=cache)
+        self.assertIn('blob cache hit', output)
+        self.assertEqual(contents, 'first')
+
+    def test_git_without_cache(self):
+        """Test that temporary clones are removed, also on failure."""
+        repository = os.path.join(self.directory.name, 'repository')
+        os.makedirs(repository)
+        self.git(repository, 'init', '--quiet')
+        commit = self.commit_file(repository, 'contents')
+
+        _, contents = self.fetch_git_file(repository, commit)
+        self.assertEqual(contents, 'contents')
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.fetch_git_file(repository + '.missing', commit)
+
+        self.assertEqual(os.listdir(self.temp_dir), [])
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for the build daemon.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+from freedommaker import daemon
+from freedommaker.variant import ImageVariant
+
+logger = logging.getLogger('freedommaker.tests')
+
+
+class TestDaemon(unittest.TestCase):
+    """Tests for the build daemon."""
+
+    def setUp(self):
+        """Start a daemon with a fake build."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.directory.name, 'daemon.sock')
+        self.executed = []
+        self.release = threading.Event()
+        self.daemon_arguments = argparse.Namespace(
+            command='serve', targets=[], build_dir='daemon',
+            vmdebootstrap='/usr/sbin/vmdebootstrap', memory_limit=None)
+        self.daemon = daemon.BuildDaemon(self.socket_path, self.execute,
+                                         self.daemon_arguments)
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+        while not self.daemon.server:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        """Stop the daemon."""
+        self.release.set()
+        self.daemon.stop()
+        self.thread.join()
+        self.directory.cleanup()
+
+    def execute(self, arguments, listener):
+        """Fake a build that waits until released."""
+        self.executed.append(arguments)
+        logger.warning('Building %s', ' '.join(arguments.targets))
+        listener(arguments.targets[0], 'make_image', 'started')
+        self.release.wait()
+        if 'fail' in arguments.targets:
+            raise RuntimeError('Build failed')
+
+    def get_arguments(self, targets):
+        """Return command line arguments of a build."""
+        return argparse.Namespace(
+            targets=targets, command='submit', socket=self.socket_path,
+            build_dir='build', cache_dir=None, local_mirror=None,
+            custom_package=None, build_mirror=None,
+            vmdebootstrap='/tmp/vmdebootstrap', memory_limit=1024,
+            variant=[ImageVariant('test', hostname='test')])
+
+    def submit(self, targets, results):
+        """Submit a build in a thread and record its result and output."""
+        output = io.StringIO()
+
+        def run():
+            results.append((daemon.submit(self.socket_path,
+                                          self.get_arguments(targets),
+                                          output), output))
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_request(self):
+        """Test that paths are made absolute and variants restored."""
+        request = daemon.get_request(self.get_arguments(['amd64']))
+        self.assertEqual(request['build_dir'], os.path.abspath('build'))
+        self.assertNotIn('socket', request)
+        self.assertNotIn('vmdebootstrap', request)
+        arguments = daemon.get_arguments(request, self.daemon_arguments)
+        self.assertIsNone(arguments.command)
+        self.assertEqual(arguments.targets, ['amd64'])
+        self.assertEqual(arguments.build_dir, os.path.abspath('build'))
+        self.assertEqual(arguments.vmdebootstrap, '/usr/sbin/vmdebootstrap')
+        self.assertIsNone(arguments.memory_limit)
+        self.assertEqual(arguments.variant[0].hostname, 'test')
+        self.assertEqual(self.daemon_arguments.targets, [])
+
+    def test_refuse_arguments(self):
+        """Test that requests may only set what is built."""
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+
+        request = {'targets': ['amd64'], 'vmdebootstrap': '/tmp/script'}
+        with self.assertRaises(ValueError):
+            daemon.get_arguments(request, self.daemon_arguments)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as \
+                connection:
+            connection.connect(self.socket_path)
+            connection.sendall(json.dumps({'arguments': request}).encode() +
+                               b'\n')
+            message = json.loads(connection.makefile('rb').readline())
+
+        self.assertEqual(message['status'], 'failed')
+        self.assertIn('vmdebootstrap', message['error'])
+        self.assertEqual(self.executed, [])
+
+    def test_deduplicate(self):
+        """Test that identical requests are built once."""
+        results = []
+        threads = [self.submit(['amd64'], results) for _ in range(2)]
+        while not self.executed:
+            time.sleep(0.01)
+
+        threads.append(self.submit(['i386'], results))
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([arguments.targets for arguments in self.executed],
+                         [['amd64'], ['i386']])
+        self.assertEqual([status for status, _ in results], [0, 0, 0])
+        output = ''.join(output.getvalue() for _, output in results)
+        self.assertIn('joined identical request', output)
+        self.assertIn('Stage make_image of amd64 started', output)
+        self.assertIn('Building amd64', output)
+
+    def test_failure(self):
+        """Test that failure of a build is reported to the client."""
+        self.release.set()
+        results = []
+        self.submit(['fail'], results).join()
+        self.assertEqual(results[0][0], 1)
+
+    def test_no_daemon(self):
+        """Test submitting when no daemon is listening."""
+        self.assertEqual(
+            daemon.submit(os.path.join(self.directory.name, 'missing'),
+                          self.get_arguments(['amd64'])), 2)
+
+    def test_already_running(self):
+        """Test that a second daemon does not take over the socket."""
+        with self.assertRaises(daemon.DaemonError):
+            daemon.BuildDaemon(self.socket_path, self.execute,
+                               self.daemon_arguments).serve()
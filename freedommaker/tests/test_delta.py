@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for indexes of compressed images for delta downloads.
+"""
+
+import json
+import lzma
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from freedommaker import delta
+
+BLOCK_SIZE = 64 * 1024
+
+
+@unittest.skipUnless(shutil.which('xz'), 'xz is not installed')
+class TestDelta(unittest.TestCase):
+    """Tests for indexes of compressed images for delta downloads."""
+
+    def setUp(self):
+        """Create an image of random data."""
+        self.directory = tempfile.TemporaryDirectory()
+        generator = random.Random(0)
+        self.data = bytes(
+            generator.getrandbits(8) for _ in range(4 * BLOCK_SIZE)) + b'end'
+
+    def tearDown(self):
+        """Remove the images and archives."""
+        self.directory.cleanup()
+
+    def write_image(self, name, contents):
+        """Write an image."""
+        file_name = os.path.join(self.directory.name, name)
+        with open(file_name, 'wb') as file_handle:
+            file_handle.write(contents)
+
+        return file_name
+
+    def compress(self, image_file):
+        """Compress an image in blocks as the builder does."""
+        archive_file = image_file + '.xz'
+        block_hashes = []
+        with open(archive_file, 'wb') as file_handle:
+            process = subprocess.Popen(
+                delta.get_compressor(BLOCK_SIZE) + ['--stdout'],
+                stdin=subprocess.PIPE, stdout=file_handle)
+            feeder = threading.Thread(
+                target=delta.feed,
+                args=(image_file, process.stdin, BLOCK_SIZE, block_hashes))
+            feeder.start()
+            feeder.join()
+            self.assertEqual(process.wait(), 0)
+
+        listing = subprocess.check_output(
+            ['xz', '--robot', '--list', '-vv', archive_file]).decode()
+        index = delta.get_index(archive_file, listing, BLOCK_SIZE,
+                                block_hashes)
+        delta.write_index(index, archive_file)
+        return archive_file
+
+    def test_index(self):
+        """Test that blocks of the archive are listed with their hashes."""
+        archive_file = self.compress(self.write_image('image.img',
+                                                      self.data))
+        with open(archive_file + delta.INDEX_SUFFIX) as file_handle:
+            index = json.load(file_handle)
+
+        self.assertEqual(index['archive'], 'image.img.xz')
+        self.assertEqual(index['size'], len(self.data))
+        self.assertEqual(len(index['blocks']), 5)
+        self.assertEqual(index['blocks'][4]['offset'], 4 * BLOCK_SIZE)
+        self.assertEqual(index['blocks'][4]['size'], 3)
+
+        with open(archive_file, 'rb') as file_handle:
+            archive = file_handle.read()
+
+        self.assertEqual(lzma.decompress(archive), self.data)
+        block = index['blocks'][1]
+        data = archive[block['compressed_offset']:block['compressed_offset'] +
+                       block['compressed_size']]
+        self.assertEqual(delta.decompress_block(data),
+                         self.data[BLOCK_SIZE:2 * BLOCK_SIZE])
+
+    def test_update(self):
+        """Test that an earlier image is updated with changed blocks only."""
+        old_image = self.write_image('old.img', self.data[:-1])
+        new_data = b'new' + self.data[3:]
+        archive_file = self.compress(self.write_image('new.img', new_data))
+        with open(archive_file + delta.INDEX_SUFFIX) as file_handle:
+            index = json.load(file_handle)
+
+        changed = delta.get_changed_blocks(index, old_image)
+        self.assertEqual(changed, [index['blocks'][0], index['blocks'][4]])
+
+        def read_range(offset, size):
+            with open(archive_file, 'rb') as file_handle:
+                file_handle.seek(offset)
+                return file_handle.read(size)
+
+        read = delta.update(index, old_image, read_range)
+        self.assertEqual(read, sum(block['compressed_size']
+                                   for block in changed))
+        with open(old_image, 'rb') as file_handle:
+            self.assertEqual(file_handle.read(), new_data)
+
+        def read_damaged_range(offset, size):
+            data = bytearray(read_range(offset, size))
+            data[size // 2] ^= 0xff
+            return bytes(data)
+
+        self.write_image('old.img', self.data)
+        with self.assertRaises(ValueError):
+            delta.update(index, old_image, read_damaged_range)
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for the build history.
+"""
+
+import argparse
+import io
+import tempfile
+import unittest
+
+from freedommaker import history
+from freedommaker.builder import ImageBuilder
+
+
+class TestHistory(unittest.TestCase):
+    """Tests for the build history."""
+
+    def setUp(self):
+        """Create an empty history."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = history.BuildHistory(self.directory.name)
+        arguments = argparse.Namespace(image_size='3800M', build_in_ram=None,
+                                       variant=None, distribution='unstable')
+        self.key = history.get_key(ImageBuilder.get_builder_class('amd64'),
+                                   arguments)
+
+    def tearDown(self):
+        """Remove the history."""
+        self.directory.cleanup()
+
+    def record(self, finished, make_image, success=True, reused=False):
+        """Record a build with a duration of its image build."""
+        self.history.record(
+            self.key, 'stamp', finished - make_image - 10, finished, success,
+            reused, {'make_image': make_image, 'compress': 10},
+            {'.img.xz': 1000})
+
+    def test_key(self):
+        """Test that key identifies the kind of build."""
+        self.assertEqual(self.key[:3], ('amd64', 'vmdebootstrap', 'unstable'))
+        self.assertIn('"architecture": "amd64"', self.key[3])
+
+    def test_estimate(self):
+        """Test estimating from successful builds that were not reused."""
+        self.assertIsNone(self.history.estimate(self.key))
+        self.record(1000, 100)
+        self.record(2000, 200)
+        self.record(3000, 300)
+        self.record(4000, 1000, success=False)
+        self.record(5000, 1, reused=True)
+
+        estimate = self.history.estimate(self.key)
+        self.assertEqual(list(estimate.keys()),
+                         [None, 'make_image', 'compress'])
+        self.assertEqual(estimate[None], 210)
+        self.assertEqual(estimate['make_image'], 200)
+
+    def test_regressions(self):
+        """Test that stages slower than their baseline are found."""
+        for finished in range(1000, 6000, 1000):
+            self.record(finished, 100)
+
+        output = io.StringIO()
+        self.assertFalse(self.history.report(output=output))
+
+        self.record(7000, 200)
+        durations = self.history.get_durations(self.key)
+        self.assertEqual(history.find_regressions(durations),
+                         [(None, 210, 110), ('make_image', 200, 100)])
+
+        output = io.StringIO()
+        self.assertTrue(self.history.report(['amd64'], output=output))
+        lines = output.getvalue().splitlines()
+        self.assertIn('make_image', lines[2])
+        self.assertIn('+100%', lines[2])
+        self.assertTrue(lines[2].endswith('SLOWER'))
+        self.assertFalse(lines[3].endswith('SLOWER'))
+
+    def test_format_duration(self):
+        """Test formatting durations."""
+        self.assertEqual(history.format_duration(42), '42s')
+        self.assertEqual(history.format_duration(125), '2m05s')
+        self.assertEqual(history.format_duration(3720), '1h02m')
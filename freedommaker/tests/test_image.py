@@ -0,0 +1,454 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for mounting built images, refreshing and resuming builds and
+customizing variants of images.
+
+Commands are recorded instead of run, so neither root nor loop devices are
+needed.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import unittest
+
+from freedommaker import image
+from freedommaker import vmdebootstrap
+from freedommaker.builder import ImageBuilder
+from freedommaker.variant import ImageVariant
+
+LOOP_DEVICE = '/dev/loop7'
+
+PARTITIONS = ['/dev/mapper/loop7p1', '/dev/mapper/loop7p2']
+
+
+class StubLoopManager(object):
+    """Loop manager handing out a fixed loop device."""
+
+    def __init__(self, partitions):
+        """Initialize the object."""
+        self.partitions = partitions
+        self.attached = []
+
+    def attach(self, image_file, read_only=False):
+        """Pretend to attach an image to a loop device."""
+        self.attached.append(image_file)
+        return LOOP_DEVICE, self.partitions
+
+    def detach(self, loop_device):
+        """Pretend to detach a loop device."""
+        self.attached.pop()
+
+
+class StubBuildLog(object):
+    """Build log that does not write any files."""
+
+    @staticmethod
+    def add_file(name):
+        """Return the path of a log file written by a program."""
+        return os.path.join('/logs', name)
+
+
+class StubBuilder(object):
+    """Builder recording the commands it is asked to run."""
+
+    architecture = 'armhf'
+    machine = 'beaglebone'
+    free = True
+    boot_loader = 'u-boot'
+    boot_size = None
+    boot_offset = None
+    kernel_flavor = 'armmp'
+    root_filesystem_type = 'btrfs'
+    boot_filesystem_type = None
+    debootstrap_variant = None
+    customization_script = '/usr/lib/freedom-maker/freedombox-customize'
+    source_archive = 'source.tar.gz'
+
+    # Inputs of images are compared as real builders do
+    get_fingerprint = ImageBuilder.get_fingerprint
+    _get_input_hash = staticmethod(ImageBuilder._get_input_hash)
+    read_manifest = ImageBuilder.read_manifest
+
+    def __init__(self, partitions=PARTITIONS, **arguments):
+        """Initialize the object."""
+        self.arguments = argparse.Namespace(**arguments)
+        self.loop_manager = StubLoopManager(partitions)
+        self.build_log = StubBuildLog()
+        self.packages = []
+        self.commands = []
+        self.root_directory = None
+
+    def _run(self, command, **kwargs):
+        """Record a command instead of running it."""
+        self.commands.append(command)
+
+    def _run_output(self, command, **kwargs):
+        """Record a command instead of running it and return no output."""
+        self.commands.append(command)
+        return ''
+
+    @staticmethod
+    def get_target_name():
+        """Return the name of the target."""
+        return 'beaglebone'
+
+    @staticmethod
+    def get_resource_wrapper():
+        """Return a command prefix running commands without limits."""
+        return []
+
+    @staticmethod
+    def allocate_cpus():
+        """Return CPUs dedicated to the build."""
+        return '1'
+
+    @staticmethod
+    def get_cache_directory(name):
+        """Return a directory of the cache shared by builds."""
+        return os.path.join('/cache', name)
+
+
+class StubImageMount(image.ImageMount):
+    """Image mount whose root file system is a prepared directory."""
+
+    def mount_root(self):
+        """Use the builder's directory as root file system."""
+        self.root_directory = self.builder.root_directory
+        self.mount(self.partitions[-1], '')
+
+    def detach(self):
+        """Keep the prepared directory when detaching."""
+        self.root_directory = None
+        super().detach()
+
+
+class TestImageMount(unittest.TestCase):
+    """Tests for mounting the file systems of a built image."""
+
+    def test_mount(self):
+        """Test mounting root and boot file systems with an emulator."""
+        builder = StubBuilder()
+        with image.ImageMount(builder, 'image.img') as mount:
+            root = mount.root_directory
+            self.assertTrue(os.path.isdir(root))
+            self.assertEqual(builder.loop_manager.attached, ['image.img'])
+            mount.mount_boot()
+            mount.install_emulator('armhf')
+            mount.chroot(['apt-get', 'clean'])
+            self.assertEqual(mount.get_path('/etc/fstab'),
+                             os.path.join(root, 'etc/fstab'))
+
+        self.assertEqual(builder.commands, [
+            ['sudo', 'mount', PARTITIONS[1], os.path.join(root, '')],
+            ['sudo', 'mount', PARTITIONS[0], os.path.join(root, 'boot')],
+            ['sudo', 'cp', image.EMULATOR,
+             os.path.join(root, image.EMULATOR.lstrip('/'))],
+            ['sudo', 'chroot', root, 'apt-get', 'clean'],
+            ['sudo', 'rm', '-f',
+             os.path.join(root, image.EMULATOR.lstrip('/'))],
+        ])
+        self.assertFalse(os.path.exists(root))
+        self.assertEqual(builder.loop_manager.attached, [])
+
+    def test_read_only(self):
+        """Test that images are mounted read-only when asked to."""
+        builder = StubBuilder()
+        with image.ImageMount(builder, 'image.img', read_only=True) as mount:
+            mount.install_emulator('amd64')
+
+        self.assertEqual(builder.commands[0][:4],
+                         ['sudo', 'mount', '-o', 'ro'])
+        self.assertEqual(len(builder.commands), 1)
+
+    def test_no_partitions(self):
+        """Test that the image is detached when it has no partitions."""
+        builder = StubBuilder(partitions=[])
+        with self.assertRaises(ValueError):
+            with image.ImageMount(builder, 'image.img'):
+                pass
+
+        self.assertEqual(builder.loop_manager.attached, [])
+        self.assertEqual(builder.commands, [])
+
+
+class TestRefresh(unittest.TestCase):
+    """Tests for refreshing a previous image instead of a full build."""
+
+    def setUp(self):
+        """Create a previous image and its manifest."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.previous_image = os.path.join(self.directory.name,
+                                           'previous.img.xz')
+        open(self.previous_image, 'w').close()
+        self.image_file = os.path.join(self.directory.name, 'image.img.temp')
+        self.custom_package = os.path.join(self.directory.name,
+                                           'plinth_1.deb')
+        self.builder = StubBuilder(
+            refresh_from=self.previous_image, hostname='freedombox',
+            image_size='3800M', build_mirror='http://deb.debian.org/debian',
+            mirror='http://deb.debian.org/debian', distribution='unstable',
+            log_level='debug', download_source=False, include_source=False,
+            package=['tor'], custom_package=[self.custom_package],
+            resume=False, force=False, vmdebootstrap='vmdebootstrap')
+        self.builder.root_directory = os.path.join(self.directory.name,
+                                                   'root')
+        self.write_manifest(self.builder.get_fingerprint())
+        self.backend = vmdebootstrap.VmdebootstrapBuilderBackend(self.builder)
+        self.backend._prepare(self.image_file)
+        self.image_mount = image.ImageMount
+        image.ImageMount = StubImageMount
+
+    def tearDown(self):
+        """Remove the images."""
+        image.ImageMount = self.image_mount
+        self.directory.cleanup()
+
+    def write_manifest(self, fingerprint):
+        """Write the manifest of the previous image."""
+        manifest_file = ImageBuilder.get_manifest_file(self.previous_image)
+        with open(manifest_file, 'w') as file_handle:
+            json.dump({'build_stamp': 'previous', 'fingerprint': fingerprint},
+                      file_handle)
+
+    def get_customizations(self):
+        """Return the commands running the customization script."""
+        return [
+            command for command in self.builder.commands
+            if self.builder.customization_script in command
+        ]
+
+    def test_manifest(self):
+        """Test that manifests are found next to images and archives."""
+        self.assertEqual(
+            ImageBuilder.get_manifest_file(self.previous_image),
+            os.path.join(self.directory.name, 'previous.manifest.json'))
+        self.assertEqual(
+            ImageBuilder.get_manifest_file(self.image_file[:-len('.temp')]),
+            os.path.join(self.directory.name, 'image.manifest.json'))
+        self.assertEqual(
+            ImageBuilder.read_manifest(self.previous_image)['build_stamp'],
+            'previous')
+        self.assertIsNone(ImageBuilder.read_manifest(self.image_file))
+
+    def test_refresh(self):
+        """Test that packages are upgraded in a copy of the image."""
+        self.assertTrue(self.backend._refresh(self.image_file))
+        self.assertEqual(self.builder.commands[0], [
+            'sh', '-c', 'xz --decompress --stdout "$1" | '
+            'cp --sparse=always /dev/stdin "$2"', 'sh', self.previous_image,
+            self.image_file
+        ])
+        root = self.builder.root_directory
+        customizations = self.get_customizations()
+        self.assertEqual(len(customizations), 1)
+        self.assertIn('CUSTOMIZE_PHASES=refresh', customizations[0])
+        self.assertEqual(customizations[0][-2:], [root, self.image_file])
+        self.assertIn(['sudo', 'chroot', root, 'update-initramfs', '-u',
+                       '-k', 'all'], self.builder.commands)
+        self.assertEqual(self.builder.loop_manager.attached, [])
+
+    def test_custom_package(self):
+        """Test that custom packages are inputs, also when missing."""
+        missing = self.builder.get_fingerprint()
+        with open(self.custom_package, 'w') as file_handle:
+            file_handle.write('first')
+
+        first = self.builder.get_fingerprint()
+        with open(self.custom_package, 'w') as file_handle:
+            file_handle.write('second')
+
+        self.assertEqual(len({missing, first,
+                              self.builder.get_fingerprint()}), 3)
+        self.assertFalse(self.backend._refresh(self.image_file))
+        self.assertEqual(self.builder.commands, [])
+
+    def test_inputs_differ(self):
+        """Test that a full build is done if the inputs changed."""
+        self.builder.arguments.package = ['tor', 'privoxy']
+        self.assertFalse(self.backend._refresh(self.image_file))
+        self.assertEqual(self.builder.commands, [])
+
+    def test_no_manifest(self):
+        """Test that a full build is done without a manifest."""
+        os.remove(ImageBuilder.get_manifest_file(self.previous_image))
+        self.assertFalse(self.backend._refresh(self.image_file))
+        self.assertEqual(self.builder.commands, [])
+
+        self.builder.arguments.refresh_from = None
+        self.assertFalse(self.backend._refresh(self.image_file))
+        self.assertEqual(self.builder.commands, [])
+
+    def test_full_build(self):
+        """Test that vmdebootstrap builds the image when not refreshed."""
+        self.write_manifest('other inputs')
+        self.builder.image_file = self.image_file[:-len('.temp')]
+        self.builder.ram_directory = None
+        self.builder.should_skip_step = lambda file_name: False
+        self.builder.get_temp_image_file = lambda: self.image_file
+        self.builder.loop_manager.track_image = \
+            self.builder.loop_manager.release_image = lambda image_file: None
+        open(self.image_file, 'w').close()
+        self.backend.make_image()
+
+        self.assertEqual(len(self.builder.commands), 1)
+        command = self.builder.commands[0]
+        self.assertIn('vmdebootstrap', command)
+        self.assertEqual(command[command.index('--image') + 1],
+                         self.image_file)
+        self.assertNotIn('CUSTOMIZE_PHASES=refresh', command)
+        self.assertTrue(os.path.exists(self.builder.image_file))
+
+
+class TestResume(unittest.TestCase):
+    """Tests for resuming a failed build from its last checkpoint."""
+
+    def setUp(self):
+        """Create a root file system and a partially built image."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.image_file = os.path.join(self.directory.name, 'image.img.temp')
+        open(self.image_file, 'w').close()
+        self.builder = StubBuilder(resume=True)
+        self.builder.root_directory = os.path.join(self.directory.name,
+                                                   'root')
+        self.checkpoint_directory = os.path.join(
+            self.builder.root_directory, vmdebootstrap.CHECKPOINT_DIRECTORY)
+        os.makedirs(self.checkpoint_directory)
+        self.backend = vmdebootstrap.VmdebootstrapBuilderBackend(self.builder)
+        self.backend.environment = {'MACHINE': 'beaglebone'}
+        self.backend.execution_wrapper = ['sudo', '-H']
+        self.image_mount = image.ImageMount
+        image.ImageMount = StubImageMount
+
+    def tearDown(self):
+        """Remove the image and root file system."""
+        image.ImageMount = self.image_mount
+        self.directory.cleanup()
+
+    def take_checkpoint(self, checkpoint):
+        """Create a checkpoint as the customization script does."""
+        os.makedirs(os.path.join(self.checkpoint_directory, checkpoint))
+
+    def get_customizations(self):
+        """Return the commands running the customization script."""
+        return [
+            command for command in self.builder.commands
+            if self.builder.customization_script in command
+        ]
+
+    def test_resume(self):
+        """Test that the build continues after the last checkpoint."""
+        self.take_checkpoint('debootstrap')
+        self.take_checkpoint('packages')
+        open(os.path.join(self.checkpoint_directory, 'packages-boot.tar'),
+             'w').close()
+        self.assertTrue(self.backend._resume(self.image_file))
+
+        root = self.builder.root_directory
+        snapshot = os.path.join(self.checkpoint_directory, 'packages')
+        self.assertIn([
+            'sudo', 'find', root, '-mindepth', '1', '-maxdepth', '1', '!',
+            '-name', vmdebootstrap.CHECKPOINT_DIRECTORY, '-exec', 'rm', '-rf',
+            '{}', '+'
+        ], self.builder.commands)
+        self.assertIn(
+            ['sudo', 'cp', '-a', '--reflink=always', snapshot + '/.', root],
+            self.builder.commands)
+        self.assertIn([
+            'sudo', 'tar', '--extract', '--overwrite', '--file',
+            snapshot + '-boot.tar', '--directory',
+            os.path.join(root, 'boot')
+        ], self.builder.commands)
+        self.assertEqual(self.get_customizations(), [[
+            'sudo', '-H', 'MACHINE=beaglebone', 'RESUME_FROM=packages',
+            self.builder.customization_script, root, self.image_file
+        ]])
+        self.assertIn(['sudo', 'chroot', root, 'update-initramfs', '-u',
+                       '-k', 'all'], self.builder.commands)
+        self.assertEqual(self.builder.loop_manager.attached, [])
+
+    def test_no_checkpoint(self):
+        """Test that a full build is done without a checkpoint."""
+        self.assertFalse(self.backend._resume(self.image_file))
+        self.assertEqual(self.get_customizations(), [])
+        self.assertEqual(self.builder.loop_manager.attached, [])
+
+    def test_no_image(self):
+        """Test that a full build is done without a partial image."""
+        os.remove(self.image_file)
+        self.take_checkpoint('debootstrap')
+        self.assertFalse(self.backend._resume(self.image_file))
+        self.assertEqual(self.builder.commands, [])
+
+        self.builder.arguments.resume = False
+        open(self.image_file, 'w').close()
+        self.assertFalse(self.backend._resume(self.image_file))
+        self.assertEqual(self.builder.commands, [])
+
+
+class TestVariant(unittest.TestCase):
+    """Tests for customizing images of variants."""
+
+    def setUp(self):
+        """Create an empty root file system."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.builder = StubBuilder(
+            hostname='freedombox', image_size='3800M',
+            build_mirror='http://deb.debian.org/debian',
+            mirror='http://deb.debian.org/debian', distribution='unstable',
+            log_level='debug', download_source=False, include_source=False,
+            package=['tor'], custom_package=None)
+        self.builder.root_directory = self.directory.name
+        self.backend = vmdebootstrap.VmdebootstrapBuilderBackend(self.builder)
+        self.image_mount = image.ImageMount
+        image.ImageMount = StubImageMount
+
+    def tearDown(self):
+        """Remove the root file system."""
+        image.ImageMount = self.image_mount
+        self.directory.cleanup()
+
+    def test_variants(self):
+        """Test that each variant is customized with its own packages."""
+        variants = [
+            ImageVariant.parse('office:package=privoxy,hostname=office'),
+            ImageVariant.parse('plain'),
+        ]
+        for variant in variants:
+            self.backend.make_image_variant(variant,
+                                            variant.name + '.img')
+
+        customizations = [
+            command for command in self.builder.commands
+            if self.builder.customization_script in command
+        ]
+        self.assertEqual(len(customizations), 2)
+        office, plain = customizations
+        self.assertIn('VARIANT_PACKAGES=privoxy', office)
+        self.assertIn('VARIANT_HOSTNAME=office', office)
+        self.assertIn('CUSTOMIZE_PHASES=variant', office)
+        self.assertEqual(office[-2:],
+                         [self.builder.root_directory, 'office.img'])
+        self.assertIn('VARIANT_PACKAGES=', plain)
+        self.assertEqual(plain[-1], 'plain.img')
+        self.assertEqual(self.builder.packages, ['btrfs-progs'])
+        self.assertEqual(
+            self.backend.parameters.count('btrfs-progs'), 1)
@@ -24,15 +24,21 @@ Also test:
   - Other basic behavior
 """
 
+import argparse
 import json
 import logging
 import os
 import random
+import shutil
 import string
 import subprocess
+import tempfile
 import time
 import unittest
 
+from freedommaker import mirror
+from freedommaker.builder import ImageBuilder
+
 logger = logging.getLogger(__name__)
 
 
@@ -69,6 +75,13 @@ class TestInvocation(unittest.TestCase):
         self.build_stamp = self.random_string()
         self.current_target = 'amd64'
 
+        # Builds run in groups created in a stub of the cgroup hierarchy
+        self.cgroup_parent = tempfile.mkdtemp(prefix='cgroup-')
+        self.addCleanup(shutil.rmtree, self.cgroup_parent)
+        with open(os.path.join(self.cgroup_parent, 'cgroup.controllers'),
+                  'w') as file_handle:
+            file_handle.write('cpu io memory\n')
+
     def random_string(self):
         """Generate a random string."""
         return ''.join([random.choice(string.ascii_lowercase)
@@ -84,12 +97,17 @@ class TestInvocation(unittest.TestCase):
 
         parameters = [
             '--vmdebootstrap', os.path.join(self.path, 'vmdebootstrap-stub'),
-            '--build-dir', self.output_dir
+            '--build-dir', self.output_dir, '--cgroup-parent',
+            self.cgroup_parent
         ]
 
         if 'build_stamp' not in kwargs:
             parameters += ['--build-stamp', self.build_stamp]
 
+        # Stub does not need the host resources that preflight checks for
+        if 'skip_preflight' not in kwargs:
+            parameters += ['--skip-preflight']
+
         for parameter, value in kwargs.items():
             parameter = '--' + parameter.replace('_', '-')
 
@@ -226,6 +244,41 @@ class TestInvocation(unittest.TestCase):
         self.assert_arguments_passed(['--mirror', mirror])
         self.assert_environment_passed({'BUILD_MIRROR': mirror})
 
+    def test_local_mirror(self):
+        """Test that a synchronized local mirror is used for building."""
+        local_mirror = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_mirror)
+        os.makedirs(os.path.join(local_mirror, 'dists', 'unstable'))
+        for file_name in ('dists/unstable/InRelease', 'mirror.gpg'):
+            open(os.path.join(local_mirror, file_name), 'w').close()
+
+        names = mirror.get_target_packages(
+            ImageBuilder.get_builder_class(self.current_target),
+            argparse.Namespace(package=None, variant=None))
+        with open(os.path.join(local_mirror, mirror.SYNC_FILE), 'w') as \
+                file_handle:
+            json.dump({
+                'components': ['main'],
+                'architectures': {
+                    ARCHITECTURES[self.current_target]: names
+                }
+            }, file_handle)
+
+        # Packages not synchronized are downloaded from upstream
+        self.invoke(local_mirror=local_mirror, package='tor')
+        self.assert_environment_passed(
+            {'BUILD_MIRROR': 'http://deb.debian.org/debian'})
+
+        self.invoke(local_mirror=local_mirror, force=True)
+        key_file = os.path.join(local_mirror, 'mirror.gpg')
+        self.assert_arguments_passed(['--mirror', 'file://' + local_mirror])
+        self.assert_arguments_passed(
+            ['--debootstrapopts', 'keyring=' + key_file])
+        self.assert_environment_passed({
+            'BUILD_MIRROR': 'file://' + local_mirror,
+            'BUILD_MIRROR_KEY': key_file
+        })
+
     def test_mirror(self):
         """Test that mirror parameter works."""
         mirror = 'http://' + self.random_string() + '/debian/'
@@ -257,6 +310,25 @@ class TestInvocation(unittest.TestCase):
         self.invoke(include_source=True, force=True)
         self.assert_environment_passed({'SOURCE_IN_IMAGE': 'true'})
 
+    def test_source_cache(self):
+        """Test that source packages are collected using source cache."""
+        self.invoke(download_source=True)
+        source_archive = self.get_built_file().rsplit('.img.xz')[0] + \
+            '-source.tar.gz'
+        self.assert_environment_passed({
+            'SOURCE_CACHE': os.path.abspath(
+                os.path.join(self.output_dir, 'cache', 'sources')),
+            'SOURCE_ARCHIVE': os.path.abspath(source_archive),
+        })
+
+    def test_preflight(self):
+        """Test that problems are found before building."""
+        custom_package = self.random_string() + '.deb'
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.invoke(skip_preflight=False, custom_package=custom_package)
+
+        self.assertFalse(os.path.exists(self.get_built_file()))
+
     def test_package(self):
         """Test that package parameter works."""
         package = self.random_string()
@@ -288,6 +360,20 @@ class TestInvocation(unittest.TestCase):
         self.invoke(hostname=hostname)
         self.assert_arguments_passed(['--hostname', hostname])
 
+    def test_cache_dir(self):
+        """Test that cache-dir parameter works."""
+        self.invoke()
+        self.assert_environment_passed({
+            'BLOB_CACHE': os.path.abspath(
+                os.path.join(self.output_dir, 'cache', 'blobs'))
+        })
+
+        cache_dir = os.path.join(self.output_dir, self.random_string())
+        self.invoke(cache_dir=cache_dir, force=True)
+        self.assert_environment_passed({
+            'BLOB_CACHE': os.path.abspath(os.path.join(cache_dir, 'blobs'))
+        })
+
     def test_no_force(self):
         """Test that not giving force parameter works."""
         self.invoke()
@@ -310,6 +396,42 @@ class TestInvocation(unittest.TestCase):
         """Test that sign parameter works."""
         # XXX: Implement
 
+    def test_checksum(self):
+        """Test that checksum of the archive is written next to it."""
+        self.invoke()
+        archive = self.get_built_file()
+        with open(archive + '.sha256', 'r') as file_handle:
+            checksum, file_name = file_handle.read().split()
+
+        self.assertEqual(file_name, os.path.basename(archive))
+        output = subprocess.check_output(['sha256sum', archive]).decode()
+        self.assertEqual(checksum, output.split()[0])
+
+    def test_build_in_ram(self):
+        """Test that image built in RAM is only written compressed."""
+        self.invoke(build_in_ram=True)
+        archive = self.get_built_file()
+        self.assertTrue(os.path.isfile(archive))
+        self.assertTrue(os.path.isfile(archive + '.sha256'))
+        self.assertFalse(os.path.exists(archive[:-len('.xz')]))
+
+    def test_cgroup(self):
+        """Test that the build runs in a group of its own with limits."""
+        self.invoke(memory_limit='1G', cpu_weight='50')
+        groups = [
+            os.path.join(self.cgroup_parent, name)
+            for name in os.listdir(self.cgroup_parent)
+            if os.path.isdir(os.path.join(self.cgroup_parent, name))
+        ]
+        self.assertEqual(len(groups), 1)
+        for file_name, value in (('memory.max', str(1024**3)),
+                                 ('cpu.weight', '50')):
+            with open(os.path.join(groups[0], file_name)) as file_handle:
+                self.assertEqual(file_handle.read().strip(), value)
+
+        self.assertTrue(
+            os.path.isfile(os.path.join(groups[0], 'cgroup.procs')))
+
     def test_multiple_targets(self):
         """Test that passing multiple targets works."""
         self.invoke(['amd64', 'i386'])
@@ -344,13 +466,15 @@ class TestInvocation(unittest.TestCase):
 
         Also tests:
           - verbose flag
-          - log file path
+          - log directory and its index
         """
         self.invoke(log_level='debug')
         self.assert_arguments_passed(['--verbose'])
         self.assert_arguments_passed(['--log-level', 'debug'])
-        log_file = self.get_built_file().rstrip('.img.xz') + '.log'
-        self.assert_file_exists(log_file)
+        log_directory = self.get_built_file().rstrip('.img.xz') + '.logs'
+        self.assert_file_exists(os.path.join(log_directory, 'index.json'))
+        self.assert_file_exists(
+            os.path.join(log_directory, 'vmdebootstrap.log.xz'))
 
         self.invoke(log_level='info', force=True)
         self.assert_arguments_passed(['--log-level', 'info'])
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for tracking loop devices of builds.
+"""
+
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from freedommaker import loop
+
+
+class TestLoopManager(unittest.TestCase):
+    """Tests for tracking loop devices of builds."""
+
+    def setUp(self):
+        """Setup test case."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry_directory = self.directory.name
+
+    def tearDown(self):
+        """Cleanup after test case."""
+        self.directory.cleanup()
+
+    def get_registries(self):
+        """Return the registry files present."""
+        return [
+            file_name for file_name in os.listdir(self.registry_directory)
+            if file_name.endswith('.json')
+        ]
+
+    def test_registry(self):
+        """Test that a running build keeps its registry."""
+        manager = loop.LoopManager(self.registry_directory)
+        manager.track_image('image.img')
+        registries = self.get_registries()
+        self.assertEqual(len(registries), 1)
+        with open(os.path.join(self.registry_directory, registries[0])) as \
+                file_handle:
+            registry = json.load(file_handle)
+
+        self.assertEqual(registry['pid'], os.getpid())
+        self.assertEqual(registry['images'], [os.path.abspath('image.img')])
+
+        loop.collect_garbage(self.registry_directory)
+        self.assertEqual(self.get_registries(), registries)
+
+        manager.images = []
+        manager.close()
+        self.assertEqual(self.get_registries(), [])
+
+    def test_deferred_interrupt(self):
+        """Test that interrupts wait for devices to be torn down."""
+        previous = signal.signal(
+            signal.SIGINT, loop.deferring(signal.default_int_handler))
+        tearing_down = threading.Event()
+        torn_down = threading.Event()
+
+        def teardown():
+            with loop._signals_blocked():
+                tearing_down.set()
+                torn_down.wait()
+
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                with loop._signals_blocked():
+                    os.kill(os.getpid(), signal.SIGINT)
+                    time.sleep(0.1)
+
+            thread = threading.Thread(target=teardown)
+            thread.start()
+            tearing_down.wait()
+            os.kill(os.getpid(), signal.SIGINT)
+            time.sleep(0.1)
+            torn_down.set()
+            with self.assertRaises(KeyboardInterrupt):
+                thread.join()
+                time.sleep(1)
+
+            thread.join()
+        finally:
+            torn_down.set()
+            signal.signal(signal.SIGINT, previous)
+
+    def test_collect_garbage(self):
+        """Test that registries of dead builds are removed."""
+        with open(os.path.join(self.registry_directory, '1-dead.json'),
+                  'w') as file_handle:
+            json.dump({'pid': 1, 'devices': [], 'images': []}, file_handle)
+
+        loop.collect_garbage(self.registry_directory)
+        self.assertEqual(self.get_registries(), [])
+
+    def test_collect_garbage_reused_device(self):
+        """Test that devices now backed by other images are kept."""
+        registry = {
+            'pid': 1,
+            'devices': [['/dev/loop7', '/build/dead.img'],
+                        ['/dev/loop8', '/build/dead-other.img']],
+            'images': []
+        }
+        with open(os.path.join(self.registry_directory, '1-dead.json'),
+                  'w') as file_handle:
+            json.dump(registry, file_handle)
+
+        back_files = {
+            '/dev/loop7': '/build/live.img',
+            '/dev/loop8': '/build/dead-other.img'
+        }
+        with mock.patch.object(loop, 'get_back_file', back_files.get), \
+                mock.patch.object(loop, 'teardown') as teardown:
+            loop.collect_garbage(self.registry_directory)
+
+        teardown.assert_called_once_with('/dev/loop8')
+        self.assertEqual(self.get_registries(), [])
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for metrics of builds.
+"""
+
+import argparse
+import collections
+import os
+import tempfile
+import unittest
+
+from freedommaker import metrics
+
+
+class FakeBuilder(object):
+    """Builder of a finished build."""
+
+    builder_backend = 'vmdebootstrap'
+
+    def __init__(self, build_dir):
+        """Initialize the object."""
+        self.arguments = argparse.Namespace(build_dir=build_dir)
+        self.started = 1000
+        self.reused_from = None
+        self.stage_durations = collections.OrderedDict(
+            [('make_image', 600), ('compress', 120)])
+        self.compressions = [{
+            'file': '/tmp/ram/freedombox_amd64.img',
+            'size': 4000,
+            'seconds': 2
+        }]
+        self.cache_statistics = {
+            'package_index': collections.Counter(hits=3, misses=1)
+        }
+
+    @staticmethod
+    def get_target_name():
+        """Return the name of the target."""
+        return 'amd64'
+
+    @staticmethod
+    def _get_image_base_name():
+        """Return base file name of the image."""
+        return 'freedombox_amd64'
+
+    @staticmethod
+    def get_artifact_sizes():
+        """Return sizes of the files built."""
+        return {'.img': 4000, '.img.xz': 100}
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for metrics of builds."""
+
+    def test_textfile(self):
+        """Test writing metrics of a build."""
+        with tempfile.TemporaryDirectory() as directory:
+            samples = metrics.get_build_samples(FakeBuilder(directory), True,
+                                                1800)
+            file_name = os.path.join(directory, 'amd64.prom')
+            metrics.write_textfile(file_name, samples)
+            with open(file_name, 'r') as file_handle:
+                lines = file_handle.read().splitlines()
+
+            self.assertEqual(os.listdir(directory).count('amd64.prom'), 1)
+
+        expected = [
+            'freedommaker_build_success{backend="vmdebootstrap",'
+            'target="amd64"} 1.0',
+            'freedommaker_build_duration_seconds{backend="vmdebootstrap",'
+            'target="amd64"} 800.0',
+            'freedommaker_stage_duration_seconds{backend="vmdebootstrap",'
+            'stage="compress",target="amd64"} 120.0',
+            'freedommaker_artifact_size_bytes{artifact=".img",'
+            'target="amd64"} 4000.0',
+            'freedommaker_artifact_size_bytes{artifact=".img.xz",'
+            'target="amd64"} 100.0',
+            'freedommaker_compression_throughput_bytes_per_second{'
+            'artifact=".img",target="amd64"} 2000.0',
+            'freedommaker_cache_hit_ratio{cache="package_index",'
+            'target="amd64"} 0.75',
+            '# TYPE freedommaker_build_reused gauge',
+        ]
+        for line in expected:
+            self.assertIn(line, lines)
+
+    def test_labels(self):
+        """Test escaping label values."""
+        self.assertEqual(metrics.format_labels({'b': 'a"b\\', 'a': 1}),
+                         'a="1",b="a\\"b\\\\"')
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for synchronizing and signing the local mirror.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from freedommaker.builder import ImageBuilder
+from freedommaker.mirror import LocalMirror, get_target_source_packages
+
+PACKAGES = {
+    'plinth': 'Depends: python3\n',
+    'python3': 'Priority: optional\n',
+    'tor': '',
+}
+
+
+@unittest.skipUnless(shutil.which('gpg'), 'gpg is not installed')
+class TestLocalMirror(unittest.TestCase):
+    """Tests for synchronizing and signing the local mirror."""
+
+    def setUp(self):
+        """Create an upstream mirror and a keyring with two keys."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.gnupg_home = os.environ.get('GNUPGHOME')
+        os.environ['GNUPGHOME'] = os.path.join(self.directory.name, 'gnupg')
+        os.makedirs(os.environ['GNUPGHOME'], mode=0o700)
+        for user in ('first', 'second'):
+            subprocess.check_call([
+                'gpg', '--batch', '--passphrase', '', '--quick-gen-key',
+                '{0} <{0}@example.org>'.format(user), 'default', 'default',
+                'never'
+            ], stderr=subprocess.DEVNULL)
+
+        self.upstream = os.path.join(self.directory.name, 'upstream')
+        binary = os.path.join(self.upstream, 'dists', 'unstable', 'main',
+                              'binary-amd64')
+        os.makedirs(binary)
+        os.makedirs(os.path.join(self.upstream, 'pool'))
+        with open(os.path.join(self.upstream, 'dists', 'unstable',
+                               'Release'), 'w') as file_handle:
+            file_handle.write('Suite: unstable\n')
+
+        stanzas = []
+        for name, fields in sorted(PACKAGES.items()):
+            contents = name.encode()
+            with open(os.path.join(self.upstream, 'pool', name + '.deb'),
+                      'wb') as file_handle:
+                file_handle.write(contents)
+
+            stanzas.append(
+                'Package: {}\nVersion: 1.0\nArchitecture: amd64\n{}'
+                'Filename: pool/{}.deb\nSHA256: {}\n'.format(
+                    name, fields, name,
+                    hashlib.sha256(contents).hexdigest()))
+
+        with open(os.path.join(binary, 'Packages'), 'w') as file_handle:
+            file_handle.write('\n'.join(stanzas))
+
+        self.cache = os.path.join(self.directory.name, 'cache')
+        os.makedirs(self.cache)
+        self.mirror = LocalMirror(os.path.join(self.directory.name, 'mirror'),
+                                  'unstable')
+
+    def tearDown(self):
+        """Remove the mirrors and the keyring."""
+        if self.gnupg_home is None:
+            del os.environ['GNUPGHOME']
+        else:
+            os.environ['GNUPGHOME'] = self.gnupg_home
+
+        self.directory.cleanup()
+
+    def get_exported_keys(self):
+        """Return the user IDs of keys exported with the mirror."""
+        output = subprocess.check_output(
+            ['gpg', '--with-colons', '--show-keys', self.mirror.key_file],
+            stderr=subprocess.DEVNULL).decode()
+        return [
+            line.split(':')[9] for line in output.splitlines()
+            if line.startswith('uid:')
+        ]
+
+    def test_covers(self):
+        """Test that the mirror is used only for what it was synced for."""
+        self.assertFalse(self.mirror.covers({'amd64': ['plinth']}, ['main']))
+        self.mirror.sync(self.upstream, {'amd64': ['plinth']}, ['main'],
+                         self.cache)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.mirror.directory, 'pool', 'python3.deb')))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.mirror.directory, 'pool', 'tor.deb')))
+
+        self.assertTrue(self.mirror.covers({'amd64': ['plinth']}, ['main']))
+        self.assertFalse(self.mirror.covers({'amd64': ['plinth', 'tor']},
+                                            ['main']))
+        self.assertFalse(self.mirror.covers({'i386': ['plinth']}, ['main']))
+        self.assertFalse(self.mirror.covers({'amd64': ['plinth']},
+                                            ['main', 'contrib']))
+
+    def test_covers_sources(self):
+        """Test that builds fetching source packages use build mirror."""
+        self.mirror.sync(self.upstream, {'amd64': ['plinth']}, ['main'],
+                         self.cache)
+        arguments = argparse.Namespace(download_source=False, package=None,
+                                       variant=None)
+        for target, expected in (('amd64', True), ('raspberry2', False),
+                                 ('raspberry3', False)):
+            cls = ImageBuilder.get_builder_class(target)
+            sources = get_target_source_packages(cls, arguments)
+            self.assertEqual(
+                self.mirror.covers({'amd64': ['plinth']}, ['main'], sources),
+                expected)
+
+        arguments.download_source = True
+        cls = ImageBuilder.get_builder_class('amd64')
+        sources = get_target_source_packages(cls, arguments)
+        self.assertFalse(
+            self.mirror.covers({'amd64': ['plinth']}, ['main'], sources))
+
+    def test_sign(self):
+        """Test that only the key signing the mirror is exported."""
+        self.mirror.sync(self.upstream, {'amd64': ['plinth']}, ['main'],
+                         self.cache, key='second@example.org')
+        self.assertEqual(self.get_exported_keys(),
+                         ['second <second@example.org>'])
+
+        self.mirror.sync(self.upstream, {'amd64': ['plinth']}, ['main'],
+                         self.cache)
+        self.assertEqual(len(self.get_exported_keys()), 1)
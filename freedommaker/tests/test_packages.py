@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for reading package indexes of a mirror.
+"""
+
+import gzip
+import io
+import os
+import tempfile
+import unittest
+
+from freedommaker.packages import LOADED_INDEXES, PackageIndex, \
+    parse_stanzas
+
+PACKAGES = '''Package: plinth
+Version: 0.20.0
+Architecture: all
+Depends: python3,
+ python3-django
+
+Package: tor
+Version: 0.3.1.7-1
+Architecture: amd64
+'''
+
+
+class TestPackageIndex(unittest.TestCase):
+    """Tests for reading package indexes of a mirror."""
+
+    def test_parse_stanzas(self):
+        """Test parsing stanzas with continuation lines."""
+        stanzas = list(parse_stanzas(io.StringIO(PACKAGES)))
+        self.assertEqual(len(stanzas), 2)
+        self.assertEqual(stanzas[0]['Depends'], 'python3,\npython3-django')
+        self.assertEqual(stanzas[1]['Version'], '0.3.1.7-1')
+
+    def test_changes(self):
+        """Test finding packages with versions different from installed."""
+        index = PackageIndex()
+        index.read(io.StringIO(PACKAGES))
+        installed = {
+            'plinth:all': '0.20.0',
+            'tor:amd64': '0.3.1.6-1',
+            'custom:all': '1.0',
+        }
+        self.assertEqual(index.get_changes(installed),
+                         {'tor:amd64': ('0.3.1.6-1', '0.3.1.7-1')})
+
+    def test_additions(self):
+        """Test finding packages needed that are not installed."""
+        index = PackageIndex()
+        index.read(io.StringIO(PACKAGES + '''
+Package: python3
+Version: 3.6.3-2
+
+Package: python3-django
+Version: 1:1.11.7-1
+'''))
+        installed = {'plinth:all': '0.20.0', 'python3:amd64': '3.6.3-2'}
+        self.assertEqual(index.get_additions(['plinth'], installed),
+                         {'python3-django': '1:1.11.7-1'})
+        self.assertEqual(index.get_additions(['plinth', 'tor'], installed),
+                         {'python3-django': '1:1.11.7-1',
+                          'tor': '0.3.1.7-1'})
+        installed['python3-django:all'] = '1:1.11.7-1'
+        self.assertEqual(index.get_additions(['plinth'], installed), {})
+
+    def test_additions_alternatives(self):
+        """Test that relations are satisfied by any installed package."""
+        index = PackageIndex()
+        index.read(io.StringIO('''Package: plinth
+Version: 1.0
+Depends: a | b, mail-transport-agent
+Recommends: tor
+
+Package: a
+Version: 1.0
+
+Package: b
+Version: 1.0
+
+Package: exim4
+Version: 1.0
+Provides: mail-transport-agent
+
+Package: postfix
+Version: 1.0
+Provides: mail-transport-agent
+
+Package: tor
+Version: 1.0
+'''))
+        installed = {
+            'plinth:all': '1.0',
+            'b:amd64': '1.0',
+            'postfix:amd64': '1.0'
+        }
+        self.assertEqual(index.get_additions(['plinth'], installed), {})
+        del installed['b:amd64']
+        self.assertEqual(index.get_additions(['plinth'], installed),
+                         {'a': '1.0'})
+
+    def test_resolve(self):
+        """Test resolving dependencies with alternatives and providers."""
+        index = PackageIndex()
+        index.read(io.StringIO('''Package: plinth
+Depends: python3 (>= 3.5) | python3-minimal, mail-transport-agent
+Recommends: tor:any
+
+Package: python3
+
+Package: exim4
+Provides: mail-transport-agent
+
+Package: tor
+
+Package: base-files
+Priority: required
+'''))
+        selected, missing = index.resolve(['plinth', 'missing'])
+        self.assertEqual(selected, {'plinth', 'python3', 'exim4', 'tor'})
+        self.assertEqual(missing, ['missing'])
+        self.assertEqual(index.get_priority_packages(['required']),
+                         ['base-files'])
+
+    def test_load_local_mirror(self):
+        """Test loading and caching the index of a local mirror."""
+        with tempfile.TemporaryDirectory() as directory:
+            mirror = os.path.join(directory, 'mirror')
+            binary = os.path.join(mirror, 'dists', 'unstable', 'main',
+                                  'binary-amd64')
+            os.makedirs(binary)
+            with open(os.path.join(mirror, 'dists', 'unstable', 'Release'),
+                      'w') as file_handle:
+                file_handle.write('Suite: unstable\n')
+
+            with gzip.open(os.path.join(binary, 'Packages.gz'), 'wt') as \
+                    file_handle:
+                file_handle.write(PACKAGES)
+
+            cache = os.path.join(directory, 'cache')
+            os.makedirs(cache)
+            self.assertIsNone(PackageIndex.load(
+                mirror, 'unstable', 'amd64', ['main'], cache, offline=True))
+
+            index = PackageIndex.load(mirror, 'unstable', 'amd64', ['main'],
+                                      cache)
+            self.assertEqual(index.get_version('plinth'), '0.20.0')
+
+            index = PackageIndex.load(mirror, 'unstable', 'amd64', ['main'],
+                                      cache, offline=True)
+            self.assertEqual(index.get_version('tor'), '0.3.1.7-1')
+
+            # Indexes of earlier releases are unloaded
+            for number in range(LOADED_INDEXES + 1):
+                with open(os.path.join(mirror, 'dists', 'unstable',
+                                       'Release'), 'w') as file_handle:
+                    file_handle.write('Suite: unstable\nDate: {}\n'.format(
+                        number))
+
+                PackageIndex.load(mirror, 'unstable', 'amd64', ['main'],
+                                  cache)
+
+            self.assertEqual(len(PackageIndex._loaded), LOADED_INDEXES)
+            self.assertNotIn(index, PackageIndex._loaded.values())
@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for running stages of several builds at the same time.
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import threading
+import time
+import unittest
+
+from freedommaker import pipeline
+
+
+class FakeBuilder(object):
+    """Builder with stages that record how many ran at the same time."""
+
+    def __init__(self, target, counters, fail_stage=None):
+        """Initialize the object."""
+        self.target = target
+        self.counters = counters
+        self.fail_stage = fail_stage
+        self.stages = []
+        self.failed = False
+        self.cleaned_up = False
+
+    def prepare(self):
+        """Count builds running at the same time."""
+        with self.counters['lock']:
+            self.counters['builds'] += 1
+            self.counters['max_builds'] = max(self.counters['max_builds'],
+                                              self.counters['builds'])
+
+        if self.fail_stage == 'prepare':
+            raise RuntimeError('Failed prepare')
+
+    def get_stages(self):
+        """Return stages that count concurrent runs."""
+        return [(stage, self._get_function(stage))
+                for stage in ('make_image', 'compress', 'sign')]
+
+    def run_stage(self, stage, function):
+        """Run a stage."""
+        function()
+
+    def complete(self):
+        """Do nothing."""
+        pass
+
+    def fail(self):
+        """Record that the build failed."""
+        self.failed = True
+
+    def cleanup(self):
+        """Record that cleanup ran."""
+        self.cleaned_up = True
+        with self.counters['lock']:
+            self.counters['builds'] -= 1
+
+    def _get_function(self, stage):
+        """Return a stage function that records its concurrency."""
+        def function():
+            with self.counters['lock']:
+                self.counters[stage] += 1
+                self.counters['max_' + stage] = max(
+                    self.counters['max_' + stage], self.counters[stage])
+
+            time.sleep(0.05)
+            with self.counters['lock']:
+                self.counters[stage] -= 1
+
+            self.stages.append(stage)
+            if stage == self.fail_stage:
+                raise RuntimeError('Failed ' + stage)
+
+        return function
+
+
+class InterruptedBuilder(FakeBuilder):
+    """Builder interrupted while its image is made by a command."""
+
+    def __init__(self, target, counters):
+        """Initialize the object."""
+        super().__init__(target, counters)
+        self.process = None
+
+    def cancel(self):
+        """Stop the command."""
+        if self.process:
+            self.process.terminate()
+
+    def _get_function(self, stage):
+        """Return a stage function interrupting the build."""
+        def function():
+            self.stages.append(stage)
+            self.process = subprocess.Popen(['sleep', '60'])
+            # Let the main thread start waiting for the builds
+            time.sleep(0.2)
+            os.kill(os.getpid(), signal.SIGINT)
+            if self.process.wait():
+                raise subprocess.CalledProcessError(self.process.returncode,
+                                                    'sleep')
+
+        return function
+
+
+class TestPipeline(unittest.TestCase):
+    """Tests for running stages of several builds at the same time."""
+
+    def setUp(self):
+        """Setup test fixtures."""
+        self.counters = {'lock': threading.Lock(), 'builds': 0,
+                         'max_builds': 0}
+        for stage in ('make_image', 'compress', 'sign'):
+            self.counters[stage] = 0
+            self.counters['max_' + stage] = 0
+
+        self.builders = {}
+
+    def create_builder(self, target, fail_stage=None):
+        """Create and remember a fake builder."""
+        builder = FakeBuilder(target, self.counters, fail_stage)
+        self.builders[target] = builder
+        return builder
+
+    def test_limits(self):
+        """Test that stages of targets overlap within limits."""
+        executor = pipeline.Pipeline([('compress', 3)])
+        targets = ['a', 'b', 'c', 'd']
+        executor.run(targets, self.create_builder)
+
+        for builder in self.builders.values():
+            self.assertEqual(builder.stages, ['make_image', 'compress',
+                                              'sign'])
+            self.assertTrue(builder.cleaned_up)
+
+        self.assertEqual(self.counters['max_make_image'], 1)
+        self.assertLessEqual(self.counters['max_compress'], 3)
+        self.assertEqual(len(executor.timeline), 12)
+        for entry in executor.timeline:
+            self.assertEqual(entry['status'], 'done')
+            self.assertLessEqual(entry['queued'], entry['started'])
+            self.assertLessEqual(entry['started'], entry['ended'])
+
+    def test_failure(self):
+        """Test that no stages start after a target fails."""
+        def create_builder(target):
+            fail_stage = 'make_image' if target == 'a' else None
+            return self.create_builder(target, fail_stage)
+
+        executor = pipeline.Pipeline()
+        with self.assertRaises(RuntimeError):
+            executor.run(['a', 'b'], create_builder)
+
+        self.assertEqual(self.builders['a'].stages, ['make_image'])
+        self.assertTrue(self.builders['a'].failed)
+        self.assertTrue(self.builders['a'].cleaned_up)
+        if 'b' in self.builders:
+            self.assertNotIn('sign', self.builders['b'].stages)
+
+        failed = [entry for entry in executor.timeline
+                  if entry['status'] == 'failed']
+        self.assertEqual(failed[0]['target'], 'a')
+
+    def test_prepare_failure(self):
+        """Test that failing before the first stage fails the build."""
+        executor = pipeline.Pipeline()
+        with self.assertRaises(RuntimeError):
+            executor.run(['a'], lambda target: self.create_builder(
+                target, 'prepare'))
+
+        self.assertEqual(self.builders['a'].stages, [])
+        self.assertTrue(self.builders['a'].failed)
+        self.assertTrue(self.builders['a'].cleaned_up)
+
+    def test_workers(self):
+        """Test that targets wait for a worker to build them."""
+        executor = pipeline.Pipeline()
+        targets = [str(number) for number in range(executor.workers + 2)]
+        executor.run(targets, self.create_builder)
+
+        self.assertEqual(sorted(self.builders), sorted(targets))
+        self.assertLessEqual(self.counters['max_builds'], executor.workers)
+
+    def test_interrupt(self):
+        """Test that interrupting stops the commands of running stages."""
+        def create_builder(target):
+            builder = InterruptedBuilder(target, self.counters)
+            self.builders[target] = builder
+            return builder
+
+        handler = signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            started = time.time()
+            executor = pipeline.Pipeline()
+            with self.assertRaises(KeyboardInterrupt):
+                executor.run(['a', 'b'], create_builder)
+        finally:
+            signal.signal(signal.SIGINT, handler)
+
+        self.assertLess(time.time() - started, 30)
+        interrupted = [
+            builder for builder in self.builders.values() if builder.process
+        ]
+        self.assertEqual(len(interrupted), 1)
+        self.assertEqual(interrupted[0].process.returncode, -signal.SIGTERM)
+        self.assertTrue(interrupted[0].cleaned_up)
+        self.assertEqual(sum(len(builder.stages)
+                             for builder in self.builders.values()), 1)
+
+    def test_parse_stage_limit(self):
+        """Test parsing stage limits from command line."""
+        self.assertEqual(pipeline.parse_stage_limit('compress=2'),
+                         ('compress', 2))
+        for value in ('compress', 'compress=x', 'unknown=1', 'sign=0'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                pipeline.parse_stage_limit(value)
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for plans of builds.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from freedommaker import plan
+
+
+class TestPlan(unittest.TestCase):
+    """Tests for plans of builds."""
+
+    base_name = 'freedombox-unstable-free_plan_all-amd64'
+
+    def setUp(self):
+        """Create an empty build directory."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.build_dir = os.path.join(self.directory.name, 'build')
+
+    def tearDown(self):
+        """Remove the build directory."""
+        self.directory.cleanup()
+
+    def get_plan(self, *arguments):
+        """Return the plan of a build as written by --plan."""
+        output = subprocess.check_output(
+            [
+                sys.executable, '-m', 'freedommaker', '--plan',
+                '--plan-format', 'json', '--build-dir', self.build_dir,
+                '--build-stamp', 'plan'
+            ] + list(arguments),
+            stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+        return {target['target']: target
+                for target in json.loads(output)['targets']}
+
+    def write_file(self, suffix):
+        """Create an artifact of the build in the build directory."""
+        os.makedirs(self.build_dir, exist_ok=True)
+        open(os.path.join(self.build_dir, self.base_name + suffix),
+             'w').close()
+
+    def test_full_build(self):
+        """Test planning a build from scratch without creating anything."""
+        plans = self.get_plan('amd64', 'raspberry2')
+        self.assertFalse(os.path.exists(self.build_dir))
+        stages = plans['amd64']['stages']
+        self.assertEqual([stage['stage'] for stage in stages],
+                         ['make_image', 'compress', 'sign'])
+        command = stages[0]['steps'][0]['command']
+        self.assertIn('vmdebootstrap', command)
+        self.assertIn('SUITE=unstable', command)
+        self.assertEqual(
+            command[command.index('--image') + 1],
+            os.path.join(self.build_dir, self.base_name + '.img.temp'))
+        command = plans['raspberry2']['stages'][0]['steps'][0]['command']
+        self.assertEqual(command[:3], ['taskset', '--cpu-list', '{cpus}'])
+
+    def test_skipped_stages(self):
+        """Test that stages explain why they are skipped."""
+        self.write_file('.img.xz')
+        stages = self.get_plan('amd64')['amd64']['stages']
+        self.assertEqual(stages[0]['reason'], 'compressed image exists')
+        self.assertEqual(stages[0]['steps'], [])
+        self.assertEqual(stages[1]['steps'], [])
+        self.assertEqual(len(stages[2]['steps']), 1)
+
+        self.write_file('.qcow2.xz')
+        stages = self.get_plan('qemu-amd64')['qemu-amd64']['stages']
+        self.assertEqual([stage['stage'] for stage in stages], ['sign'])
+
+    def test_delta_index(self):
+        """Test that compressing in blocks also writes the delta index."""
+        stages = self.get_plan('--delta-block-size', '4M',
+                               'amd64')['amd64']['stages']
+        steps = stages[1]['steps']
+        self.assertEqual(steps[0]['command'][-2:],
+                         ['--block-size=4194304', '--stdout'])
+        self.assertEqual(
+            steps[1]['command'][-1],
+            os.path.join(self.build_dir, self.base_name + '.img.xz'))
+
+    def test_chunk_stage(self):
+        """Test that images are added to the chunk store in a stage."""
+        stages = self.get_plan('--chunk-store',
+                               os.path.join(self.directory.name, 'chunks'),
+                               '--drop-chunked-images',
+                               'amd64')['amd64']['stages']
+        self.assertEqual([stage['stage'] for stage in stages],
+                         ['make_image', 'compress', 'sign', 'chunk'])
+        self.assertEqual(len(stages[3]['steps']), 2)
+
+    def test_build_in_ram(self):
+        """Test that targets are not taken for the kind of RAM disk."""
+        plans = self.get_plan('--build-in-ram', 'amd64', '--ram-disk',
+                              'zram', 'i386')
+        self.assertEqual(sorted(plans), ['amd64', 'i386'])
+        command = plans['amd64']['stages'][0]['steps'][0]['command']
+        self.assertEqual(
+            command[command.index('--image') + 1],
+            os.path.join('{ram_disk}', self.base_name + '.img'))
+
+    def test_schedule(self):
+        """Test that stages wait for free slots of the pipeline."""
+        plans = [{
+            'stages': [{
+                'stage': 'make_image',
+                'seconds': 100
+            }, {
+                'stage': 'compress',
+                'seconds': 50
+            }, {
+                'stage': 'sign',
+                'seconds': None
+            }]
+        } for _ in range(3)]
+        self.assertEqual(plan.schedule(plans), 350)
+        self.assertEqual([target['stages'][0]['start'] for target in plans],
+                         [0, 100, 200])
+        self.assertEqual([target['stages'][1]['start'] for target in plans],
+                         [100, 200, 300])
+
+        # Third target waits for one of the two compress slots
+        self.assertEqual(plan.schedule(plans, [('make_image', 3)]), 200)
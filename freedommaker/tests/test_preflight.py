@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for checks done before building.
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import unittest
+
+from freedommaker.builder import ImageBuilder
+from freedommaker.packages import PackageIndex
+from freedommaker.preflight import Preflight, parse_size
+
+
+class TestPreflight(unittest.TestCase):
+    """Tests for checks done before building."""
+
+    def setUp(self):
+        """Setup test case."""
+        self.arguments = argparse.Namespace(
+            build_mirror='http://deb.debian.org/debian',
+            distribution='unstable', package=['tor', 'typo'],
+            custom_package=None, variant=None, vmdebootstrap='vmdebootstrap',
+            sign=False, build_in_ram=None)
+        self.preflight = Preflight(self.arguments)
+
+    def test_parse_size(self):
+        """Test parsing image sizes."""
+        self.assertEqual(parse_size('3800M'), 3800 * 1024**2)
+        self.assertEqual(parse_size('4G'), 4 * 1024**3)
+        self.assertEqual(parse_size('1.5GiB'), 3 * 1024**3 // 2)
+        self.assertEqual(parse_size('512'), 512)
+
+    def test_packages(self):
+        """Test that unavailable packages and kernels are reported."""
+        index = PackageIndex()
+        index.read(io.StringIO(
+            'Package: initramfs-tools\n\nPackage: btrfs-progs\n\n'
+            'Package: grub-pc\n\nPackage: linux-image-amd64\n\n'
+            'Package: tor\n\nPackage: linux-image-686\n'))
+        self.preflight.indexes[('amd64', ('main',))] = index
+        self.preflight.indexes[('i386', ('main',))] = index
+        self.preflight.check_packages(ImageBuilder.get_builder_class('amd64'))
+        self.preflight.check_packages(ImageBuilder.get_builder_class('i386'))
+        self.assertEqual(
+            [problem for _, problem in self.preflight.problems], [
+                'Package typo not available for amd64 in '
+                'http://deb.debian.org/debian',
+                'Package typo not available for i386 in '
+                'http://deb.debian.org/debian',
+            ])
+
+    def test_disk_space(self):
+        """Test that space is needed for the images of all targets."""
+        with tempfile.TemporaryDirectory() as directory:
+            statistics = os.statvfs(directory)
+            available = statistics.f_bavail * statistics.f_frsize
+            self.arguments.build_dir = directory
+            self.arguments.image_size = str(available * 3 // 5)
+            self.preflight.check_disk_space(1)
+            self.assertEqual(self.preflight.problems, [])
+
+            self.preflight.check_disk_space(2)
+            self.assertEqual(len(self.preflight.problems), 1)
+            self.assertIn('2 images need',
+                          self.preflight.problems[0][1])
+
+    def test_tools(self):
+        """Test that missing programs are reported."""
+        self.arguments.vmdebootstrap = '/nonexistent/vmdebootstrap'
+        self.preflight.check_tools(ImageBuilder.get_builder_class('amd64'))
+        self.assertIn(('amd64', 'Program /nonexistent/vmdebootstrap not '
+                       'found'), self.preflight.problems)
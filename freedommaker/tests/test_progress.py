@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for following progress of builds.
+"""
+
+import io
+import unittest
+
+from freedommaker import progress
+
+DEBOOTSTRAP_OUTPUT = '''Debootstrapping unstable [amd64]
+I: Retrieving InRelease
+I: Retrieving Packages
+I: Retrieving libacl1 2.2.52-3+b1
+I: Validating libacl1 2.2.52-3+b1
+I: Retrieving adduser 3.117
+I: Validating adduser 3.117
+I: Chosen extractor for .deb packages: dpkg-deb
+I: Extracting libacl1...
+'''
+
+APT_OUTPUT = '''+ echo 'info: phase - packages'
+info: phase - packages
+0 upgraded, 4 newly installed, 0 to remove and 0 not upgraded.
+Need to get 2,000 kB of archives.
+Get:1 http://deb.debian.org/debian unstable/main amd64 a 1.0 [1,500 kB]
+Get:2 http://deb.debian.org/debian unstable/main amd64 b 1.0 [500 kB]
+Fetched 2,000 kB in 1s (2,000 kB/s)
+Selecting previously unselected package a.
+Unpacking a (1.0) ...
+Unpacking b (1.0) ...
+Setting up a (1.0) ...
+'''
+
+
+class TestProgress(unittest.TestCase):
+    """Tests for following progress of builds."""
+
+    @staticmethod
+    def feed(parser, output):
+        """Feed lines of output, return names of phases started."""
+        return [
+            parser.get_name() for line in output.splitlines()
+            if parser.feed(line)
+        ]
+
+    def test_debootstrap(self):
+        """Test following debootstrap run by vmdebootstrap."""
+        parser = progress.ProgressParser()
+        self.assertEqual(self.feed(parser, DEBOOTSTRAP_OUTPUT), [
+            'debootstrap', 'debootstrap / debootstrap retrieve',
+            'debootstrap / debootstrap extract'
+        ])
+        self.assertEqual((parser.done, parser.total), (1, 2))
+        status = parser.get_status(parser.phase_started + 10)
+        self.assertEqual(status,
+                         'debootstrap / debootstrap extract 1/2 50% 0.1/s '
+                         'ETA 10s')
+
+    def test_apt(self):
+        """Test following apt and dpkg in a customization phase."""
+        parser = progress.ProgressParser()
+        lines = APT_OUTPUT.splitlines()
+        self.assertEqual(self.feed(parser, '\n'.join(lines[:5])), [
+            'customize packages', 'customize packages / apt download'
+        ])
+        self.assertEqual(parser.bytes_total, 2000000)
+        status = parser.get_status(parser.phase_started + 2)
+        self.assertEqual(status, 'customize packages / apt download 1/1 MiB '
+                         '75% 0.7 MiB/s ETA 1s')
+
+        self.assertEqual(self.feed(parser, '\n'.join(lines[5:])), [
+            'customize packages / dpkg unpack',
+            'customize packages / dpkg set up'
+        ])
+        self.assertEqual(parser.get_status(parser.phase_started + 4),
+                         'customize packages / dpkg set up 1/4 25% 0.2/s '
+                         'ETA 12s')
+
+    def test_display(self):
+        """Test that log messages are written above progress lines."""
+        stream = io.StringIO()
+        display = progress.ProgressDisplay(stream, interval=0)
+        display.update('amd64', 'debootstrap')
+        display.update('i386', 'customize')
+        display.write('message\n')
+        display.update('amd64', None)
+        self.assertEqual(stream.getvalue(), ''.join([
+            'amd64: debootstrap\n',
+            '\r\033[1A\033[J', 'amd64: debootstrap\n', 'i386: customize\n',
+            '\r\033[2A\033[J', 'message\n', 'amd64: debootstrap\n',
+            'i386: customize\n', '\r\033[2A\033[J', 'i386: customize\n'
+        ]))
+
+    def test_apt_size(self):
+        """Test parsing sizes printed by apt."""
+        self.assertEqual(progress.parse_apt_size('1,234 kB'), 1234000)
+        self.assertEqual(progress.parse_apt_size('45.3 MB'), 45300000)
+        self.assertEqual(progress.parse_apt_size('12 B'), 12)
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for file systems in RAM.
+"""
+
+import unittest
+
+from freedommaker import ramdisk
+
+
+class RecordingBuilder(object):
+    """Builder that records commands instead of running them."""
+
+    def __init__(self):
+        """Initialize the object."""
+        self.commands = []
+
+    def _run(self, command):
+        """Record a command."""
+        self.commands.append(command)
+        if command[1] == 'mkfs.ext4':
+            raise RuntimeError('mkfs.ext4 failed')
+
+    def _run_output(self, command):
+        """Record a command and return the number of a zram device."""
+        self.commands.append(command)
+        return '3\n'
+
+
+class TestRamDisk(unittest.TestCase):
+    """Tests for file systems in RAM."""
+
+    def test_tmpfs(self):
+        """Test that tmpfs is limited to the image size and headroom."""
+        builder = RecordingBuilder()
+        ram_disk = ramdisk.get_ram_disk_class('tmpfs')(builder, 1024)
+        ram_disk.mount('/tmp/ram')
+        ram_disk.unmount()
+        self.assertEqual(builder.commands, [
+            ['sudo', 'mount', '-t', 'tmpfs', '-o', 'size=1126', 'tmpfs',
+             '/tmp/ram'],
+            ['sudo', 'umount', '/tmp/ram'],
+        ])
+        self.assertIsNone(ram_disk.get_statistics())
+
+    def test_unmount_not_mounted(self):
+        """Test that nothing is unmounted if mounting failed."""
+        builder = RecordingBuilder()
+        ram_disk = ramdisk.get_ram_disk_class('tmpfs')(builder, 1024)
+        ram_disk.unmount()
+        self.assertEqual(builder.commands, [])
+
+    def test_zram_failed_setup(self):
+        """Test that the zram device is removed if setting it up fails."""
+        builder = RecordingBuilder()
+        ram_disk = ramdisk.get_ram_disk_class('zram')(builder, 1024)
+        ram_disk._read = lambda attribute: 'lzo [lz4]'
+        with self.assertRaises(RuntimeError):
+            ram_disk.mount('/tmp/ram')
+
+        self.assertEqual(builder.commands[-2:], [
+            ['sudo', 'sh', '-c', 'echo "$1" > "$0"',
+             '/sys/block/zram3/reset', '1'],
+            ['sudo', 'sh', '-c', 'echo "$1" > "$0"',
+             '/sys/class/zram-control/hot_remove', '3'],
+        ])
+        self.assertNotIn(['sudo', 'umount', '/tmp/ram'], builder.commands)
+        self.assertIsNone(ram_disk.device)
+
+        commands = list(builder.commands)
+        ram_disk.unmount()
+        self.assertEqual(builder.commands, commands)
+
+    def test_zram_statistics(self):
+        """Test reading compression statistics of a zram device."""
+        ram_disk = ramdisk.get_ram_disk_class('zram')(RecordingBuilder(),
+                                                      1024)
+        ram_disk._read = lambda attribute: \
+            '4096000 1024000 1200000 0 1500000 100 0 0'
+        self.assertEqual(ram_disk.get_statistics(), {
+            'original': 4096000,
+            'compressed': 1024000,
+            'ratio': 4.0,
+            'peak': 1500000,
+        })
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for sampling resources used by builds.
+"""
+
+import csv
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from freedommaker import sampling
+
+
+class FakeBuilder(object):
+    """Builder with a running command and no cgroup."""
+
+    def __init__(self):
+        """Initialize the object."""
+        self.current_stage = 'compress'
+        self.current_command = 'xz'
+        self.running_commands = set()
+        self.threads = set()
+        self.finished_usage = {'cpu_seconds': 1.5}
+        self.cgroup = None
+
+
+class TestSampling(unittest.TestCase):
+    """Tests for sampling resources used by builds."""
+
+    def test_command_name(self):
+        """Test finding the program run through wrappers."""
+        cgroup_wrapper = [
+            'sudo', 'sh', '-c', 'echo $$ > "$0/cgroup.procs" && exec "$@"',
+            '/sys/fs/cgroup/freedom-maker/build'
+        ]
+        commands = [
+            (['xz', '--best', 'image'], 'xz'),
+            (['sudo', '-H', 'LANG=C', '/usr/bin/vmdebootstrap'],
+             'vmdebootstrap'),
+            (cgroup_wrapper + ['taskset', '--cpu-list', '0,1', 'sudo', '-H',
+                               'vmdebootstrap', '--verbose'],
+             'vmdebootstrap'),
+            (['sudo'], None),
+        ]
+        for command, name in commands:
+            self.assertEqual(sampling.get_command_name(command), name)
+
+    def test_read_process(self):
+        """Test reading usage of a process."""
+        usage = sampling.read_process(os.getpid())
+        self.assertEqual(usage['ppid'], os.getppid())
+        self.assertGreater(usage['rss_bytes'], 0)
+
+    def test_sample(self):
+        """Test that running commands and finished usage are sampled."""
+        builder = FakeBuilder()
+        sampler = sampling.ResourceSampler(builder, 60)
+        sampler.start()
+        self.assertEqual(builder.threads, {sampler._thread.ident})
+        process = subprocess.Popen([
+            sys.executable, '-c', 'import time\n'
+            'while time.process_time() < 0.3: pass\n'
+            'print(input())'
+        ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        builder.running_commands.add(process.pid)
+        while sampling.read_process(process.pid)['cpu_seconds'] < 0.2:
+            time.sleep(0.05)
+
+        sampler.sample()
+        process.communicate(b'done\n')
+        sampler.stop()
+        self.assertEqual(builder.threads, set())
+
+        first = sampler.samples[0]
+        self.assertEqual((first['stage'], first['command']),
+                         ('compress', 'xz'))
+        self.assertGreater(first['cpu_seconds'], 0.1)
+        self.assertGreater(first['rss_bytes'], 0)
+        summary = sampler.summary[('compress', 'xz')]
+        self.assertGreater(summary['cpu_seconds'], 0.1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'resources.csv')
+            sampler.write(file_name)
+            with open(file_name, 'r') as file_handle:
+                rows = list(csv.DictReader(file_handle))
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(list(rows[0].keys()), sampling.COLUMNS)
+
+        with self.assertLogs('freedommaker.tests', logging.INFO) as logs:
+            sampler.log_summary(logging.getLogger('freedommaker.tests'))
+
+        self.assertIn('compress', logs.output[-1])
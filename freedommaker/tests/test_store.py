@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for the content-addressed artifact store.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from freedommaker import delta
+from freedommaker import store
+
+
+class TestArtifactStore(unittest.TestCase):
+    """Tests for the content-addressed artifact store."""
+
+    def setUp(self):
+        """Create an empty store and build directory."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.build_dir = os.path.join(self.directory.name, 'build')
+        os.makedirs(self.build_dir)
+        self.store = store.ArtifactStore(
+            os.path.join(self.directory.name, 'store'))
+
+    def tearDown(self):
+        """Remove the store and build directory."""
+        self.directory.cleanup()
+
+    def publish(self, name, contents, build_stamp='2019-01-01'):
+        """Write a built file and add it to the store."""
+        file_name = os.path.join(self.build_dir, name)
+        with open(file_name, 'wb') as file_handle:
+            file_handle.write(contents)
+
+        return file_name, self.store.publish(file_name, 'amd64', build_stamp,
+                                             'fingerprint')
+
+    def test_publish(self):
+        """Test that identical files share the stored file."""
+        first, file_hash = self.publish('first.img.xz', b'image')
+        second, second_hash = self.publish('second.img.xz', b'image')
+        self.assertEqual(file_hash, hashlib.sha256(b'image').hexdigest())
+        self.assertEqual(second_hash, file_hash)
+        object_file = self.store.get_object_file(file_hash)
+        self.assertTrue(os.path.samefile(first, object_file))
+        self.assertTrue(os.path.samefile(second, object_file))
+        self.assertEqual(os.stat(object_file).st_nlink, 3)
+
+        # Files already in the store are found without hashing them
+        self.assertEqual(
+            self.store.publish(first, 'amd64', '2019-01-01', None, 'wrong'),
+            file_hash)
+
+    def test_republish(self):
+        """Test that rewriting a published file keeps the stored file."""
+        archive_file = os.path.join(self.build_dir, 'first.img.xz')
+        delta.write_index({'blocks': []}, archive_file)
+        index_file = archive_file + delta.INDEX_SUFFIX
+        with open(index_file, 'rb') as file_handle:
+            contents = file_handle.read()
+
+        file_hash = self.store.publish(index_file, 'amd64', '2019-01-01')
+        object_file = self.store.get_object_file(file_hash)
+        self.assertTrue(os.path.samefile(index_file, object_file))
+
+        delta.write_index({'blocks': [1]}, archive_file)
+        new_hash = self.store.publish(index_file, 'amd64', '2019-01-02')
+        self.assertNotEqual(new_hash, file_hash)
+        with open(object_file, 'rb') as file_handle:
+            self.assertEqual(file_handle.read(), contents)
+
+        self.assertEqual(hashlib.sha256(contents).hexdigest(), file_hash)
+
+    def test_evict(self):
+        """Test that least recently used files not pinned are evicted."""
+        old, old_hash = self.publish('old.img.xz', b'old' * 4096,
+                                     '2019-01-01')
+        release, _ = self.publish('release.img.xz', b'release' * 4096,
+                                  '2019-01-02')
+        new, _ = self.publish('new.img.xz', b'new' * 4096, '2019-01-03')
+        with open(old + '.sha256', 'w') as file_handle:
+            file_handle.write(old_hash + '  old.img.xz\n')
+
+        self.store.pin('2019-01-02')
+        self.assertEqual(self.store.get_pins(), ['2019-01-02'])
+        size = self.store.get_size()
+        self.assertEqual(self.store.evict(size), [])
+
+        evicted = self.store.evict(size - 1)
+        self.assertEqual(evicted, [old_hash])
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(old + '.sha256'))
+        self.assertFalse(
+            os.path.exists(self.store.get_object_file(old_hash)))
+
+        # Pinned files are kept even over quota
+        self.store.evict(0)
+        self.assertTrue(os.path.exists(release))
+        self.assertFalse(os.path.exists(new))
+
+        self.store.unpin('2019-01-02')
+        self.store.evict(0)
+        self.assertFalse(os.path.exists(release))
+        self.assertEqual(self.store.get_size(), 0)
+
+    @unittest.skipUnless(
+        os.path.isdir('/dev/shm') and
+        os.stat('/dev/shm').st_dev != os.stat(tempfile.gettempdir()).st_dev,
+        'no other file system to store in')
+    def test_other_file_system(self):
+        """Test that copies in build directories are evicted too."""
+        directory = tempfile.mkdtemp(dir='/dev/shm')
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = store.ArtifactStore(directory)
+        copy, file_hash = self.publish('image.img.xz', b'image')
+        object_file = self.store.get_object_file(file_hash)
+        self.assertTrue(os.path.isfile(object_file))
+        self.assertFalse(os.path.samefile(copy, object_file))
+
+        # A later build writes another file with the same name
+        replaced, _ = self.publish('replaced.img.xz', b'other')
+        os.replace(replaced, copy)
+        self.store.evict(self.store.get_size() - 1)
+        self.assertTrue(os.path.exists(copy))
+        self.assertFalse(os.path.exists(object_file))
+
+        copy, _ = self.publish('image.img.xz', b'image')
+        self.store.evict(0)
+        self.assertFalse(os.path.exists(copy))
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests for parsing image variants.
+"""
+
+import argparse
+import os
+import unittest
+
+from freedommaker.variant import ImageVariant
+
+
+class TestImageVariant(unittest.TestCase):
+    """Tests for parsing image variants."""
+
+    def test_name_only(self):
+        """Test that a variant without changes can be parsed."""
+        variant = ImageVariant.parse('plain')
+        self.assertEqual(variant.name, 'plain')
+        self.assertIsNone(variant.hostname)
+        self.assertEqual(variant.packages, [])
+
+    def test_changes(self):
+        """Test that all kinds of changes are parsed."""
+        variant = ImageVariant.parse(
+            'office:hostname=office,package=tor,package=privoxy,'
+            'custom-package=plinth_1.0_all.deb,mirror=http://mirror/debian')
+        self.assertEqual(variant.hostname, 'office')
+        self.assertEqual(variant.packages, ['tor', 'privoxy'])
+        self.assertEqual(variant.custom_packages,
+                         [os.path.abspath('plinth_1.0_all.deb')])
+        self.assertEqual(variant.mirror, 'http://mirror/debian')
+        self.assertEqual(variant.get_environment()['MIRROR'],
+                         'http://mirror/debian')
+
+    def test_invalid(self):
+        """Test that invalid specifications are rejected."""
+        for specification in ['', 'Bad Name', 'name:hostname',
+                              'name:color=red']:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                ImageVariant.parse(specification)
+
+    def test_image_file(self):
+        """Test image file name of a variant."""
+        variant = ImageVariant.parse('tor')
+        self.assertEqual(variant.get_image_file('build/fbx_all-amd64.img'),
+                         'build/fbx_all-amd64-tor.img')
@@ -0,0 +1,88 @@
+#
+# This file is part of Freedom Maker.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Variants of an image that are derived from a single base build.
+"""
+
+import argparse
+import os
+import re
+
+
+class ImageVariant(object):
+    """Differences of an image variant from the base image of a target."""
+
+    def __init__(self, name, hostname=None, packages=None,
+                 custom_packages=None, mirror=None):
+        """Initialize the object."""
+        self.name = name
+        self.hostname = hostname
+        self.packages = packages or []
+        self.custom_packages = custom_packages or []
+        self.mirror = mirror
+
+    @classmethod
+    def parse(cls, specification):
+        """Create a variant from its command line specification.
+
+        Specification is of the form 'name:key=value,key=value' where key is
+        one of hostname, package, custom-package or mirror. package and
+        custom-package may be repeated.
+
+        """
+        name, _, changes = specification.partition(':')
+        if not re.match(r'^[a-z0-9][a-z0-9.+-]*$', name):
+            raise argparse.ArgumentTypeError(
+                'Invalid variant name - {}'.format(name))
+
+        variant = cls(name)
+        for change in filter(None, changes.split(',')):
+            key, _, value = change.partition('=')
+            if not value:
+                raise argparse.ArgumentTypeError(
+                    'Invalid variant change - {}'.format(change))
+
+            if key == 'hostname':
+                variant.hostname = value
+            elif key == 'package':
+                variant.packages.append(value)
+            elif key == 'custom-package':
+                variant.custom_packages.append(os.path.abspath(value))
+            elif key == 'mirror':
+                variant.mirror = value
+            else:
+                raise argparse.ArgumentTypeError(
+                    'Unknown variant change - {}'.format(key))
+
+        return variant
+
+    def get_image_file(self, image_file):
+        """Return the path of the variant's image given base image path."""
+        base, extension = os.path.splitext(image_file)
+        return base + '-' + self.name + extension
+
+    def get_environment(self):
+        """Return environment for customization script to apply variant."""
+        environment = {
+            'VARIANT_HOSTNAME': self.hostname or '',
+            'VARIANT_PACKAGES': ' '.join(self.packages),
+            'VARIANT_CUSTOM_PACKAGES': ' '.join(self.custom_packages),
+        }
+        if self.mirror:
+            environment['MIRROR'] = self.mirror
+
+        return environment
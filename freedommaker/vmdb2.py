@@ -33,3 +33,8 @@ class Vmdb2BuilderBackend():
     def make_image(self):
         """Create a disk image."""
         raise Exception('Not implemented yet.')
+
+    @staticmethod
+    def plan_image():
+        """Return what creating a disk image would do."""
+        return {'reason': 'vmdb2 backend is not implemented yet', 'steps': []}
@@ -18,10 +18,17 @@
 Basic image builder using vmdebootstrap.
 """
 
-import json
 import logging
+import os
 import shutil
-import subprocess
+
+from . import image
+from . import mirror
+
+CHECKPOINT_DIRECTORY = '.freedom-maker-checkpoints'
+
+# Checkpoints taken by the customization script, in the order they are taken
+CHECKPOINTS = ['debootstrap', 'packages', 'hardware']
 
 logger = logging.getLogger(__name__)
 
@@ -45,12 +52,110 @@ class VmdebootstrapBuilderBackend():
 
         temp_image_file = self.builder.get_temp_image_file()
         logger.info('Building image in temporary file - %s', temp_image_file)
-        self.execution_wrapper = ['sudo', '-H']
+        self._prepare(temp_image_file)
+
+        if not (self._refresh(temp_image_file) or
+                self._resume(temp_image_file)):
+            self.process_environment()
+            command = self.execution_wrapper + [
+                self.builder.arguments.vmdebootstrap
+            ] + self.parameters
+
+            # vmdebootstrap does not always remove its kpartx mappings and
+            # loop device, also after a successful build.
+            self.builder.loop_manager.track_image(temp_image_file)
+            try:
+                self.builder._run(command)
+            finally:
+                self.builder.loop_manager.release_image(temp_image_file)
+
+        if self.builder.ram_directory and self.builder.compress_in_ram:
+            logger.info('Keeping image in RAM for compression - %s',
+                        temp_image_file)
+            self.builder.built_image_file = temp_image_file
+            return
+
+        logger.info('Moving file: %s -> %s', temp_image_file,
+                    self.builder.image_file)
+        shutil.move(temp_image_file, self.builder.image_file)
+
+    def plan_image(self):
+        """Return what creating a disk image would do, without doing it."""
+        if self.builder.should_skip_step(self.builder.image_file):
+            return {'reason': 'image exists, not compressed yet', 'steps': []}
+
+        temp_image_file = self.builder.get_temp_image_file()
+        self._prepare(temp_image_file)
+        customize = [
+            self.builder.customization_script, '{mount}', temp_image_file
+        ]
+        previous_image = self.builder.arguments.refresh_from
+        manifest = previous_image and self.builder.read_manifest(
+            previous_image)
+        if manifest and \
+           manifest['fingerprint'] == self.builder.get_fingerprint():
+            self.environment['CUSTOMIZE_PHASES'] = 'refresh'
+            self.process_environment()
+            return {
+                'reason': 'refreshing image built on ' +
+                manifest['build_stamp'],
+                'steps': [{
+                    'description': 'Copy previous image ' + previous_image,
+                    'command': None
+                }, {
+                    'description': 'Upgrade packages in mounted image',
+                    'command': self.execution_wrapper + customize
+                }]
+            }
+
+        if self.builder.arguments.resume and \
+           os.path.isfile(temp_image_file):
+            self.environment['RESUME_FROM'] = '{checkpoint}'
+            self.process_environment()
+            return {
+                'reason': 'resuming from last checkpoint, if any, in ' +
+                temp_image_file,
+                'steps': [{
+                    'description': 'Customize mounted image from its last '
+                    'checkpoint',
+                    'command': self.execution_wrapper + customize
+                }]
+            }
+
+        self.process_environment()
+        return {
+            'reason': '--force given' if self.builder.arguments.force else
+            'image does not exist',
+            'steps': [{
+                'description': 'Build image with vmdebootstrap',
+                'command': self.execution_wrapper +
+                [self.builder.arguments.vmdebootstrap] + self.parameters
+            }]
+        }
+
+    def plan_image_variant(self, variant, image_file):
+        """Return steps applying the differences of a variant."""
+        self._prepare(image_file)
+        self.environment.update(variant.get_environment())
+        self.environment['CUSTOMIZE_PHASES'] = 'variant'
+        self.process_environment()
+        return [{
+            'description': 'Customize mounted image of variant ' +
+            variant.name,
+            'command': self.execution_wrapper + [
+                self.builder.customization_script, '{mount}', image_file
+            ]
+        }]
+
+    def _prepare(self, image_file):
+        """Compute parameters and environment for building an image."""
+        self.execution_wrapper = self.builder.get_resource_wrapper() + \
+            ['sudo', '-H']
         self.parameters = [
             '--hostname',
             self.builder.arguments.hostname,
             '--image',
-            temp_image_file,
+            image_file,
             '--size',
             self.builder.arguments.image_size,
             '--mirror',
@@ -61,7 +166,7 @@ class VmdebootstrapBuilderBackend():
             self.builder.architecture,
             '--lock-root-password',
             '--log',
-            self.builder.log_file,
+            self.builder.build_log.add_file('vmdebootstrap.log'),
             '--log-level',
             self.builder.arguments.log_level,
             '--verbose',
@@ -78,63 +183,172 @@ class VmdebootstrapBuilderBackend():
             if self.builder.arguments.include_source else 'false',
             'SUITE': self.builder.arguments.distribution,
             'ENABLE_NONFREE': 'no' if self.builder.free else 'yes',
+            'BLOB_CACHE': self.builder.get_cache_directory('blobs'),
+            'SOURCE_CACHE': self.builder.get_cache_directory('sources'),
+            'SOURCE_ARCHIVE': os.path.abspath(self.builder.source_archive),
         }
         self.process_variant()
+        self.process_local_mirror()
         self.process_architecture()
         self.process_boot_loader()
         self.process_kernel_flavor()
         self.process_filesystems()
         self.process_packages()
         self.process_custom_packages()
+
+    def make_image_variant(self, variant, image_file):
+        """Apply the differences of a variant over a copy of built image."""
+        self._prepare(image_file)
+        self.environment.update(variant.get_environment())
+        self.environment['CUSTOMIZE_PHASES'] = 'variant'
         self.process_environment()
 
-        command = self.execution_wrapper + [
-            self.builder.arguments.vmdebootstrap
-        ] + self.parameters
+        with image.ImageMount(self.builder, image_file) as mount:
+            mount.mount_boot()
+            mount.install_emulator(self.builder.architecture)
+            self.builder._run(self.execution_wrapper + [
+                self.builder.customization_script, mount.root_directory,
+                image_file
+            ])
 
-        try:
-            self.builder._run(command)
-        finally:
-            self._cleanup_vmdebootstrap(temp_image_file)
+    def _refresh(self, temp_image_file):
+        """Upgrade a previously built image instead of a full build.
 
-        logger.info('Moving file: %s -> %s', temp_image_file,
-                    self.builder.image_file)
-        shutil.move(temp_image_file, self.builder.image_file)
+        Return False if the previous image can't be refreshed.
 
-    def _cleanup_vmdebootstrap(self, image_file):
-        """Cleanup those that vmdebootstrap is supposed to have cleaned up."""
-        # XXX: Remove this when vmdebootstrap removes kpartx mappings properly
-        # after a successful build.
-        process = subprocess.run(['losetup', '--json'],
-                                 stdout=subprocess.PIPE,
-                                 check=True)
-        output = process.stdout.decode()
-        if not output:
-            return
+        """
+        previous_image = self.builder.arguments.refresh_from
+        if not previous_image:
+            return False
 
-        loop_data = json.loads(output)
-        loop_device = None
-        for device_data in loop_data['loopdevices']:
-            if image_file == device_data['back-file']:
-                loop_device = device_data['name']
-                break
+        manifest = self.builder.read_manifest(previous_image)
+        if not manifest or \
+           manifest['fingerprint'] != self.builder.get_fingerprint():
+            logger.info('Customization inputs differ from previous image, '
+                        'doing a full build - %s', previous_image)
+            return False
 
-        if not loop_device:
-            return
+        logger.info('Refreshing image built on %s - %s',
+                    manifest['build_stamp'], previous_image)
+        if previous_image.endswith('.xz'):
+            self.builder._run([
+                'sh', '-c', 'xz --decompress --stdout "$1" | '
+                'cp --sparse=always /dev/stdin "$2"', 'sh', previous_image,
+                temp_image_file
+            ])
+        else:
+            self.builder._run([
+                'cp', '--reflink=auto', '--sparse=always', previous_image,
+                temp_image_file
+            ])
 
-        partition_devices = [
-            '/dev/mapper/' + loop_device.split('/')[-1] + 'p' + str(number)
-            for number in range(1, 4)
-        ]
-        # Don't log command, ignore errors, force
-        for device in partition_devices:
-            subprocess.run(['dmsetup', 'remove', '-f', device],
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.DEVNULL)
+        self.environment['CUSTOMIZE_PHASES'] = 'refresh'
+        self.process_environment()
+        with image.ImageMount(self.builder, temp_image_file) as mount:
+            mount.mount_boot()
+            mount.install_emulator(self.builder.architecture)
+            packages_before = mount.get_installed_packages()
+            self.builder._run(self.execution_wrapper + [
+                self.builder.customization_script, mount.root_directory,
+                temp_image_file
+            ])
+            self._finish_customization(mount)
+            packages_after = mount.get_installed_packages()
+
+        self._log_package_changes(packages_before, packages_after)
+        return True
+
+    @staticmethod
+    def _log_package_changes(before, after):
+        """Log the packages that changed during a refresh."""
+        changes = 0
+        for package in sorted(set(before) | set(after)):
+            if before.get(package) != after.get(package):
+                changes += 1
+                logger.info('Package changed: %s %s -> %s', package,
+                            before.get(package, '(none)'),
+                            after.get(package, '(none)'))
+
+        logger.info('%d packages changed during refresh', changes)
+
+    def _resume(self, temp_image_file):
+        """Resume a failed build from the last checkpoint in its image.
+
+        Return False if there is nothing to resume from.
+
+        """
+        if not self.builder.arguments.resume:
+            return False
+
+        if not os.path.isfile(temp_image_file):
+            logger.info('No partially built image to resume from - %s',
+                        temp_image_file)
+            return False
 
-        subprocess.run(['losetup', '-d', loop_device],
-                       stdout=subprocess.DEVNULL,
-                       stderr=subprocess.DEVNULL)
+        with image.ImageMount(self.builder, temp_image_file) as mount:
+            checkpoint = self._get_last_checkpoint(mount)
+            if not checkpoint:
+                logger.info('No checkpoint found in image, building from '
+                            'scratch - %s', temp_image_file)
+                return False
+
+            logger.info('Resuming build from checkpoint - %s', checkpoint)
+            self._restore_checkpoint(mount, checkpoint)
+            mount.install_emulator(self.builder.architecture)
+
+            self.environment['RESUME_FROM'] = checkpoint
+            self.process_environment()
+            self.builder._run(self.execution_wrapper + [
+                self.builder.customization_script, mount.root_directory,
+                temp_image_file
+            ])
+
+            self._finish_customization(mount)
+
+        return True
+
+    @staticmethod
+    def _get_last_checkpoint(mount):
+        """Return the name of last complete checkpoint in a mounted image."""
+        directory = mount.get_path(CHECKPOINT_DIRECTORY)
+        for checkpoint in reversed(CHECKPOINTS):
+            if os.path.isdir(os.path.join(directory, checkpoint)):
+                return checkpoint
+
+        return None
+
+    def _restore_checkpoint(self, mount, checkpoint):
+        """Replace contents of a mounted image with that of a checkpoint."""
+        root = mount.root_directory
+        snapshot = os.path.join(root, CHECKPOINT_DIRECTORY, checkpoint)
+        self.builder._run([
+            'sudo', 'find', root, '-mindepth', '1', '-maxdepth', '1', '!',
+            '-name', CHECKPOINT_DIRECTORY, '-exec', 'rm', '-rf', '{}', '+'
+        ])
+        self.builder._run(
+            ['sudo', 'cp', '-a', '--reflink=always', snapshot + '/.', root])
+
+        mount.mount_boot()
+        boot_archive = snapshot + '-boot.tar'
+        if os.path.isfile(boot_archive):
+            self.builder._run([
+                'sudo', 'tar', '--extract', '--overwrite', '--file',
+                boot_archive, '--directory', mount.get_path('boot')
+            ])
+
+    def _finish_customization(self, mount):
+        """Perform the steps vmdebootstrap does after customization."""
+        mount.mount_virtual_file_systems()
+        mount.chroot(['apt-get', 'clean'])
+        mount.chroot(['update-initramfs', '-u', '-k', 'all'])
+
+        if self.builder.boot_loader == 'grub':
+            mount.chroot(['update-grub'])
+            mount.chroot([
+                'grub-install', '--no-floppy',
+                '--modules=part_msdos part_gpt', '--root-directory=/',
+                mount.loop_device
+            ])
 
     def process_variant(self):
         """Add paramaters for deboostrap variant."""
@@ -144,16 +358,30 @@ class VmdebootstrapBuilderBackend():
                 'variant=' + self.builder.debootstrap_variant
             ]
 
+    def process_local_mirror(self):
+        """Add parameters to trust the key of a local build mirror."""
+        build_mirror = self.builder.arguments.build_mirror
+        if not build_mirror.startswith('file://'):
+            return
+
+        key_file = os.path.join(build_mirror[len('file://'):],
+                                mirror.KEY_FILE)
+        if os.path.isfile(key_file):
+            self.parameters += ['--debootstrapopts', 'keyring=' + key_file]
+            self.environment['BUILD_MIRROR_KEY'] = key_file
+
     def process_architecture(self):
         """Add parameters specific to the architecture."""
         if self.builder.architecture not in ('i386', 'amd64'):
             self.parameters += ['--foreign', '/usr/bin/qemu-arm-static']
 
-            # Using taskset to pin build process to single core. This
-            # is a workaround for a qemu-user-static issue that causes
-            # builds to hang. (See Debian bug #769983 for details.)
+            # Using taskset to pin build process to cores not used by other
+            # builds. This is a workaround for a qemu-user-static issue that
+            # causes builds to hang when run on multiple cores. (See Debian
+            # bug #769983 for details.)
             self.execution_wrapper = \
-                ['taskset', '0x01'] + self.execution_wrapper
+                ['taskset', '--cpu-list', self.builder.allocate_cpus()] + \
+                self.execution_wrapper
 
     def process_boot_loader(self):
         """Add parameters related to boot loader."""
@@ -196,11 +424,12 @@ class VmdebootstrapBuilderBackend():
                 '--boottype', self.builder.boot_filesystem_type
             ]
 
+        # Parameters are computed again for each variant of the image
         if 'btrfs' in [
                 self.builder.root_filesystem_type,
                 self.builder.boot_filesystem_type
-        ]:
-            self.builder.packages += ['btrfs-progs']
+        ] and 'btrfs-progs' not in self.builder.packages:
+            self.builder.packages.append('btrfs-progs')
 
     def process_packages(self):
         """Add parameters for additional packages to install in image."""